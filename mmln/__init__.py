@@ -3,9 +3,12 @@ OBSVS = 'mmln_observations'
 TARGETS = 'mmln_targets'
 TRUTH = 'mmln_truth'
 
+from .labels import LabelStore
+from .cache import GroundingCache, FactorizationCache
 from .learn import Learner, HomophilyLearner
 from .model import Model
 from .predict import MRFPredictor, LabelPropPredictor
+from .profiling import Profiler
 from .stats import estimate_p_values_inter_node
 from .util import make_stratified_k_folds, get_all_labels, prune_labels, count_labels,\
     count_coocurring_intra_node_labels, count_adjacent_labels
@@ -0,0 +1,130 @@
+import collections
+import hashlib
+import logging
+import os
+import shutil
+
+import numpy as np
+
+import mmln
+
+# Columns of a ground program. Variables are positions in the order of the target matrix, and each variable's node and
+# label are kept as indices into the label store's nodes and labels.
+_COLUMNS = ('weight', 'coeff1', 'coeff2', 'const', 'bowl', 'var1', 'var2', 'var_nodes', 'var_labels')
+
+
+class GroundingCache:
+
+    def __init__(self, path, max_bytes=2 ** 30):
+        # Each entry is a directory of .npy files named by its key, which are loaded memory-mapped. When the entries
+        # take more than max_bytes, the least recently used ones are removed.
+        self.path = path
+        self.max_bytes = max_bytes
+        self.logger = logging.getLogger(__name__)
+        os.makedirs(path, exist_ok=True)
+
+    def get_key(self, model, store, all_labels, settings=()):
+        # Hashes everything that grounding reads: the nodes, labels, and edges, the observations, which (node, label)
+        # pairs are targets, the model's weights, and any other grounding settings. Nodes, labels, and settings are
+        # hashed by their repr.
+        digest = hashlib.sha256()
+        for matrix in (store.adjacency, store.matrices[mmln.OBSVS], store.matrices[mmln.TARGETS]):
+            for array in (matrix.indptr, matrix.indices):
+                digest.update(np.asarray(array, dtype=np.int64).tobytes())
+        digest.update(np.asarray(store.matrices[mmln.OBSVS].data, dtype=float).tobytes())
+        digest.update(repr((store.nodes, store.labels, store.directed, sorted(all_labels, key=repr),
+                            model.regularization, model.inter_node_pos_same_label_default,
+                            sorted(model.intra_node_pos.items(), key=repr),
+                            sorted(model.inter_node_pos.items(), key=repr), settings)).encode())
+        return digest.hexdigest()
+
+    def load(self, key):
+        # Returns the columns of the entry, or None if there is none
+        entry = os.path.join(self.path, key)
+        if not os.path.isdir(entry):
+            return None
+        columns = dict((name, np.load(os.path.join(entry, name + '.npy'), mmap_mode='r')) for name in _COLUMNS)
+
+        # Marks the entry as used
+        os.utime(entry)
+        self.logger.info('Loaded ' + str(len(columns['weight'])) + ' potentials from the grounding cache.')
+        return columns
+
+    def save(self, key, columns):
+        # Writes the entry to a temporary directory first, so that readers never see part of it
+        entry = os.path.join(self.path, key)
+        temp = entry + '.tmp' + str(os.getpid())
+        os.makedirs(temp, exist_ok=True)
+        for name in _COLUMNS:
+            np.save(os.path.join(temp, name + '.npy'), columns[name])
+        try:
+            os.rename(temp, entry)
+        except OSError:
+            # Another process saved the same entry first
+            shutil.rmtree(temp)
+        self._evict(key)
+
+    def _evict(self, key):
+        entries = []
+        for name in os.listdir(self.path):
+            entry = os.path.join(self.path, name)
+            if os.path.isdir(entry) and '.tmp' not in name:
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), name, size))
+
+        # Removes the least recently used entries, but never the one just saved
+        total = sum(size for _, _, size in entries)
+        for _, name, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name != key:
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+                total -= size
+                self.logger.info('Evicted ' + name + ' from the grounding cache.')
+
+
+class FactorizationCache:
+
+    def __init__(self, max_bytes=2 ** 30):
+        # Keeps factorizations of label propagation systems in memory, keyed by a hash of the graph and the settings
+        # they were made with, so that predictors for different folds of the same graph can share them. When they
+        # take more than max_bytes, the least recently used ones are dropped.
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.logger = logging.getLogger(__name__)
+
+    def get_key(self, adjacency, settings=()):
+        # Hashes the graph's structure and edge weights, and the settings by their repr
+        digest = hashlib.sha256()
+        for array in (adjacency.indptr, adjacency.indices):
+            digest.update(np.asarray(array, dtype=np.int64).tobytes())
+        digest.update(np.asarray(adjacency.data, dtype=float).tobytes())
+        digest.update(repr((adjacency.shape, settings)).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        # Returns the factorization, or None if there is none
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def put(self, key, factorization, n_bytes):
+        if key in self.entries:
+            self.n_bytes -= self.entries.pop(key)[1]
+        if n_bytes > self.max_bytes:
+            self.logger.info('Not caching a factorization of ' + str(n_bytes) + ' bytes.')
+            return
+        self.entries[key] = (factorization, n_bytes)
+        self.n_bytes += n_bytes
+
+        # Drops the least recently used entries
+        while self.n_bytes > self.max_bytes:
+            evicted, (_, evicted_bytes) = self.entries.popitem(last=False)
+            self.n_bytes -= evicted_bytes
+            self.logger.info('Evicted ' + evicted + ' from the factorization cache.')
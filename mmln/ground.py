@@ -1,41 +1,61 @@
 import logging
+import multiprocessing
+
+import numpy as np
+import scipy.sparse
 
 import mmln
 import mmln.infer
+import mmln.profiling
 
 
 class GroundingManager:
 
-    def __init__(self, model, network, all_labels, inference):
+    def __init__(self, model, network, all_labels, inference, profiler=None):
         self.m = model
         self.n = network
         self.all_labels = all_labels
         self.inf = inference
 
+        # If a mmln.Profiler is given, grounding records the time of each phase with it and the number of potentials
+        # grounded for each rule family
+        self.profiler = profiler
+
         self.logger = logging.getLogger(__name__)
 
-        # Initializes variables and maps labels to nodes that have them as targets
-        self.variables = {}
+        # Initializes variables and maps labels to nodes that have them as targets. Variables are whatever the
+        # inference method uses to identify them, e.g., Variable objects or integer indices. They are numbered in
+        # the order of the entries of the label store's target matrix. The network can also be given as a label
+        # store, in which case weights are always initialized in bulk.
+        self.store = network if isinstance(network, mmln.LabelStore) else mmln.LabelStore.from_network(network)
         self.label_map = {}
         for label in self.all_labels:
             self.label_map[label] = set()
 
-        for node in self.n.nodes():
-            if mmln.TARGETS in self.n.node[node]:
-                for label in self.n.node[node][mmln.TARGETS]:
-                    self.variables[(node, label)] = mmln.infer.Variable((node, label))
-                    self.label_map[label].add(node)
+        targets = self.store.matrices[mmln.TARGETS]
+        rows = np.repeat(np.arange(len(self.store.nodes)), np.diff(targets.indptr))
+        var_ids = []
+        for i, j in zip(rows.tolist(), targets.indices.tolist()):
+            node, label = self.store.nodes[i], self.store.labels[j]
+            var_ids.append((node, label))
+            self.label_map[label].add(node)
+        variables = list(self.inf.new_variables(var_ids))
+        self.variables = dict(zip(var_ids, variables))
+        self.var_array = np.asarray(variables)
 
         # Initializes data structure mapping rules to potentials
         self.rule_map = []
 
+        # Settings of the last bulk grounding that change its potentials
+        self.settings = ()
+
     def get_value(self, node, label):
         if (node, label) in self.variables:
-            return self.variables[(node, label)].value
+            return self.inf.get_value(self.variables[(node, label)])
         else:
             raise Exception('(' + node + ', ' + label + ') is not a target.')
 
-    def init_all_weights(self):
+    def init_all_weights(self, bulk=True, n_jobs=1, cache=None, max_degree=None, seed=0, aggregate=False):
         if len(self.rule_map) > 0:
             self.logger.info('Weights already set. Zeroing all potential weights before initializing.')
             for rule in self.rule_map:
@@ -43,75 +63,598 @@ class GroundingManager:
                     pass
             self.rule_map = []
 
+        if bulk:
+            self._init_all_weights_bulk(n_jobs, cache, max_degree, seed, aggregate)
+            return
+        elif self.n is self.store:
+            raise Exception('Weights can only be initialized in bulk from a label store.')
+        elif n_jobs > 1 or cache is not None or max_degree is not None or aggregate:
+            raise Exception('Weights can only be initialized in parallel, from a cache, with capped degrees, or with '
+                            'aggregated evidence in bulk.')
+
         self.logger.info('Initializing all weights. Starting with regularization.')
-        for var in self.variables.values():
-            self.inf.add_weight(self.m.regularization, 1, var, -0.5, two_sided=True, squared=True)
+        with mmln.profiling._phase(self.profiler, 'ground regularization'):
+            for var in self.variables.values():
+                self.inf.add_weight(self.m.regularization, 1, var, -0.5, two_sided=True, squared=True)
+        self._count(_REGULARIZATION, 1, True, len(self.variables))
 
         self.logger.info('Added ' + str(len(self.variables)) + ' regularization weights. ' +
                          'Starting intra-node weights.')
         pots_set = 0
-        for (l1, l2), weight in self.m.intra_node_pos.items():
-            for node in self.label_map[l1]:
-                var = self.variables[(node, l1)]
-                if mmln.TARGETS in self.n.node[node] and l2 in self.n.node[node][mmln.TARGETS]:
-                    other_var = self.variables[(node, l2)]
-                    self.inf.add_weight(weight, (1, -1), (var, other_var), 0, squared=True)
-                    pots_set += 1
-                elif mmln.OBSVS in self.n.node[node] and l2 in self.n.node[node][mmln.OBSVS]:
-                    obsv = self.n.node[node][mmln.OBSVS][l2]
-                    self.inf.add_weight(weight, 1, var, -1 * obsv, squared=True)
-                    pots_set += 1
-
-            # Gets the dependencies we missed: (node, l2) where (node, l1) is observed (explicitly or implicitly)
-            for node in self.label_map[l2]:
-                if mmln.OBSVS in self.n.node[node] and l1 in self.n.node[node][mmln.OBSVS]:
-                    other_var = self.variables[(node, l2)]
-                    obsv = self.n.node[node][mmln.OBSVS][l1]
-                    self.inf.add_weight(weight, -1, other_var, obsv, squared=True)
-                    pots_set += 1
-
-        self.logger.info('Added ' + str(pots_set) + ' intra-node weights. ' +
-                         'Starting non-default inter-node weights.')
-        pots_set = 0
-        for (l1, l2), weight in self.m.inter_node_pos.items():
-            for node in self.label_map[l1]:
-                var = self.variables[(node, l1)]
-                for other_node in self.n.neighbors(node):
-                    if mmln.TARGETS in self.n.node[other_node] and l2 in self.n.node[other_node][mmln.TARGETS]:
-                        other_var = self.variables[(other_node, l2)]
+        with mmln.profiling._phase(self.profiler, 'ground ' + _INTRA):
+            for (l1, l2), weight in self.m.intra_node_pos.items():
+                for node in self.label_map[l1]:
+                    var = self.variables[(node, l1)]
+                    if mmln.TARGETS in self.n.node[node] and l2 in self.n.node[node][mmln.TARGETS]:
+                        other_var = self.variables[(node, l2)]
                         self.inf.add_weight(weight, (1, -1), (var, other_var), 0, squared=True)
+                        self._count(_INTRA, 2, False)
                         pots_set += 1
-                    elif mmln.OBSVS in self.n.node[other_node] and l2 in self.n.node[other_node][mmln.OBSVS]:
-                        obsv = self.n.node[other_node][mmln.OBSVS][l2]
+                    elif mmln.OBSVS in self.n.node[node] and l2 in self.n.node[node][mmln.OBSVS]:
+                        obsv = self.n.node[node][mmln.OBSVS][l2]
                         self.inf.add_weight(weight, 1, var, -1 * obsv, squared=True)
+                        self._count(_INTRA, 1, False)
                         pots_set += 1
 
-            # Gets the dependencies we missed: (other_node, l2) where (node, l1) is observed
-            for other_node in self.label_map[l2]:
-                other_var = self.variables[(other_node, l2)]
-                for node in self.n.neighbors(other_node):
+                # Gets the dependencies we missed: (node, l2) where (node, l1) is observed (explicitly or implicitly)
+                for node in self.label_map[l2]:
                     if mmln.OBSVS in self.n.node[node] and l1 in self.n.node[node][mmln.OBSVS]:
+                        other_var = self.variables[(node, l2)]
                         obsv = self.n.node[node][mmln.OBSVS][l1]
                         self.inf.add_weight(weight, -1, other_var, obsv, squared=True)
+                        self._count(_INTRA, 1, False)
                         pots_set += 1
 
-        self.logger.info('Added ' + str(pots_set) + ' non-default inter-node weights. ' +
-                         'Starting default inter-node weights.')
+        self.logger.info('Added ' + str(pots_set) + ' intra-node weights. ' +
+                         'Starting non-default inter-node weights.')
         pots_set = 0
-        weight = self.m.inter_node_pos_same_label_default
-        for label in self.all_labels:
-            if (label, label) not in self.m.inter_node_pos:
-                for node in self.label_map[label]:
-                    var = self.variables[(node, label)]
+        with mmln.profiling._phase(self.profiler, 'ground ' + _INTER):
+            for (l1, l2), weight in self.m.inter_node_pos.items():
+                for node in self.label_map[l1]:
+                    var = self.variables[(node, l1)]
                     for other_node in self.n.neighbors(node):
-                        if mmln.TARGETS in self.n.node[other_node] and label in self.n.node[other_node][mmln.TARGETS]:
-                            other_var = self.variables[(other_node, label)]
+                        if mmln.TARGETS in self.n.node[other_node] and l2 in self.n.node[other_node][mmln.TARGETS]:
+                            other_var = self.variables[(other_node, l2)]
                             self.inf.add_weight(weight, (1, -1), (var, other_var), 0, squared=True)
+                            self._count(_INTER, 2, False)
+                            pots_set += 1
+                        elif mmln.OBSVS in self.n.node[other_node] and l2 in self.n.node[other_node][mmln.OBSVS]:
+                            obsv = self.n.node[other_node][mmln.OBSVS][l2]
+                            self.inf.add_weight(weight, 1, var, -1 * obsv, squared=True)
+                            self._count(_INTER, 1, False)
                             pots_set += 1
-                        elif mmln.OBSVS in self.n.node[other_node] and label in self.n.node[other_node][mmln.OBSVS]:
-                            obsv = self.n.node[other_node][mmln.OBSVS][label]
-                            self.inf.add_weight(weight, 1, var, -1 * obsv, two_sided=True, squared=True)
+
+                # Gets the dependencies we missed: (other_node, l2) where (node, l1) is observed
+                for other_node in self.label_map[l2]:
+                    other_var = self.variables[(other_node, l2)]
+                    for node in self.n.neighbors(other_node):
+                        if mmln.OBSVS in self.n.node[node] and l1 in self.n.node[node][mmln.OBSVS]:
+                            obsv = self.n.node[node][mmln.OBSVS][l1]
+                            self.inf.add_weight(weight, -1, other_var, obsv, squared=True)
+                            self._count(_INTER, 1, False)
                             pots_set += 1
 
+        self.logger.info('Added ' + str(pots_set) + ' non-default inter-node weights. ' +
+                         'Starting default inter-node weights.')
+        pots_set = 0
+        weight = self.m.inter_node_pos_same_label_default
+        with mmln.profiling._phase(self.profiler, 'ground ' + _DEFAULT):
+            for label in self.all_labels:
+                if (label, label) not in self.m.inter_node_pos:
+                    for node in self.label_map[label]:
+                        var = self.variables[(node, label)]
+                        for other_node in self.n.neighbors(node):
+                            if mmln.TARGETS in self.n.node[other_node] and \
+                                    label in self.n.node[other_node][mmln.TARGETS]:
+                                other_var = self.variables[(other_node, label)]
+                                self.inf.add_weight(weight, (1, -1), (var, other_var), 0, squared=True)
+                                self._count(_DEFAULT, 2, False)
+                                pots_set += 1
+                            elif mmln.OBSVS in self.n.node[other_node] and \
+                                    label in self.n.node[other_node][mmln.OBSVS]:
+                                obsv = self.n.node[other_node][mmln.OBSVS][label]
+                                self.inf.add_weight(weight, 1, var, -1 * obsv, two_sided=True, squared=True)
+                                self._count(_DEFAULT, 1, True)
+                                pots_set += 1
+
         self.logger.info('Added ' + str(pots_set) + ' default inter-node weights. ' +
                          'Done initializing weights.')
+
+    def update(self, added_nodes=(), removed_nodes=(), added_edges=(), removed_edges=(), label_changes=None):
+        # Applies changes to the network and adds, removes, or reweights only the potentials and variables they
+        # affect, so inference can continue from the current solution. Added nodes and edges are given as to
+        # networkx's add_nodes_from and add_edges_from, and label changes map nodes to dictionaries of new OBSVS,
+        # TARGETS, or TRUTH entries, which replace the old ones.
+        if isinstance(self.n, mmln.LabelStore):
+            raise Exception('Only networks, not label stores, can be updated.')
+        elif self.settings:
+            raise Exception('Only networks grounded without capped degrees or aggregated evidence can be updated.')
+        added_nodes = list(added_nodes)
+        added_edges = list(added_edges)
+        removed_nodes = list(removed_nodes)
+        removed_edges = list(removed_edges)
+        label_changes = label_changes if label_changes is not None else {}
+
+        # A potential depends on the labels of a node or on an edge and the labels of its ends, so the potentials of
+        # each changed node and its edges are subtracted before the changes and added back after them. Weights of
+        # potentials that did not change cancel out and are left as they are. Added edges that already exist are
+        # subtracted too, so that re-adding them replaces their potentials instead of counting them twice.
+        added_ids = [node[0] if isinstance(node, tuple) and len(node) == 2 and isinstance(node[1], dict) else node
+                     for node in added_nodes]
+        changed_nodes = set(removed_nodes) | set(label_changes) | set(added_ids)
+        deltas = {}
+        self._collect_potentials([node for node in changed_nodes if self.n.has_node(node)],
+                                 removed_edges + [edge for edge in added_edges if self.n.has_edge(*edge[:2])],
+                                 deltas, -1)
+
+        self.n.remove_edges_from([edge[:2] for edge in removed_edges])
+        self.n.remove_nodes_from(removed_nodes)
+        self.n.add_nodes_from(added_nodes)
+        self.n.add_edges_from(added_edges)
+        for node, labels in label_changes.items():
+            self.n.node[node].update(labels)
+
+        self._update_variables(changed_nodes)
+        changed_nodes = [node for node in changed_nodes if self.n.has_node(node)]
+        self._collect_potentials(changed_nodes, added_edges, deltas, 1)
+
+        pots_changed = 0
+        for (coefficients, variables, constant, two_sided), (delta, scale) in deltas.items():
+            if abs(delta) <= _TOLERANCE * scale:
+                continue
+            pots_changed += 1
+            if delta > 0:
+                self.inf.add_weight(delta, coefficients, variables, constant, two_sided, squared=True)
+            elif self.inf.get_weight(coefficients, variables, constant, two_sided, squared=True) + delta > \
+                    _TOLERANCE * scale:
+                self.inf.subtract_weight(-delta, coefficients, variables, constant, two_sided, squared=True)
+            else:
+                self.inf.set_weight(0, coefficients, variables, constant, two_sided, squared=True)
+
+        # The label store is remade from the network when next needed
+        self.store = None
+        self.var_array = None
+        self.logger.info('Updated ' + str(pots_changed) + ' potentials for ' + str(len(changed_nodes)) +
+                         ' changed nodes.')
+
+    def _update_variables(self, nodes):
+        # Removes the variables of targets that nodes no longer have and makes variables for their new targets
+        var_ids = []
+        for node in nodes:
+            attributes = self.n.node[node] if self.n.has_node(node) else {}
+            targets = attributes.get(mmln.TARGETS, ())
+            for label in self.all_labels:
+                if (node, label) in self.variables and label not in targets:
+                    del self.variables[(node, label)]
+                    self.label_map[label].discard(node)
+            for label in targets:
+                if (node, label) not in self.variables:
+                    self.label_map[label].add(node)
+                    var_ids.append((node, label))
+        self.variables.update(zip(var_ids, self.inf.new_variables(var_ids)))
+
+    def _collect_potentials(self, nodes, edges, deltas, sign):
+        # Adds sign times the weight of each potential of nodes, their edges, and the given edges to deltas
+        # Undirected edges are grounded from both ends, so both directions are collected
+        edges = [edge[:2] for edge in edges if self.n.has_edge(edge[0], edge[1])]
+        for node in nodes:
+            edges.extend(self.n.out_edges(node) if self.n.is_directed() else self.n.edges(node))
+            if self.n.is_directed():
+                edges.extend(self.n.in_edges(node))
+        pairs = set(edges)
+        if not self.n.is_directed():
+            pairs.update((other_node, node) for node, other_node in edges)
+
+        for node in nodes:
+            self._collect_node_potentials(node, deltas, sign)
+        for node, other_node in pairs:
+            self._collect_edge_potentials(node, other_node, deltas, sign)
+
+    def _collect_node_potentials(self, node, deltas, sign):
+        obsvs = self.n.node[node].get(mmln.OBSVS, {})
+        for label in self.all_labels:
+            if (node, label) in self.variables:
+                _add_delta(deltas, sign * self.m.regularization, (1,), (self.variables[(node, label)],), -0.5, True)
+
+        for (l1, l2), weight in self.m.intra_node_pos.items():
+            if (node, l1) in self.variables:
+                var = self.variables[(node, l1)]
+                if (node, l2) in self.variables:
+                    _add_delta(deltas, sign * weight, (1, -1), (var, self.variables[(node, l2)]), 0)
+                elif l2 in obsvs:
+                    _add_delta(deltas, sign * weight, (1,), (var,), -1 * obsvs[l2])
+            if (node, l2) in self.variables and l1 in obsvs:
+                _add_delta(deltas, sign * weight, (-1,), (self.variables[(node, l2)],), obsvs[l1])
+
+    def _collect_edge_potentials(self, node, other_node, deltas, sign):
+        # Collects the potentials grounded from node's side of the edge to other_node
+        other_obsvs = self.n.node[other_node].get(mmln.OBSVS, {})
+        for (l1, l2), weight in self.m.inter_node_pos.items():
+            if (node, l1) in self.variables:
+                var = self.variables[(node, l1)]
+                if (other_node, l2) in self.variables:
+                    _add_delta(deltas, sign * weight, (1, -1), (var, self.variables[(other_node, l2)]), 0)
+                elif l2 in other_obsvs:
+                    _add_delta(deltas, sign * weight, (1,), (var,), -1 * other_obsvs[l2])
+            if (node, l2) in self.variables and l1 in other_obsvs:
+                _add_delta(deltas, sign * weight, (-1,), (self.variables[(node, l2)],), other_obsvs[l1])
+
+        weight = self.m.inter_node_pos_same_label_default
+        for label in self.all_labels:
+            if (label, label) not in self.m.inter_node_pos and (node, label) in self.variables:
+                var = self.variables[(node, label)]
+                if (other_node, label) in self.variables:
+                    _add_delta(deltas, sign * weight, (1, -1), (var, self.variables[(other_node, label)]), 0)
+                elif label in other_obsvs:
+                    _add_delta(deltas, sign * weight, (1,), (var,), -1 * other_obsvs[label], True)
+
+    def _count(self, family, n_vars, two_sided, n=1):
+        if self.profiler is not None:
+            self.profiler.count(family, mmln.profiling._kind(n_vars, two_sided), n)
+
+    def _count_kinds(self, family, kinds):
+        if self.profiler is not None:
+            for kind, n in kinds.items():
+                self.profiler.count(family, kind, n)
+
+    def _refresh_store(self):
+        # Remakes the label store after updates, with variables in the order of its target matrix
+        self.store = mmln.LabelStore.from_network(self.n)
+        targets = self.store.matrices[mmln.TARGETS]
+        rows = np.repeat(np.arange(len(self.store.nodes)), np.diff(targets.indptr))
+        self.var_array = np.asarray([self.variables[(self.store.nodes[i], self.store.labels[j])]
+                                     for i, j in zip(rows.tolist(), targets.indices.tolist())])
+
+    def _init_all_weights_bulk(self, n_jobs=1, cache=None, max_degree=None, seed=0, aggregate=False):
+        if self.store is None:
+            self._refresh_store()
+        self.settings = ((max_degree, seed) if max_degree is not None else ()) + (('aggregate',) if aggregate else ())
+
+        # Nodes with more than max_degree neighbors only get inter-node potentials for a sample of them
+        adjacency = None
+        if max_degree is not None:
+            with mmln.profiling._phase(self.profiler, 'cap degrees'):
+                adjacency = _cap_degrees(self.store.adjacency, max_degree, seed)
+            self.logger.info('Sampled the neighbors of ' +
+                             str(np.count_nonzero(np.diff(self.store.adjacency.indptr) > max_degree)) +
+                             ' nodes with more than ' + str(max_degree) + '.')
+
+        if cache is None:
+            self._ground_bulk(self.inf, self.var_array, n_jobs, adjacency, aggregate)
+            return
+
+        # The cache keeps the ground program with variables as positions in the variable array
+        with mmln.profiling._phase(self.profiler, 'load cache'):
+            key = cache.get_key(self.m, self.store, self.all_labels, self.settings)
+            columns = cache.load(key)
+        targets = self.store.matrices[mmln.TARGETS]
+        var_nodes = np.repeat(np.arange(len(self.store.nodes)), np.diff(targets.indptr))
+        if columns is None:
+            staging = mmln.infer._ArrayInference()
+            staging.new_variables(range(len(self.var_array)))
+            self._ground_bulk(staging, np.arange(len(self.var_array)), n_jobs, adjacency, aggregate)
+            columns = staging.get_potentials()
+            columns['var_nodes'] = var_nodes
+            columns['var_labels'] = targets.indices
+            with mmln.profiling._phase(self.profiler, 'save cache'):
+                cache.save(key, columns)
+        elif not (np.array_equal(columns['var_nodes'], var_nodes) and
+                  np.array_equal(columns['var_labels'], targets.indices)):
+            raise Exception('Cached variables do not match the targets.')
+        else:
+            for n_vars, two_sided in ((1, False), (1, True), (2, False), (2, True)):
+                self._count(_CACHED, n_vars, two_sided, np.count_nonzero(
+                    ((columns['var2'] >= 0) == (n_vars == 2)) & (columns['bowl'] == two_sided)))
+
+        with mmln.profiling._phase(self.profiler, 'add cached potentials'):
+            _add_distinct_potentials(self.inf, self.var_array, columns)
+
+    def _ground_bulk(self, inf, var_array, n_jobs, adjacency=None, aggregate=False):
+        # Grounds each rule as one batch, by looking up targets and observations in the columns of the label store and
+        # neighbors in its adjacency matrix
+        if aggregate:
+            inf = _EvidenceAggregator(inf, var_array)
+            var_array = np.arange(len(var_array))
+
+        rules = [(_INTRA, l1, l2, weight) for (l1, l2), weight in self.m.intra_node_pos.items()]
+        rules += [(_INTER, l1, l2, weight) for (l1, l2), weight in self.m.inter_node_pos.items()]
+        rules += [(_DEFAULT, label, label, self.m.inter_node_pos_same_label_default) for label in self.all_labels
+                  if (label, label) not in self.m.inter_node_pos]
+        parallel = n_jobs > 1 and len(rules) > 1
+
+        self.logger.info('Initializing all weights in bulk. Starting with regularization.')
+        if not parallel:
+            with mmln.profiling._phase(self.profiler, 'ground regularization'):
+                inf.add_weights(self.m.regularization, 1, var_array, -0.5, two_sided=True, squared=True)
+        self._count(_REGULARIZATION, 1, True, len(var_array))
+        self.logger.info('Added ' + str(len(var_array)) + ' regularization weights.')
+
+        if parallel:
+            # Each worker grounds its rules, and the first one the regularization too, in terms of positions in the
+            # variable array, merges the repeated potentials, and splits them into n_jobs parts by hash. Each part is
+            # then merged across the workers by one worker, so that the parts hold distinct potentials and can be
+            # added without merging them again. The label store is passed to each worker once, when it starts.
+            self.logger.info('Grounding ' + str(len(rules)) + ' rules with ' + str(n_jobs) + ' processes.')
+            n_jobs = min(n_jobs, len(rules))
+            jobs = [(([(_REGULARIZATION, None, None, self.m.regularization)] if i == 0 else []) + rules[i::n_jobs],
+                     n_jobs) for i in range(n_jobs)]
+            with mmln.profiling._phase(self.profiler, 'ground in parallel'):
+                with multiprocessing.Pool(n_jobs, _init_ground_worker, (self.store, len(var_array), adjacency)) as pool:
+                    results = pool.starmap(_ground_rules_job, jobs)
+                    parts = pool.map(_merge_parts_job, [[result[0][j] for result in results] for j in range(n_jobs)])
+
+            pots_set = dict((family, 0) for family in _FAMILIES)
+            for i in range(len(rules)):
+                count, kinds = results[i % n_jobs][1][i // n_jobs]
+                pots_set[rules[i][0]] += count
+                self._count_kinds(rules[i][0], kinds)
+            with mmln.profiling._phase(self.profiler, 'add parallel potentials'):
+                _add_distinct_potentials(inf, var_array, dict((name, np.concatenate([part[name] for part in parts]))
+                                                              for name in parts[0]))
+        else:
+            grounder = _BulkGrounder(self.store, var_array, inf, adjacency)
+            pots_set = dict((family, 0) for family in _FAMILIES)
+            for rule in rules:
+                with mmln.profiling._phase(self.profiler, 'ground ' + rule[0]):
+                    pots_set[rule[0]] += grounder.ground(*rule)
+                self._count_kinds(rule[0], grounder.kinds)
+                grounder.kinds = {}
+
+        self.logger.info('Added ' + str(pots_set[_INTRA]) + ' intra-node weights, ' + str(pots_set[_INTER]) +
+                         ' non-default inter-node weights, and ' + str(pots_set[_DEFAULT]) +
+                         ' default inter-node weights. Done initializing weights.')
+        if aggregate:
+            with mmln.profiling._phase(self.profiler, 'aggregate evidence'):
+                n_folded, n_dropped, n_bowls = inf.flush()
+            self._count(_AGGREGATED, 1, True, n_bowls)
+            self.logger.info('Folded ' + str(n_folded) + ' potentials on one variable into ' + str(n_bowls) +
+                             ' and dropped ' + str(n_dropped) + ' that are zero on [0, 1].')
+
+
+# Families of rules grounded in bulk
+_INTRA = 'intra'
+_INTER = 'inter'
+_DEFAULT = 'default'
+_FAMILIES = (_INTRA, _INTER, _DEFAULT)
+
+# Other families of potentials reported to profilers
+_REGULARIZATION = 'regularization'
+_AGGREGATED = 'aggregated'
+_CACHED = 'cached'
+
+
+class _BulkGrounder:
+
+    def __init__(self, store, var_array, inference, adjacency=None):
+        # Potentials are added to the inference method, which only needs an add_weights method. Neighbors can be
+        # given by another adjacency matrix, whose entries scale the weights of the potentials between the nodes.
+        self.store = store
+        self.var_array = var_array
+        self.inf = inference
+        self.adjacency = adjacency
+
+        # Number of potentials added of each kind
+        self.kinds = {}
+
+    def ground(self, family, l1, l2, weight):
+        # Adds the potentials of a rule and returns how many were added
+        if family == _INTRA:
+            nodes, variables = self._get_targets(l1)
+            pots_set = self._add_inter_label_weights(weight, variables, nodes, l2)
+
+            # Gets the dependencies we missed: (node, l2) where (node, l1) is observed
+            nodes, variables = self._get_targets(l2)
+            return pots_set + self._add_obsv_weights(weight, -1, variables, nodes, l1)
+        elif family == _INTER:
+            nodes, variables = self._get_targets(l1)
+            sources, neighbors, weights = self._get_neighbors(nodes, weight)
+            pots_set = self._add_inter_label_weights(weights, variables[sources], neighbors, l2)
+
+            # Gets the dependencies we missed: (other_node, l2) where (node, l1) is observed
+            nodes, variables = self._get_targets(l2)
+            sources, neighbors, weights = self._get_neighbors(nodes, weight)
+            return pots_set + self._add_obsv_weights(weights, -1, variables[sources], neighbors, l1)
+        else:
+            nodes, variables = self._get_targets(l1)
+            sources, neighbors, weights = self._get_neighbors(nodes, weight)
+            return self._add_inter_label_weights(weights, variables[sources], neighbors, l1, two_sided_obsvs=True)
+
+    def _get_targets(self, label):
+        nodes, positions = self.store.get_entries(mmln.TARGETS, label)
+        return nodes, self.var_array[positions]
+
+    def _get_neighbors(self, nodes, weight):
+        # Returns each (node, neighbor) pair as the node's position in nodes and the neighbor, and the weight of its
+        # potentials
+        if self.adjacency is None:
+            rows = self.store.adjacency[nodes]
+            return np.repeat(np.arange(len(nodes)), np.diff(rows.indptr)), rows.indices, weight
+        rows = self.adjacency[nodes]
+        return np.repeat(np.arange(len(nodes)), np.diff(rows.indptr)), rows.indices, weight * rows.data
+
+    def _add_inter_label_weights(self, weights, variables, other_nodes, other_label, two_sided_obsvs=False):
+        # Adds a hinge from each variable to the other node's variable for other_label if it is a target, or else to
+        # its observation, if any. Weights are one for all or one for each variable.
+        weights = np.broadcast_to(np.asarray(weights, dtype=float), (len(variables),))
+        has_target, positions = self.store.lookup_entries(mmln.TARGETS, other_label, other_nodes)
+        self._add_weights(weights[has_target], (1, -1), _stack(variables[has_target], self.var_array[positions]), 0)
+        pots_set = len(positions)
+
+        untargeted = ~has_target
+        return pots_set + self._add_obsv_weights(weights[untargeted], 1, variables[untargeted],
+                                                 other_nodes[untargeted], other_label, two_sided_obsvs)
+
+    def _add_obsv_weights(self, weights, coefficient, variables, obsv_nodes, obsv_label, two_sided=False):
+        weights = np.broadcast_to(np.asarray(weights, dtype=float), (len(variables),))
+        has_obsv, obsvs = self.store.lookup(mmln.OBSVS, obsv_label, obsv_nodes)
+        self._add_weights(weights[has_obsv], coefficient, variables[has_obsv], -1 * coefficient * obsvs, two_sided)
+        return len(obsvs)
+
+    def _add_weights(self, weights, coefficients, variables, constants, two_sided=False):
+        kind = mmln.profiling._kind(variables.shape[1] if variables.ndim == 2 else 1, two_sided)
+        self.kinds[kind] = self.kinds.get(kind, 0) + len(variables)
+        self.inf.add_weights(weights, coefficients, variables, constants, two_sided=two_sided, squared=True)
+
+
+class _EvidenceAggregator:
+
+    def __init__(self, inference, var_array):
+        # Passes potentials on to the inference method, except those on one variable that are zero or quadratic
+        # wherever the variable is in [0, 1]. The quadratic ones, such as bowls and hinges toward observations of 0 or
+        # 1, are summed into one bowl per variable when flushed, which has the same minimizers as their sum since
+        # solvers keep variables in [0, 1]. Hinges toward fractional observations are passed on, and potentials with
+        # the same observation are still merged by the inference method. Variables are positions in var_array.
+        self.inf = inference
+        self.var_array = var_array
+        self.weights = np.zeros(len(var_array))
+        self.centers = np.zeros(len(var_array))
+        self.n_folded = 0
+        self.n_dropped = 0
+
+    def add_weights(self, weights, coefficients, variables, constants, two_sided=False, squared=False):
+        weights, coefficients, variables, constants, two_sided = mmln.infer._broadcast_batch(
+            weights, coefficients, variables, constants, two_sided)
+        passed = np.ones(len(variables), dtype=bool)
+        if squared and variables.shape[1] == 1:
+            # Bounds of coefficient * x + constant for x in [0, 1]
+            coefficients = coefficients[:, 0]
+            lower = constants + np.minimum(coefficients, 0)
+            upper = constants + np.maximum(coefficients, 0)
+            dropped = (coefficients == 0) | (~two_sided & (upper <= 0))
+            folded = ~dropped & (two_sided | (lower >= 0))
+
+            # w * (c * x + k) ^ 2 is w * c ^ 2 * (x + k / c) ^ 2
+            scales = weights[folded] * coefficients[folded] ** 2
+            positions = variables[folded, 0]
+            self.weights += np.bincount(positions, scales, minlength=len(self.weights))
+            self.centers -= np.bincount(positions, scales * constants[folded] / coefficients[folded],
+                                        minlength=len(self.centers))
+            self.n_folded += len(positions)
+            self.n_dropped += np.count_nonzero(dropped)
+            passed = ~(dropped | folded)
+            coefficients = coefficients.reshape(-1, 1)
+
+        if passed.any():
+            self.inf.add_weights(weights[passed], coefficients[passed], self.var_array[variables[passed]],
+                                 constants[passed], two_sided[passed], squared)
+
+    def flush(self):
+        # Adds the bowls and returns the number of potentials folded into them, dropped, and the number of bowls
+        positions = np.flatnonzero(self.weights > 0)
+        self.inf.add_weights(self.weights[positions], 1, self.var_array[positions],
+                             -1 * self.centers[positions] / self.weights[positions], two_sided=True, squared=True)
+        return self.n_folded, self.n_dropped, len(positions)
+
+
+# What grounding workers share, set once when each one starts
+_worker_state = {}
+
+
+def _init_ground_worker(store, n_vars, adjacency):
+    _worker_state['store'] = store
+    _worker_state['n_vars'] = n_vars
+    _worker_state['adjacency'] = adjacency
+
+
+def _ground_rules_job(rules, n_parts):
+    # Grounds rules with the variables given as their positions in the variable array, and merges their repeated
+    # potentials. Returns the potentials' columns split into n_parts parts by hash, and the number of potentials and
+    # of each kind of potential of each rule.
+    n_vars = _worker_state['n_vars']
+    staging = mmln.infer._ArrayInference()
+    staging.new_variables(range(n_vars))
+    grounder = _BulkGrounder(_worker_state['store'], np.arange(n_vars), staging, _worker_state['adjacency'])
+    counts = []
+    for rule in rules:
+        if rule[0] == _REGULARIZATION:
+            staging.add_weights(rule[3], 1, np.arange(n_vars), -0.5, two_sided=True, squared=True)
+            continue
+        grounder.kinds = {}
+        count = grounder.ground(*rule)
+        counts.append((count, grounder.kinds))
+
+    columns = staging.get_potentials()
+    parts = mmln.infer._hash_potentials(columns['var1'], columns['var2'], columns['coeff1'], columns['coeff2'],
+                                        columns['const'], columns['bowl']) % np.uint64(n_parts)
+    return [dict((name, column[parts == j]) for name, column in columns.items()) for j in range(n_parts)], counts
+
+
+def _merge_parts_job(parts):
+    # Merges the same part of the potentials of each worker, returning the distinct potentials' columns
+    staging = mmln.infer._ArrayInference()
+    staging.new_variables(range(_worker_state['n_vars']))
+    for part in parts:
+        _add_distinct_potentials(staging, np.arange(_worker_state['n_vars']), part)
+    return staging.get_potentials()
+
+
+def _add_distinct_potentials(inf, var_array, columns):
+    # Adds potentials given as columns, as returned by get_potentials, with variables as positions in var_array. The
+    # potentials must be distinct, so they are set without merging when inf is an array-backed method without any.
+    var1 = var_array[columns['var1']]
+    two_vars = columns['var2'] >= 0
+    if isinstance(inf, mmln.infer._ArrayInference) and inf.n_pots == 0:
+        var2 = np.where(two_vars, var_array[np.where(two_vars, columns['var2'], 0)], -1)
+        inf.set_potentials(dict(columns, var1=var1, var2=var2))
+    else:
+        one_var = ~two_vars
+        inf.add_weights(columns['weight'][one_var], columns['coeff1'][one_var], var1[one_var],
+                        columns['const'][one_var], columns['bowl'][one_var], squared=True)
+        inf.add_weights(columns['weight'][two_vars], _stack(columns['coeff1'][two_vars], columns['coeff2'][two_vars]),
+                        _stack(var1[two_vars], var_array[columns['var2'][two_vars]]), columns['const'][two_vars],
+                        columns['bowl'][two_vars], squared=True)
+
+
+# Changes in weight smaller than this, relative to the weights that were summed, are rounding error
+_TOLERANCE = 1e-9
+
+
+def _add_delta(deltas, weight, coefficients, variables, constant, two_sided=False):
+    if weight != 0:
+        delta, scale = deltas.get((coefficients, variables, constant, two_sided), (0, 0))
+        deltas[(coefficients, variables, constant, two_sided)] = (delta + weight, scale + abs(weight))
+
+
+def _cap_degrees(adjacency, max_degree, seed):
+    # Samples the edges so that no node keeps more than max_degree of them. Each edge, in either direction, gets one
+    # random key, and is kept if it is among the max_degree smallest keys of both of its ends, so potentials grounded
+    # from either end use the same sample and a node's potentials are capped however they are grounded. Returns the
+    # kept entries of adjacency with the larger degree of their ends divided by max_degree, which scales the weights
+    # of the kept potentials so that the expected total of each node's potentials stays about the same, exactly so
+    # when one end has at most max_degree edges.
+    pattern = (adjacency != 0).astype(float)
+    pattern = (pattern + pattern.T).tocsr()
+    pattern.sum_duplicates()
+    pattern.sort_indices()
+    degrees = np.diff(pattern.indptr)
+    rows = np.repeat(np.arange(len(degrees)), degrees)
+    cols = pattern.indices
+
+    # Gives both directions of an edge the key drawn for the one from its lower node
+    upper = rows <= cols
+    keys = scipy.sparse.csr_matrix((np.random.RandomState(seed).random_sample(np.count_nonzero(upper)) + 1,
+                                    (rows[upper], cols[upper])), shape=pattern.shape)
+    keys = (keys + scipy.sparse.triu(keys, 1).T).tocsr()
+    keys.sort_indices()
+
+    order = np.lexsort((keys.data, rows))
+    ranks = np.empty(len(rows), dtype=np.intp)
+    ranks[order] = np.arange(len(rows)) - pattern.indptr[rows[order]]
+    kept = scipy.sparse.csr_matrix(((ranks < max_degree).astype(float), cols, pattern.indptr), shape=pattern.shape)
+    kept = kept.multiply(kept.T).tocsr()
+
+    # Keeps the entries of adjacency whose edges are kept
+    entries = adjacency.tocoo()
+    in_sample = np.asarray(kept[entries.row, entries.col]).ravel() > 0
+    scales = np.maximum(np.maximum(degrees[entries.row], degrees[entries.col]) / float(max(max_degree, 1)), 1.0)
+    capped = scipy.sparse.csr_matrix((scales[in_sample], (entries.row[in_sample], entries.col[in_sample])),
+                                     shape=adjacency.shape)
+    capped.sort_indices()
+    return capped
+
+
+def _stack(variables, other_variables):
+    stacked = np.empty((len(variables), 2), dtype=np.result_type(variables, other_variables))
+    stacked[:, 0] = variables
+    stacked[:, 1] = other_variables
+    return stacked
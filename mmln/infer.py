@@ -1,11 +1,22 @@
+import collections
 import logging
 import math
+import multiprocessing
+import multiprocessing.shared_memory
+import os
+import struct
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.sparse.linalg
 
 
 class Inference:
 
     def __init__(self):
-        pass
+        # If a mmln.Profiler is set, solvers record the residuals and time of each iteration with it
+        self.profiler = None
 
     def add_weight(self, weight, coefficients, variables, constant, two_sided=False, squared=False):
         current_weight = self.get_weight(coefficients, variables, constant, two_sided, squared)
@@ -15,6 +26,16 @@ class Inference:
         current_weight = self.get_weight(coefficients, variables, constant, two_sided, squared)
         self.set_weight(current_weight - weight, coefficients, variables, constant, two_sided, squared)
 
+    def add_weights(self, weights, coefficients, variables, constants, two_sided=False, squared=False):
+        # Adds a batch of potentials on the same number of variables. Variables has a row of variables per potential,
+        # and the other arguments are either one value for all potentials, or one value or row per potential. The
+        # result is the same as calling add_weight on each row in order.
+        weights, coefficients, variables, constants, two_sided = _broadcast_batch(weights, coefficients, variables,
+                                                                                  constants, two_sided)
+        for i in range(len(variables)):
+            self.add_weight(float(weights[i]), tuple(coefficients[i].tolist()), tuple(variables[i].tolist()),
+                            float(constants[i]), bool(two_sided[i]), squared)
+
     def set_weight(self, weight, coefficients, variables, constant, two_sided=False, squared=False):
         raise NotImplementedError('This class is abstract.')
 
@@ -24,6 +45,12 @@ class Inference:
     def infer(self):
         raise NotImplementedError('This class is abstract.')
 
+    def new_variables(self, var_ids):
+        return [Variable(var_id) for var_id in var_ids]
+
+    def get_value(self, var):
+        return var.value
+
 
 class Variable:
 
@@ -42,8 +69,9 @@ class Variable:
 
 class HLMRF(Inference):
     
-    def __init__(self, eta=1.0, epsilon_abs=1e-8, epsilon_rel=1e-3, max_iter=25000):
+    def __init__(self, eta=1.0, epsilon_abs=1e-8, epsilon_rel=1e-3, max_iter=25000, profiler=None):
         super(HLMRF, self).__init__()
+        self.profiler = profiler
         self.eta = eta
         self.epsilon_abs = epsilon_abs
         self.epsilon_rel = epsilon_rel
@@ -54,27 +82,25 @@ class HLMRF(Inference):
         self.pots = {}
         self.vars = set()
         self.needs_init = True
+        self.iterations = 0
 
     def set_weight(self, weight, coefficients, variables, constant, two_sided=False, squared=False):
-        if isinstance(coefficients, (int, float)):
-            coefficients = (coefficients,)
-        if isinstance(variables, Variable):
-            variables = (variables,)
-
-        if not squared:
-            raise NotImplementedError('Only squared potentials are currently supported.')
-        if len(coefficients) != len(variables):
-            raise Exception('Must provide the same number of coefficients and variables.')
+        key = _make_key(coefficients, variables, constant, two_sided, squared)
         if weight < 0:
             raise Exception('Only non-negative weights are allowed.')
+        coefficients, variables = key[0], key[1]
 
         for var in variables:
-            self.vars.add(var)
+            if var not in self.vars:
+                self.vars.add(var)
+                if not self.needs_init:
+                    self.var_locations[var] = set()
 
-        key = (coefficients, variables, constant, two_sided, squared)
         if weight == 0:
-            del self.pots[key]
-            self.needs_init = True
+            pot = self.pots.pop(key)
+            if not self.needs_init:
+                for var in pot.get_vars():
+                    self.var_locations[var].discard(pot)
         elif key not in self.pots:
             if len(variables) == 1:
                 if two_sided:
@@ -90,21 +116,14 @@ class HLMRF(Inference):
                                                                coefficients[1], variables[1], constant)
             else:
                 raise Exception('Only potentials on one or two variables are supported.')
+            if not self.needs_init:
+                for var in self.pots[key].get_vars():
+                    self.var_locations[var].add(self.pots[key])
         else:
             self.pots[key].weight = weight
 
     def get_weight(self, coefficients, variables, constant, two_sided=False, squared=False):
-        if isinstance(coefficients, (int, float)):
-            coefficients = (coefficients,)
-        if isinstance(variables, Variable):
-            variables = (variables,)
-
-        if not squared:
-            raise NotImplementedError('Only squared potentials are currently supported.')
-        if len(coefficients) != len(variables):
-            raise Exception('Must provide the same number of coefficients and variables.')
-
-        key = (coefficients, variables, constant, two_sided, squared)
+        key = _make_key(coefficients, variables, constant, two_sided, squared)
         return self.pots[key].weight if key in self.pots else 0
 
     def infer(self):
@@ -119,6 +138,8 @@ class HLMRF(Inference):
         epsilon_primal = 0
         epsilon_dual = 0
         epsilon_abs_term = math.sqrt(len(self.vars)) * self.epsilon_abs
+        if self.profiler is not None:
+            self.profiler.start_iterations('HLMRF')
         
         iteration = 0
         while (primal_res > epsilon_primal or dual_res > epsilon_dual) and iteration < self.max_iter:
@@ -135,6 +156,8 @@ class HLMRF(Inference):
             
             # Updates variables, and computes dual residual and bz_norm
             for var in self.vars:
+                if len(self.var_locations[var]) == 0:
+                    continue
                 total = 0.0
                 for pot in self.var_locations[var]:
                     total += pot.get_total(var)
@@ -158,6 +181,9 @@ class HLMRF(Inference):
             epsilon_dual = epsilon_abs_term + self.epsilon_rel * math.sqrt(ay_norm)
             
             iteration += 1
+            if self.profiler is not None:
+                self.profiler.record_iteration(iteration, primal_res=primal_res, dual_res=dual_res,
+                                               epsilon_primal=epsilon_primal, epsilon_dual=epsilon_dual)
 
             if iteration % 25 == 0:
                 self.logger.debug('Completed ' + str(iteration) + ' iterations.')
@@ -166,6 +192,7 @@ class HLMRF(Inference):
                 self.logger.debug('Epsilon Primal:\t' + "{:0.5}".format(epsilon_primal) + '  \t\tEpsilon Dual:\t' +
                                   "{:0.5}".format(epsilon_dual))
 
+        self.iterations = iteration
         self.logger.info('Finished optimization in ' + str(iteration) + ' iterations.')
         self.logger.info('Primal residual: ' + "{:0.4}".format(primal_res) +
                          '   Dual residual: ' + "{:0.4}".format(dual_res))
@@ -183,6 +210,1335 @@ class HLMRF(Inference):
         self.needs_init = False
 
 
+class _ArrayInference(Inference):
+
+    def __init__(self, state_arrays=()):
+        super(_ArrayInference, self).__init__()
+        self.logger = logging.getLogger(__name__)
+
+        # Variables are dense indices into values. Callers can use them directly, via new_variables, or use Variable
+        # objects, which are mapped to indices by var_indices.
+        self.n_vars = 0
+        self.var_indices = {}
+        self.values = np.zeros(16)
+        self.counts = np.zeros(16)
+        self.iterations = 0
+
+        # Arrays are allocated with spare capacity, so that potentials and variables can be added in place. Each
+        # potential is a row with two variable slots. Potentials on one variable leave the second slot empty, i.e.,
+        # index -1 and coefficient 0, and two_vars masks it out. Subclasses can keep per-potential state in
+        # additional float arrays, which are initialized by _init_state. Rows are looked up by a hash index over
+        # their columns.
+        self.n_pots = 0
+        self.arrays = dict((name, np.zeros(16, dtype=dtype)) for name, dtype in _POTENTIAL_ARRAYS)
+        for name in state_arrays:
+            self.arrays[name] = np.zeros(16)
+        self.index = _PotentialIndex()
+
+    def new_variables(self, var_ids):
+        start = self.n_vars
+        self._reserve_vars(start + len(var_ids))
+        return range(start, self.n_vars)
+
+    def get_value(self, var):
+        return var.value if isinstance(var, Variable) else float(self.values[var])
+
+    def add_weight(self, weight, coefficients, variables, constant, two_sided=False, squared=False):
+        self._update_weight(weight, True, coefficients, variables, constant, two_sided, squared)
+
+    def set_weight(self, weight, coefficients, variables, constant, two_sided=False, squared=False):
+        self._update_weight(weight, False, coefficients, variables, constant, two_sided, squared)
+
+    def get_weight(self, coefficients, variables, constant, two_sided=False, squared=False):
+        coefficients, variables, constant, two_sided, squared = _make_key(coefficients, variables, constant,
+                                                                          two_sided, squared)
+        if any(isinstance(var, Variable) and var not in self.var_indices for var in variables):
+            return 0
+        row, h = self._find_pot(coefficients, [self._get_var_index(var) for var in variables], constant, two_sided)
+        return float(self.arrays['weight'][row]) if row >= 0 else 0
+
+    def add_weights(self, weights, coefficients, variables, constants, two_sided=False, squared=False):
+        weights, coefficients, variables, constants, two_sided = _broadcast_batch(weights, coefficients, variables,
+                                                                                  constants, two_sided)
+        if not squared:
+            raise NotImplementedError('Only squared potentials are currently supported.')
+        if variables.shape[1] > 2:
+            raise Exception('Only potentials on one or two variables are supported.')
+        if len(variables) == 0:
+            return
+
+        if variables.dtype == object:
+            var_indices = np.array([[self._get_var_index(var) for var in row] for row in variables], dtype=np.int64)
+        else:
+            var_indices = variables.astype(np.int64)
+            if ((var_indices < 0) | (var_indices >= self.n_vars)).any():
+                raise Exception('Unknown variable index in batch.')
+
+        # Builds the rows, leaving the second slot empty for potentials on one variable
+        pots = {'var1': var_indices[:, 0], 'coeff1': coefficients[:, 0] + 0.0, 'const': constants + 0.0,
+                'bowl': two_sided.astype(bool)}
+        if variables.shape[1] == 2:
+            pots['var2'] = var_indices[:, 1]
+            pots['coeff2'] = coefficients[:, 1] + 0.0
+        else:
+            pots['var2'] = np.full(len(variables), -1, dtype=np.int64)
+            pots['coeff2'] = np.zeros(len(variables))
+
+        # Sums the weights of repeated potentials, keeping the order of their first occurrences
+        hashes = _hash_potentials(pots['var1'], pots['var2'], pots['coeff1'], pots['coeff2'], pots['const'],
+                                  pots['bowl'])
+        first, inverse = _find_repeats(pots, hashes)
+        order = np.argsort(first)
+        rank = np.empty(len(order), dtype=np.intp)
+        rank[order] = np.arange(len(order))
+        totals = np.bincount(rank[inverse], weights)
+        pots = dict((name, column[first[order]]) for name, column in pots.items())
+        hashes = hashes[first[order]]
+        arrays = self.arrays
+
+        def matches(rows, which):
+            return (arrays['var1'][rows] == pots['var1'][which]) & (arrays['var2'][rows] == pots['var2'][which]) & \
+                (arrays['coeff1'][rows] == pots['coeff1'][which]) & \
+                (arrays['coeff2'][rows] == pots['coeff2'][which]) & \
+                (arrays['const'][rows] == pots['const'][which]) & (arrays['bowl'][rows] == pots['bowl'][which])
+
+        rows = self.index.find_all(hashes, matches)
+        existing = rows >= 0
+        totals[existing] += arrays['weight'][rows[existing]]
+        if (totals < 0).any():
+            raise Exception('Only non-negative weights are allowed.')
+
+        arrays['weight'][rows[existing]] = totals[existing]
+        added = ~existing & (totals > 0)
+        self._add_pots(totals[added], dict((name, column[added]) for name, column in pots.items()), hashes[added])
+
+        # Removes rows from last to first, so that the rows still to remove are not moved
+        for row in np.sort(rows[existing & (totals == 0)])[::-1]:
+            self._remove_pot(int(row))
+
+    def get_potentials(self):
+        arrays = self._get_arrays()
+        return dict((name, arrays[name].copy()) for name in ('weight', 'coeff1', 'coeff2', 'const', 'bowl', 'var1',
+                                                             'var2'))
+
+    def set_potentials(self, potentials):
+        # Adds potentials given as columns, as returned by get_potentials, when there are none yet. Variables are
+        # indices. The potentials must be distinct, so they are added without looking for repeats.
+        if self.n_pots > 0:
+            raise Exception('Potentials can only be set when there are none.')
+        weights = np.asarray(potentials['weight'], dtype=float)
+        pots = {'var1': np.asarray(potentials['var1'], dtype=np.int64),
+                'var2': np.asarray(potentials['var2'], dtype=np.int64),
+                'coeff1': np.asarray(potentials['coeff1'], dtype=float) + 0.0,
+                'coeff2': np.asarray(potentials['coeff2'], dtype=float) + 0.0,
+                'const': np.asarray(potentials['const'], dtype=float) + 0.0,
+                'bowl': np.asarray(potentials['bowl'], dtype=bool)}
+        if (weights <= 0).any():
+            raise Exception('Only positive weights can be set.')
+        if ((pots['var1'] < 0) | (pots['var1'] >= self.n_vars) | (pots['var2'] < -1) |
+                (pots['var2'] >= self.n_vars)).any():
+            raise Exception('Unknown variable index in potentials.')
+        if len(weights) > 0:
+            self._add_pots(weights, pots, _hash_potentials(pots['var1'], pots['var2'], pots['coeff1'], pots['coeff2'],
+                                                           pots['const'], pots['bowl']))
+
+    def _update_weight(self, weight, add, coefficients, variables, constant, two_sided, squared):
+        # Sets or adds to a potential's weight with a single lookup
+        coefficients, variables, constant, two_sided, squared = _make_key(coefficients, variables, constant,
+                                                                          two_sided, squared)
+        if len(variables) > 2:
+            raise Exception('Only potentials on one or two variables are supported.')
+
+        var_indices = [self._get_var_index(var) for var in variables]
+        row, h = self._find_pot(coefficients, var_indices, constant, two_sided)
+        if add and row >= 0:
+            weight += self.arrays['weight'][row]
+        if weight < 0:
+            raise Exception('Only non-negative weights are allowed.')
+
+        if weight == 0:
+            if row < 0:
+                if add:
+                    return
+                raise KeyError('No potential to remove.')
+            self._remove_pot(row)
+        elif row < 0:
+            self._add_pot(weight, coefficients, var_indices, constant, two_sided, h)
+        else:
+            self.arrays['weight'][row] = weight
+
+    def _get_arrays(self):
+        return dict((name, array[:self.n_pots]) for name, array in self.arrays.items())
+
+    def _get_values(self):
+        for var, index in self.var_indices.items():
+            self.values[index] = var.value
+        return self.values[:self.n_vars].copy()
+
+    def _set_values(self, values):
+        self.values[:self.n_vars] = values
+        for var, index in self.var_indices.items():
+            var.value = float(values[index])
+
+    def _get_var_index(self, var):
+        if isinstance(var, Variable):
+            if var not in self.var_indices:
+                self.var_indices[var] = self.n_vars
+                self._reserve_vars(self.n_vars + 1)
+            index = self.var_indices[var]
+            self.values[index] = var.value
+            return index
+        elif 0 <= var < self.n_vars:
+            return int(var)
+        else:
+            raise Exception('Unknown variable index: ' + str(var))
+
+    def _reserve_vars(self, n_vars):
+        if n_vars > len(self.values):
+            self.values = _grow(self.values, n_vars)
+            self.counts = _grow(self.counts, n_vars)
+        self.n_vars = n_vars
+
+    def _find_pot(self, coefficients, var_indices, constant, two_sided):
+        var2 = var_indices[1] if len(var_indices) == 2 else -1
+        coeff2 = coefficients[1] if len(var_indices) == 2 else 0.0
+        arrays = self.arrays
+
+        def matches(row):
+            return arrays['var1'][row] == var_indices[0] and arrays['var2'][row] == var2 and \
+                arrays['coeff1'][row] == coefficients[0] and arrays['coeff2'][row] == coeff2 and \
+                arrays['const'][row] == constant and arrays['bowl'][row] == two_sided
+
+        h = _hash_potential(var_indices[0], var2, coefficients[0], coeff2, constant, two_sided)
+        return self.index.find(h, matches), h
+
+    def _add_pot(self, weight, coefficients, var_indices, constant, two_sided, h):
+        row = self.n_pots
+        if row == len(self.arrays['weight']):
+            for name in self.arrays:
+                self.arrays[name] = _grow(self.arrays[name], row + 1)
+        self.n_pots += 1
+
+        arrays = self.arrays
+        arrays['weight'][row] = weight
+        arrays['coeff1'][row] = coefficients[0]
+        arrays['var1'][row] = var_indices[0]
+        if len(var_indices) == 2:
+            arrays['coeff2'][row] = coefficients[1]
+            arrays['var2'][row] = var_indices[1]
+            arrays['var2_safe'][row] = var_indices[1]
+            arrays['two_vars'][row] = 1.0
+        else:
+            arrays['coeff2'][row] = 0.0
+            arrays['var2'][row] = -1
+            arrays['var2_safe'][row] = 0
+            arrays['two_vars'][row] = 0.0
+        arrays['const'][row] = constant
+        arrays['bowl'][row] = two_sided
+        self._init_state(row)
+
+        self.index.add(row, h)
+        for index in var_indices:
+            self.counts[index] += 1
+
+    def _add_pots(self, weights, pots, hashes):
+        rows = np.arange(self.n_pots, self.n_pots + len(weights))
+        if self.n_pots + len(weights) > len(self.arrays['weight']):
+            for name in self.arrays:
+                self.arrays[name] = _grow(self.arrays[name], self.n_pots + len(weights))
+        self.n_pots += len(weights)
+
+        arrays = self.arrays
+        arrays['weight'][rows] = weights
+        for name in ('coeff1', 'coeff2', 'const', 'bowl', 'var1', 'var2'):
+            arrays[name][rows] = pots[name]
+        two_vars = pots['var2'] >= 0
+        arrays['var2_safe'][rows] = np.where(two_vars, pots['var2'], 0)
+        arrays['two_vars'][rows] = two_vars
+        self._init_state(rows)
+
+        self.index.add_all(rows, hashes)
+        self.counts[:self.n_vars] += np.bincount(pots['var1'], minlength=self.n_vars) + \
+            np.bincount(pots['var2'][two_vars], minlength=self.n_vars)
+
+    def _init_state(self, row):
+        # Initializes the state of a row, or of an array of rows
+        pass
+
+    def _remove_pot(self, row):
+        self.counts[self.arrays['var1'][row]] -= 1
+        if self.arrays['two_vars'][row]:
+            self.counts[self.arrays['var2'][row]] -= 1
+
+        # Moves the last row into the removed one to keep the arrays dense
+        last = self.n_pots - 1
+        self.index.remove(row, last)
+        if row != last:
+            for array in self.arrays.values():
+                array[row] = array[last]
+        self.n_pots -= 1
+
+
+class _PotentialIndex:
+
+    # Hash index from potentials to rows using open addressing with linear probing. Slots hold a row, -1 if empty, or
+    # -2 if the row was removed. Each row's hash is kept, so that rows can be moved and the table resized without
+    # reading the potential arrays. The home slot of a hash is given by its high bits.
+
+    def __init__(self):
+        self.slots = np.full(32, -1, dtype=np.int64)
+        self.hashes = np.zeros(16, dtype=np.uint64)
+        self.n_rows = 0
+        self.n_filled = 0
+        self.shift = 64 - 5
+
+    def find(self, h, matches):
+        mask = len(self.slots) - 1
+        i = h >> self.shift
+        while True:
+            row = self.slots[i]
+            if row == -1:
+                return -1
+            elif row >= 0 and self.hashes[row] == h and matches(row):
+                return int(row)
+            i = (i + 1) & mask
+
+    def find_all(self, hashes, matches):
+        # Looks up many hashes at once. matches(rows, which) tells which of the rows hold the potentials at positions
+        # which of the batch.
+        mask = len(self.slots) - 1
+        found = np.full(len(hashes), -1, dtype=np.int64)
+        which = np.arange(len(hashes))
+        positions = (hashes >> np.uint64(self.shift)).astype(np.int64)
+        while len(which) > 0:
+            rows = self.slots[positions]
+            candidates = np.flatnonzero(rows >= 0)
+            candidates = candidates[self.hashes[rows[candidates]] == hashes[which[candidates]]]
+            hits = candidates[matches(rows[candidates], which[candidates])]
+            found[which[hits]] = rows[hits]
+
+            probing = rows != -1
+            probing[hits] = False
+            which = which[probing]
+            positions = (positions[probing] + 1) & mask
+        return found
+
+    def add_all(self, rows, hashes):
+        if 2 * (self.n_filled + len(rows)) > len(self.slots):
+            self._resize(self.n_rows + len(rows))
+        if len(rows) > 0 and rows[-1] >= len(self.hashes):
+            self.hashes = _grow(self.hashes, rows[-1] + 1)
+        self.hashes[rows] = hashes
+        self.n_rows += len(rows)
+        self.n_filled += len(rows)
+        _place_rows(self.slots, rows, hashes >> np.uint64(self.shift))
+
+    def add(self, row, h):
+        if 2 * (self.n_filled + 1) > len(self.slots):
+            self._resize(self.n_rows + 1)
+        if row >= len(self.hashes):
+            self.hashes = _grow(self.hashes, row + 1)
+        self.hashes[row] = h
+        self.n_rows += 1
+
+        mask = len(self.slots) - 1
+        i = h >> self.shift
+        while self.slots[i] >= 0:
+            i = (i + 1) & mask
+        if self.slots[i] == -1:
+            self.n_filled += 1
+        self.slots[i] = row
+
+    def remove(self, row, last):
+        # Removes row, and renumbers last as row
+        self.slots[self._get_slot(row)] = -2
+        if row != last:
+            self.slots[self._get_slot(last)] = row
+            self.hashes[row] = self.hashes[last]
+        self.n_rows -= 1
+
+    def _get_slot(self, row):
+        mask = len(self.slots) - 1
+        i = int(self.hashes[row]) >> self.shift
+        while self.slots[i] != row:
+            i = (i + 1) & mask
+        return i
+
+    def _resize(self, n_rows):
+        bits = max(5, int(math.ceil(math.log2(4 * n_rows))))
+        self.slots = np.full(2 ** bits, -1, dtype=np.int64)
+        self.shift = 64 - bits
+        self.n_filled = self.n_rows
+        _place_rows(self.slots, np.arange(self.n_rows), self.hashes[:self.n_rows] >> np.uint64(self.shift))
+
+    def rebuild(self, hashes):
+        # Indexes rows 0, ..., len(hashes) - 1 at once
+        self.hashes = hashes
+        self.n_rows = len(hashes)
+        self._resize(self.n_rows)
+
+
+def _place_rows(slots, rows, homes):
+    # Inserts rows into a linear probing table in rounds. In each round, every row not yet placed tries the next slot
+    # in its probe sequence, and of the rows that try the same empty slot, the first one gets it.
+    mask = len(slots) - 1
+    positions = homes.astype(np.int64)
+    while len(rows) > 0:
+        empty = slots[positions] == -1
+        candidates = np.flatnonzero(empty)
+        winners = candidates[np.unique(positions[candidates], return_index=True)[1]]
+        slots[positions[winners]] = rows[winners]
+        placed = np.zeros(len(rows), dtype=bool)
+        placed[winners] = True
+        rows = rows[~placed]
+        positions = (positions[~placed] + 1) & mask
+
+
+_HASH_MULTIPLIERS = (0x9e3779b97f4a7c15, 0xc2b2ae3d27d4eb4f, 0x165667b19e3779f9, 0x27d4eb2f165667c5,
+                     0xff51afd7ed558ccd, 0xc4ceb9fe1a85ec53)
+_HASH_MASK = 2 ** 64 - 1
+
+
+def _hash_potential(var1, var2, coeff1, coeff2, const, bowl):
+    # Folds the high half of each column into its low half, multiplies it by an odd constant, sums modulo 2^64 and
+    # mixes the result. Without folding, flipping the sign bits of two columns, e.g., negating a coefficient and the
+    # constant, would not change the hash. Coefficients and constants are hashed by their bits, after adding 0.0 so
+    # that -0.0 and 0.0 hash alike. _hash_potentials computes the same hash for arrays.
+    bits = struct.unpack('<3Q', struct.pack('<3d', float(coeff1) + 0.0, float(coeff2) + 0.0, float(const) + 0.0))
+    h = int(bool(bowl))
+    for column, multiplier in zip((int(var1) & _HASH_MASK, int(var2) & _HASH_MASK) + bits, _HASH_MULTIPLIERS):
+        h += (column ^ (column >> 32)) * multiplier
+    h &= _HASH_MASK
+    h ^= h >> 29
+    h = (h * _HASH_MULTIPLIERS[5]) & _HASH_MASK
+    return h ^ (h >> 32)
+
+
+def _hash_potentials(var1, var2, coeff1, coeff2, const, bowl):
+    columns = (np.asarray(var1, dtype=np.int64).view(np.uint64), np.asarray(var2, dtype=np.int64).view(np.uint64),
+               (np.asarray(coeff1, dtype=float) + 0.0).view(np.uint64),
+               (np.asarray(coeff2, dtype=float) + 0.0).view(np.uint64),
+               (np.asarray(const, dtype=float) + 0.0).view(np.uint64))
+    h = np.asarray(bowl, dtype=np.uint64).copy()
+    for column, multiplier in zip(columns, _HASH_MULTIPLIERS):
+        h += (column ^ (column >> np.uint64(32))) * np.uint64(multiplier)
+    h ^= h >> np.uint64(29)
+    h *= np.uint64(_HASH_MULTIPLIERS[5])
+    return h ^ (h >> np.uint64(32))
+
+
+class VectorizedHLMRF(_ArrayInference):
+
+    def __init__(self, eta=1.0, epsilon_abs=1e-8, epsilon_rel=1e-3, max_iter=25000, n_jobs=1, by_component=False,
+                 adaptive_eta=False, eta_ratio=10.0, eta_factor=2.0, relaxation=1.0, merge_potentials=False,
+                 checkpoint_path=None, checkpoint_every=1000, profiler=None):
+        super(VectorizedHLMRF, self).__init__(_STATE_ARRAYS)
+        self.profiler = profiler
+        self.eta = eta
+        self.epsilon_abs = epsilon_abs
+        self.epsilon_rel = epsilon_rel
+        self.max_iter = max_iter
+        self.n_jobs = n_jobs
+        self.by_component = by_component
+
+        # If merge_potentials is set, potentials are canonicalized and potentials with the same scope are merged
+        # before each optimization. See _merge_potentials.
+        self.merge_potentials = merge_potentials
+        self.merged_arrays = None
+
+        # If adaptive_eta is set, eta is multiplied or divided by eta_factor whenever the primal or dual residual is
+        # more than eta_ratio times the other. The relaxation parameter is the over-relaxation factor, typically in
+        # [1.5, 1.8]. A value of 1 means no relaxation.
+        self.adaptive_eta = adaptive_eta
+        self.eta_ratio = eta_ratio
+        self.eta_factor = eta_factor
+        self.relaxation = relaxation
+
+        # If checkpoint_path is set, the optimizer state is saved there every checkpoint_every iterations. A run can
+        # be resumed by calling load_checkpoint before infer, which restores the potentials as well, so the model does
+        # not need to be grounded again.
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.resumed = None
+
+        self.history = []
+
+    def infer(self):
+        self.logger.info('Starting optimization with ' + str(self.n_vars) + ' variables and ' +
+                         str(self.n_pots) + ' potentials.')
+
+        z = self._get_values()
+        if self.merge_potentials:
+            arrays = self._get_merged_arrays(z)
+            counts = np.bincount(arrays['var1'], minlength=self.n_vars) + \
+                np.bincount(arrays['var2_safe'], arrays['two_vars'], self.n_vars)
+        else:
+            arrays = self._get_arrays()
+            counts = self.counts[:self.n_vars]
+
+        if self.by_component:
+            if self.checkpoint_path is not None or self.resumed is not None:
+                raise Exception('Checkpoints are not supported when solving by component.')
+            z = self._run_admm_by_component(arrays, z, counts)
+        else:
+            if self.n_jobs > 1 and len(arrays['weight']) > 0:
+                block = _SharedPotentialBlock(arrays, self.n_vars, self.n_jobs)
+            else:
+                block = _PotentialBlock(arrays)
+
+            try:
+                z = self._run_admm(block, z, counts)
+            finally:
+                block.close()
+
+        self._set_values(z)
+
+    def _get_merged_arrays(self, z):
+        merged = _merge_potentials(self._get_arrays())
+        self.logger.info('Merged ' + str(self.n_pots) + ' potentials into ' + str(len(merged['weight'])) + '.')
+
+        # Keeps the ADMM state of the previous merged potentials if they have the same structure
+        previous = self.merged_arrays
+        if previous is not None and all(np.array_equal(previous[name], merged[name])
+                                        for name in ('var1', 'var2', 'coeff1', 'coeff2', 'bowl')):
+            for name in _STATE_ARRAYS:
+                merged[name] = previous[name]
+        else:
+            _init_state(merged, z)
+
+        self.merged_arrays = merged
+        return merged
+
+    def _run_admm(self, block, z, counts):
+        has_locations = counts > 0
+
+        # Sets up
+        primal_res = float('inf')
+        dual_res = float('inf')
+        epsilon_primal = 0
+        epsilon_dual = 0
+        epsilon_abs_term = math.sqrt(self.n_vars) * self.epsilon_abs
+        eta = self.eta
+        self.history = []
+        iteration = 0
+
+        # Continues from a loaded checkpoint
+        if self.resumed is not None:
+            iteration, self.history, eta = self.resumed
+            self.resumed = None
+        if self.profiler is not None:
+            self.profiler.start_iterations('VectorizedHLMRF')
+
+        while (primal_res > epsilon_primal or dual_res > epsilon_dual) and iteration < self.max_iter:
+            # Updates Lagrange multipliers and local copies
+            totals, ax_norm, ay_norm = block.update(z, eta, self.relaxation)
+
+            # Updates variables, and computes dual residual and bz_norm
+            new_z = np.where(has_locations, totals / np.maximum(counts, 1), z)
+            np.clip(new_z, 0, 1, out=new_z)
+            dual_res = np.dot(counts, (z - new_z) ** 2)
+            bz_norm = np.dot(counts, new_z ** 2)
+            z = new_z
+
+            # Computes primal residual
+            primal_res = block.get_primal_res(z)
+
+            # Finalizes quantities for stopping criteria
+            primal_res = math.sqrt(primal_res)
+            dual_res = eta * math.sqrt(dual_res)
+            epsilon_primal = epsilon_abs_term + self.epsilon_rel * max(math.sqrt(ax_norm), math.sqrt(bz_norm))
+            epsilon_dual = epsilon_abs_term + self.epsilon_rel * math.sqrt(ay_norm)
+            self.history.append((primal_res, dual_res, eta))
+
+            if self.adaptive_eta:
+                new_eta = float(_balance_eta(eta, primal_res, dual_res, self.eta_ratio, self.eta_factor))
+                if new_eta != eta:
+                    block.update_multipliers(z, eta)
+                    eta = new_eta
+
+            iteration += 1
+            if self.profiler is not None:
+                self.profiler.record_iteration(iteration, primal_res=primal_res, dual_res=dual_res,
+                                               epsilon_primal=epsilon_primal, epsilon_dual=epsilon_dual,
+                                               eta=self.history[-1][2])
+
+            if self.checkpoint_path is not None and iteration % self.checkpoint_every == 0:
+                self._save_checkpoint(block, z, iteration, eta)
+
+            if iteration % 25 == 0:
+                self.logger.debug('Completed ' + str(iteration) + ' iterations.')
+                self.logger.debug('Primal Residual:\t' + "{:0.5}".format(primal_res) + '  \t\tDual Residual:\t' +
+                                  "{:0.5}".format(dual_res))
+                self.logger.debug('Epsilon Primal:\t' + "{:0.5}".format(epsilon_primal) + '  \t\tEpsilon Dual:\t' +
+                                  "{:0.5}".format(epsilon_dual))
+
+        # The next run starts with the initial eta, so the deferred multiplier update is applied with the last one
+        if eta != self.eta:
+            block.update_multipliers(z, eta)
+
+        self.iterations = iteration
+        self.logger.info('Finished optimization in ' + str(iteration) + ' iterations.')
+        self.logger.info('Primal residual: ' + "{:0.4}".format(primal_res) +
+                         '   Dual residual: ' + "{:0.4}".format(dual_res))
+        return z
+
+    def _save_checkpoint(self, block, z, iteration, eta):
+        contents = {'values': z, 'iteration': iteration, 'eta': eta, 'merged': self.merge_potentials,
+                    'history': np.array(self.history, dtype=float).reshape(-1, 3)}
+        for name, array in self._get_arrays().items():
+            if name not in _STATE_ARRAYS:
+                contents['pot_' + name] = array
+
+        # The state of merged potentials is saved with the merged potentials. Otherwise, the rows are the same.
+        for name, array in block.get_arrays().items():
+            if self.merge_potentials or name in _STATE_ARRAYS:
+                contents['solve_' + name] = array
+
+        # Writes to a temporary file first, so that an interrupted write does not destroy the last checkpoint
+        temp_path = self.checkpoint_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            np.savez(f, **contents)
+        os.replace(temp_path, self.checkpoint_path)
+        self.logger.debug('Saved checkpoint at iteration ' + str(iteration) + '.')
+
+    def load_checkpoint(self, path):
+        with np.load(path) as checkpoint:
+            values = checkpoint['values']
+            if self.n_vars not in (0, len(values)):
+                raise Exception('Checkpoint has ' + str(len(values)) + ' variables, but ' + str(self.n_vars) +
+                                ' were created.')
+            self._reserve_vars(len(values))
+            self._set_values(values)
+
+            # Replaces the potentials and rebuilds the index and counts
+            self.n_pots = len(checkpoint['pot_weight'])
+            self.arrays = dict((name, checkpoint['pot_' + name].astype(dtype)) for name, dtype in _POTENTIAL_ARRAYS)
+            arrays = self.arrays
+            merged = bool(checkpoint['merged'])
+            if merged:
+                arrays['local_copy1'] = values[arrays['var1']]
+                arrays['local_copy2'] = values[arrays['var2']] * arrays['two_vars']
+                arrays['lagrange1'] = np.zeros(self.n_pots)
+                arrays['lagrange2'] = np.zeros(self.n_pots)
+                self.merged_arrays = dict((name[len('solve_'):], checkpoint[name]) for name in checkpoint.files
+                                          if name.startswith('solve_'))
+            else:
+                for name in _STATE_ARRAYS:
+                    arrays[name] = checkpoint['solve_' + name].copy()
+                self.merged_arrays = None
+
+            self.index = _PotentialIndex()
+            self.index.rebuild(_hash_potentials(arrays['var1'], arrays['var2'], arrays['coeff1'], arrays['coeff2'],
+                                                arrays['const'], arrays['bowl']))
+            self.counts[:self.n_vars] = np.bincount(arrays['var1'], minlength=self.n_vars) + \
+                np.bincount(arrays['var2_safe'], arrays['two_vars'], self.n_vars)
+
+            self.resumed = (int(checkpoint['iteration']), [tuple(row) for row in checkpoint['history']],
+                            float(checkpoint['eta']))
+
+        self.logger.info('Loaded checkpoint at iteration ' + str(self.resumed[0]) + ' with ' + str(self.n_pots) +
+                         ' potentials.')
+
+    def infer_batch(self, weights):
+        # Solves the potentials once for each column of weights, which has a row for each potential in the order of
+        # get_potentials. Returns the values with a column for each configuration. The potentials' own weights, their
+        # ADMM state, and the values are left unchanged. If merge_potentials is set, each configuration's potentials
+        # are merged with its weights.
+        weights = np.asarray(weights, dtype=float)
+        if weights.ndim != 2 or weights.shape[0] != self.n_pots:
+            raise Exception('Weights must have one row per potential.')
+        if (weights < 0).any():
+            raise Exception('Only non-negative weights are allowed.')
+        n_configs = weights.shape[1]
+        self.logger.info('Starting batch optimization of ' + str(n_configs) + ' configurations with ' +
+                         str(self.n_vars) + ' variables and ' + str(self.n_pots) + ' potentials.')
+
+        # Solves the configurations in batches small enough for the arrays to stay in cache
+        z = self._get_values()
+        arrays = self._get_arrays()
+        batch_size = max(1, _BATCH_ROWS // max(self.n_pots, 1))
+        values = np.empty((self.n_vars, n_configs))
+        iterations = 0
+        history = []
+        for start in range(0, n_configs, batch_size):
+            values[:, start:start + batch_size] = self._run_admm_batch(arrays, z, weights[:, start:start + batch_size])
+            iterations = max(iterations, self.iterations)
+            history = _merge_histories(history, self.history)
+
+        self.iterations = iterations
+        self.history = history
+        return values
+
+    def _run_admm_batch(self, arrays, z, weights):
+        # Lays out the configurations as disjoint copies of the potentials and variables, i.e., as 2-D arrays with a
+        # column per configuration, flattened. Each configuration then has its own stopping test, as a component does.
+        # Keeping a potential's or variable's copies next to each other keeps the gathers and scatters local.
+        n_configs = weights.shape[1]
+        if self.merge_potentials:
+            batch = self._get_merged_batch(arrays, z, weights)
+        else:
+            batch = dict((name, np.repeat(array, n_configs)) for name, array in arrays.items())
+            batch['weight'] = weights.ravel()
+            batch['config'] = np.tile(np.arange(n_configs, dtype=np.intp), self.n_pots)
+        configs = batch.pop('config')
+        batch['var1'] = batch['var1'] * n_configs + configs
+        batch['var2_safe'] = batch['var2_safe'] * n_configs + configs
+        batch['var2'] = np.where(batch['var2'] >= 0, batch['var2_safe'], -1)
+
+        # Drops the potentials a configuration weights by zero, so each one is solved as it would be alone, with
+        # consensus counts and residuals over only its own potentials
+        kept = np.flatnonzero(batch['weight'] > 0)
+        if len(kept) < len(batch['weight']):
+            batch = dict((name, array[kept]) for name, array in batch.items())
+        batch_z = np.repeat(z, n_configs)
+        counts = np.bincount(batch['var1'], minlength=len(batch_z)) + \
+            np.bincount(batch['var2_safe'], batch['two_vars'], len(batch_z))
+
+        var_configs = None if self.by_component else np.tile(np.arange(n_configs), self.n_vars)
+        batch_z = self._run_admm_by_component(batch, batch_z, counts, var_configs)
+        return batch_z.reshape(self.n_vars, n_configs)
+
+    def _get_merged_batch(self, arrays, z, weights):
+        # Merges the potentials separately for each configuration, since which potentials are kept, split, and summed
+        # depends on the weights, and orders the merged potentials by variable, as the unmerged batch is
+        parts = []
+        for config in range(weights.shape[1]):
+            part = _merge_potentials(dict(arrays, weight=weights[:, config]))
+            _init_state(part, z)
+            part['config'] = np.full(len(part['weight']), config, dtype=np.intp)
+            parts.append(part)
+        batch = dict((name, np.concatenate([part[name] for part in parts])) for name in parts[0])
+        order = np.lexsort((batch['config'], batch['var1']))
+        return dict((name, array[order]) for name, array in batch.items())
+
+    def _run_admm_by_component(self, arrays, z, counts, var_components=None):
+        # Components can also be given, in which case each one must be a union of connected components
+        if var_components is None:
+            n_components, var_components = scipy.sparse.csgraph.connected_components(
+                scipy.sparse.coo_matrix((arrays['two_vars'], (arrays['var1'], arrays['var2_safe'])),
+                                        shape=(len(z), len(z))), directed=False)
+            self.logger.info('Found ' + str(n_components) + ' connected components.')
+        else:
+            n_components = var_components.max() + 1 if len(var_components) > 0 else 0
+        settings = _ADMMSettings(self.eta, self.epsilon_abs, self.epsilon_rel, self.max_iter, self.adaptive_eta,
+                                 self.eta_ratio, self.eta_factor, self.relaxation)
+
+        if self.n_jobs > 1 and n_components > 1:
+            # Deals the components out to the workers from largest to smallest to balance the potentials
+            pot_components = var_components[arrays['var1']]
+            sizes = np.bincount(pot_components, minlength=n_components)
+            assignments = np.empty(n_components, dtype=np.intp)
+            assignments[np.argsort(-sizes, kind='stable')] = np.arange(n_components) % self.n_jobs
+
+            jobs = []
+            selections = []
+            for i in range(self.n_jobs):
+                rows = np.flatnonzero(assignments[pot_components] == i)
+                var_ids = np.flatnonzero(assignments[var_components] == i)
+                selections.append((rows, var_ids))
+                sub_components = np.unique(var_components[var_ids], return_inverse=True)[1]
+                jobs.append((_select(arrays, rows, var_ids, len(z)), z[var_ids], counts[var_ids],
+                             sub_components, settings))
+
+            with multiprocessing.Pool(self.n_jobs) as pool:
+                results = pool.starmap(_solve_components_job, jobs)
+
+            self.iterations = 0
+            self.history = []
+            for (rows, var_ids), (state, sub_z, iterations, history) in zip(selections, results):
+                for name, array in state.items():
+                    arrays[name][rows] = array
+                z[var_ids] = sub_z
+                self.iterations = max(self.iterations, iterations)
+                self.history = _merge_histories(self.history, history)
+        else:
+            self.iterations, self.history = _solve_components(arrays, z, counts, var_components, settings)
+
+        self.logger.info('Finished optimization in at most ' + str(self.iterations) + ' iterations per component.')
+        return z
+
+    def _init_state(self, row):
+        # Starts the local copies at the variables' current values, as HLMRF does
+        arrays = self.arrays
+        arrays['local_copy1'][row] = self.values[arrays['var1'][row]]
+        arrays['local_copy2'][row] = self.values[arrays['var2'][row]] * arrays['two_vars'][row]
+        arrays['lagrange1'][row] = 0.0
+        arrays['lagrange2'][row] = 0.0
+
+
+class SparseQP(_ArrayInference):
+
+    def __init__(self, tol=1e-8, max_iter=200, cg_tol=1e-10, cg_max_iter=None, profiler=None):
+        super(SparseQP, self).__init__()
+        self.profiler = profiler
+        self.tol = tol
+        self.max_iter = max_iter
+        self.cg_tol = cg_tol
+        self.cg_max_iter = cg_max_iter
+
+        self.history = []
+
+    def infer(self):
+        self.logger.info('Starting optimization with ' + str(self.n_vars) + ' variables and ' +
+                         str(self.n_pots) + ' potentials.')
+
+        # MAP inference is the box-constrained QP min sum_p w_p max(0, (A x + k)_p)^2, where bowl potentials are not
+        # clipped at 0. It is solved with a projected Newton method. Variables at a bound whose gradient points out of
+        # the box are held fixed and a Newton step is taken on the rest, followed by a projected line search.
+        arrays = self._get_arrays()
+        n_pots = self.n_pots
+        rows = np.arange(n_pots)
+        A = scipy.sparse.csr_matrix((np.concatenate((arrays['coeff1'], arrays['coeff2'] * arrays['two_vars'])),
+                                     (np.concatenate((rows, rows)),
+                                      np.concatenate((arrays['var1'], arrays['var2_safe'])))),
+                                    shape=(n_pots, self.n_vars))
+        weight = arrays['weight']
+        const = arrays['const']
+        bowl = arrays['bowl']
+        direct = bool(np.all(bowl))
+
+        x = np.clip(self._get_values(), 0, 1)
+        self.history = []
+        iteration = 0
+        objective = float('nan')
+        projected_gradient = float('nan')
+        if self.profiler is not None:
+            self.profiler.start_iterations('SparseQP')
+        while iteration < self.max_iter:
+            r = A.dot(x) + const
+            active = bowl | (r > 0)
+            wr = weight * r * active
+            objective = np.dot(wr, r)
+            gradient = 2 * A.T.dot(wr)
+
+            projected_gradient = np.max(np.abs(x - np.clip(x - gradient, 0, 1)), initial=0.0)
+            self.history.append((objective, projected_gradient))
+            if self.profiler is not None:
+                self.profiler.record_iteration(iteration, objective=float(objective),
+                                               projected_gradient=float(projected_gradient))
+            if projected_gradient <= self.tol:
+                break
+
+            # Newton step on the variables not held at a bound
+            epsilon = min(projected_gradient, 1e-6)
+            free = ~(((x <= epsilon) & (gradient > 0)) | ((x >= 1 - epsilon) & (gradient < 0)))
+            scaled = scipy.sparse.diags(np.sqrt(2 * weight * active)).dot(A[:, free])
+            hessian = scaled.T.dot(scaled).tocsc()
+            hessian += scipy.sparse.identity(hessian.shape[0], format='csc') * \
+                (1e-12 * max(hessian.diagonal().max(initial=0.0), 1.0))
+            direction = np.zeros(len(x))
+            direction[free] = self._solve(hessian, -gradient[free], direct)
+
+            # Projected backtracking line search with an Armijo condition
+            step = 1.0
+            while step >= 1e-10:
+                new_x = np.clip(x + step * direction, 0, 1)
+                new_r = A.dot(new_x) + const
+                new_objective = np.dot(weight * new_r * (bowl | (new_r > 0)), new_r)
+                if new_objective <= objective + 1e-4 * np.dot(gradient, new_x - x):
+                    break
+                step /= 2
+            else:
+                # No step decreases the objective enough, e.g., because of round-off near the optimum, so x is kept
+                self.logger.info('Line search failed. Stopping.')
+                break
+            x = new_x
+
+            iteration += 1
+
+        self._set_values(x)
+
+        self.iterations = iteration
+        self.logger.info('Finished optimization in ' + str(iteration) + ' iterations.')
+        self.logger.info('Objective: ' + "{:0.6}".format(float(objective)) +
+                         '   Projected gradient: ' + "{:0.4}".format(float(projected_gradient)))
+
+    def _solve(self, hessian, b, direct):
+        if len(b) == 0:
+            return b
+        if direct:
+            return scipy.sparse.linalg.spsolve(hessian, b)
+
+        # Conjugate gradient with a Jacobi preconditioner
+        inverse_diagonal = 1 / hessian.diagonal()
+        preconditioner = scipy.sparse.linalg.LinearOperator(hessian.shape, matvec=lambda v: inverse_diagonal * v)
+        solution, info = _cg(hessian, b, self.cg_tol, self.cg_max_iter, preconditioner)
+        return solution
+
+
+_POTENTIAL_ARRAYS = (('weight', float), ('coeff1', float), ('coeff2', float), ('const', float), ('bowl', bool),
+                     ('var1', np.int32), ('var2', np.int32), ('two_vars', float), ('var2_safe', np.int32))
+
+_ADMMSettings = collections.namedtuple('_ADMMSettings', ('eta', 'epsilon_abs', 'epsilon_rel', 'max_iter',
+                                                       'adaptive_eta', 'eta_ratio', 'eta_factor', 'relaxation'))
+
+_STATE_ARRAYS = ('local_copy1', 'local_copy2', 'lagrange1', 'lagrange2')
+
+# Largest number of potential rows that infer_batch solves at once. Past roughly this size, the per-row cost of an
+# iteration grows as the arrays fall out of cache, so larger batches stop paying off.
+_BATCH_ROWS = 2 ** 15
+
+
+class _PotentialBlock:
+
+    def __init__(self, arrays, start=None, end=None, groups=None, n_groups=None):
+        self.names = list(arrays)
+        for name, array in arrays.items():
+            setattr(self, name, array[start:end])
+
+        # If potentials are grouped, e.g., by connected component, norms and residuals are summed per group
+        self.groups = groups
+        self.n_groups = n_groups
+        self.unrelaxed = None
+
+    def update(self, z, eta, relaxation=1.0):
+        z1 = z[self.var1]
+        z2 = z[self.var2] * self.two_vars
+        self.lagrange1 += eta * (self.local_copy1 - z1)
+        self.lagrange2 += eta * (self.local_copy2 - z2)
+
+        # Minimizer when a hinge is inactive, i.e., the potential contributes nothing
+        x1 = z1 - self.lagrange1 / eta
+        x2 = z2 - self.lagrange2 / eta
+
+        # Minimizer of the quadratic, solved in closed form as in _ADMMTwoVarBowlPotential
+        q1 = eta * z1 - self.lagrange1 - 2 * self.weight * self.coeff1 * self.const
+        q2 = eta * z2 - self.lagrange2 - 2 * self.weight * self.coeff2 * self.const
+        a0 = 2 * self.weight * self.coeff1 ** 2 + eta
+        b1 = 2 * self.weight * self.coeff2 ** 2 + eta
+        a1b0 = 2 * self.weight * self.coeff1 * self.coeff2
+        q2 -= a1b0 * q1 / a0
+        q2 /= b1 - a1b0 * a1b0 / a0
+        q1 -= a1b0 * q2
+        q1 /= a0
+
+        active = self.bowl | (self.coeff1 * x1 + self.coeff2 * x2 + self.const > 0)
+        np.copyto(self.local_copy1, np.where(active, q1, x1))
+        np.copyto(self.local_copy2, np.where(active, q2, x2))
+
+        # Over-relaxation. The relaxed local copies are stored in place of the local copies, since both the consensus
+        # step and the next multiplier update use them, and the next local update does not depend on them. The
+        # unrelaxed copies are kept until the primal residual is computed from them.
+        self.unrelaxed = None
+        if relaxation != 1.0:
+            self.unrelaxed = (self.local_copy1.copy(), self.local_copy2.copy())
+            self.local_copy1 *= relaxation
+            self.local_copy1 += (1 - relaxation) * z1
+            self.local_copy2 *= relaxation
+            self.local_copy2 += (1 - relaxation) * z2
+
+        # Sums each variable's local copies for the consensus step
+        totals = np.bincount(self.var1, self.local_copy1 + self.lagrange1 / eta, len(z))
+        totals += np.bincount(self.var2_safe, self.local_copy2 + self.lagrange2 / eta, len(z))
+
+        ax_norm = self._sum(self.local_copy1 ** 2 + self.local_copy2 ** 2)
+        ay_norm = self._sum(self.lagrange1 ** 2 + self.lagrange2 ** 2)
+        return totals, ax_norm, ay_norm
+
+    def get_primal_res(self, z):
+        local_copy1, local_copy2 = self.unrelaxed or (self.local_copy1, self.local_copy2)
+        return self._sum((z[self.var1] - local_copy1) ** 2 + (z[self.var2] * self.two_vars - local_copy2) ** 2)
+
+    def update_multipliers(self, z, eta):
+        # Applies the deferred multiplier update of the last step now, with the eta the step was taken with. The
+        # local copies are then set to z, so the deferred update of the next step, with a new eta, adds nothing.
+        z1 = z[self.var1]
+        z2 = z[self.var2] * self.two_vars
+        self.lagrange1 += eta * (self.local_copy1 - z1)
+        self.lagrange2 += eta * (self.local_copy2 - z2)
+        np.copyto(self.local_copy1, z1)
+        np.copyto(self.local_copy2, z2)
+
+    def get_arrays(self):
+        return dict((name, getattr(self, name)) for name in self.names)
+
+    def _sum(self, values):
+        if self.groups is None:
+            return np.sum(values)
+        else:
+            return np.bincount(self.groups, values, self.n_groups)
+
+    def close(self):
+        pass
+
+
+class _SharedPotentialBlock:
+
+    def __init__(self, arrays, n_vars, n_jobs):
+        self.arrays = arrays
+        self.n_jobs = min(n_jobs, len(arrays['weight']))
+
+        # Copies the potentials into shared memory, plus the consensus variables and one row of totals per worker
+        shapes = dict((name, (array.shape, array.dtype)) for name, array in arrays.items())
+        shapes['z'] = ((n_vars,), np.dtype(float))
+        shapes['totals'] = ((self.n_jobs, n_vars), np.dtype(float))
+        self.shms, self.shared = _create_shared_arrays(shapes)
+        for name, array in arrays.items():
+            self.shared[name][...] = array
+
+        specs = dict((name, (self.shms[name].name, shape, dtype)) for name, (shape, dtype) in shapes.items())
+        bounds = np.linspace(0, len(arrays['weight']), self.n_jobs + 1).astype(int)
+        self.conns = []
+        self.workers = []
+        for i in range(self.n_jobs):
+            conn, worker_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_admm_worker,
+                                             args=(specs, i, bounds[i], bounds[i + 1], worker_conn), daemon=True)
+            worker.start()
+            self.conns.append(conn)
+            self.workers.append(worker)
+
+    def update(self, z, eta, relaxation=1.0):
+        self.shared['z'][...] = z
+        for conn in self.conns:
+            conn.send(('update', (eta, relaxation)))
+        ax_norm = 0.0
+        ay_norm = 0.0
+        for conn in self.conns:
+            worker_ax_norm, worker_ay_norm = conn.recv()
+            ax_norm += worker_ax_norm
+            ay_norm += worker_ay_norm
+        return self.shared['totals'].sum(axis=0), ax_norm, ay_norm
+
+    def get_primal_res(self, z):
+        self.shared['z'][...] = z
+        for conn in self.conns:
+            conn.send(('primal_res', None))
+        return sum(conn.recv() for conn in self.conns)
+
+    def update_multipliers(self, z, eta):
+        self.shared['z'][...] = z
+        for conn in self.conns:
+            conn.send(('multipliers', eta))
+        for conn in self.conns:
+            conn.recv()
+
+    def get_arrays(self):
+        return dict((name, self.shared[name]) for name in self.arrays)
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(('stop', None))
+            conn.close()
+        for worker in self.workers:
+            worker.join()
+
+        # Keeps the optimizer state in the caller's arrays
+        for name, array in self.arrays.items():
+            array[...] = self.shared[name]
+        self.shared = None
+        for shm in self.shms.values():
+            shm.close()
+            shm.unlink()
+
+
+def _admm_worker(specs, worker_index, start, end, conn):
+    shms, shared = _attach_shared_arrays(specs)
+    z = shared.pop('z')
+    totals = shared.pop('totals')[worker_index]
+    block = _PotentialBlock(shared, start, end)
+
+    while True:
+        command, args = conn.recv()
+        if command == 'update':
+            block_totals, ax_norm, ay_norm = block.update(z, *args)
+            totals[...] = block_totals
+            conn.send((ax_norm, ay_norm))
+        elif command == 'primal_res':
+            conn.send(block.get_primal_res(z))
+        elif command == 'multipliers':
+            block.update_multipliers(z, args)
+            conn.send(None)
+        else:
+            break
+
+    del z, totals, block, shared
+    for shm in shms.values():
+        shm.close()
+
+
+def _create_shared_arrays(shapes):
+    shms = {}
+    arrays = {}
+    for name, (shape, dtype) in shapes.items():
+        shms[name] = multiprocessing.shared_memory.SharedMemory(create=True,
+                                                                size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shms[name].buf)
+    return shms, arrays
+
+
+def _attach_shared_arrays(specs):
+    shms = {}
+    arrays = {}
+    for name, (shm_name, shape, dtype) in specs.items():
+        shms[name] = multiprocessing.shared_memory.SharedMemory(name=shm_name)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shms[name].buf)
+    return shms, arrays
+
+
+def _init_state(arrays, z):
+    # Starts the ADMM state of new potentials from the values z, with zero multipliers
+    arrays['local_copy1'] = z[arrays['var1']]
+    arrays['local_copy2'] = z[arrays['var2']] * arrays['two_vars']
+    arrays['lagrange1'] = np.zeros(len(arrays['weight']))
+    arrays['lagrange2'] = np.zeros(len(arrays['weight']))
+
+
+def _merge_potentials(arrays):
+    # Returns an equivalent set of potentials, i.e., one whose objective differs by a constant on [0, 1]^n, in which
+    #  - hinges that are nonnegative everywhere on the box are bowls, and hinges that are nonpositive are dropped,
+    #    e.g., the hinges of observations of exactly 0 or 1, while those of fractional observations can change sign
+    #    on the box and stay hinges,
+    #  - two-variable potentials list the lower variable index first, and are normalized so that the first coefficient
+    #    is 1, or +/-1 for hinges,
+    #  - hinges with the same form are summed, and a pair of opposite hinges max(0, r)^2 and max(0, -r)^2 is split
+    #    into a bowl with the smaller weight and a hinge with the remainder,
+    #  - bowls with the same variables and coefficients are summed into a single bowl.
+    weight = arrays['weight']
+    coeff1 = arrays['coeff1']
+    coeff2 = arrays['coeff2'] * arrays['two_vars']
+    const = arrays['const']
+    var1 = arrays['var1']
+    var2 = arrays['var2_safe']
+    two_vars = arrays['two_vars'] > 0
+
+    # Bounds each potential's linear form on the box
+    lower = const + np.minimum(coeff1, 0) + np.minimum(coeff2, 0)
+    upper = const + np.maximum(coeff1, 0) + np.maximum(coeff2, 0)
+    bowl = arrays['bowl'] | (lower >= 0)
+    keep = (bowl | (upper > 0)) & (weight > 0)
+
+    # Puts the lower variable index first, and folds potentials that list the same variable twice
+    swap = two_vars & (var2 < var1)
+    var1, var2 = np.where(swap, var2, var1), np.where(swap, var1, var2)
+    coeff1, coeff2 = np.where(swap, coeff2, coeff1), np.where(swap, coeff1, coeff2)
+    same = two_vars & (var1 == var2)
+    coeff1 = np.where(same, coeff1 + coeff2, coeff1)
+    coeff2 = np.where(same, 0.0, coeff2)
+    two_vars = two_vars & ~same
+    var2 = np.where(two_vars, var2, -1)
+
+    # Normalizes the first coefficient
+    keep &= (coeff1 != 0) | (coeff2 != 0)
+    scale = np.where(coeff1 != 0, coeff1, 1.0)
+    scale = np.where(bowl, scale, np.abs(scale))
+    weight = weight * scale ** 2
+    coeff1 = coeff1 / scale
+    coeff2 = coeff2 / scale
+    const = const / scale
+
+    # Sums hinges by form, keeping opposite hinges in the same group
+    hinge = keep & ~bowl
+    sign = np.where(coeff1[hinge] < 0, -1.0, 1.0)
+    groups, group_index = np.unique(np.vstack((var1[hinge], var2[hinge], sign * coeff1[hinge], sign * coeff2[hinge],
+                                               sign * const[hinge])), axis=1, return_inverse=True)
+    group_index = group_index.ravel()
+    positive = np.bincount(group_index, weight[hinge] * (sign > 0), groups.shape[1])
+    negative = np.bincount(group_index, weight[hinge] * (sign < 0), groups.shape[1])
+    shared = np.minimum(positive, negative)
+
+    # Collects bowls, including the bowls split out of opposite hinges
+    bowl_var1 = np.concatenate((var1[keep & bowl], groups[0]))
+    bowl_var2 = np.concatenate((var2[keep & bowl], groups[1]))
+    bowl_coeff1 = np.concatenate((coeff1[keep & bowl], groups[2]))
+    bowl_coeff2 = np.concatenate((coeff2[keep & bowl], groups[3]))
+    bowl_const = np.concatenate((const[keep & bowl], groups[4]))
+    bowl_weight = np.concatenate((weight[keep & bowl], shared))
+
+    # Sums bowls with the same linear part. Their constants combine into a weighted mean.
+    bowl_groups, bowl_index = np.unique(np.vstack((bowl_var1, bowl_var2, bowl_coeff1, bowl_coeff2)), axis=1,
+                                        return_inverse=True)
+    bowl_index = bowl_index.ravel()
+    merged_weight = np.bincount(bowl_index, bowl_weight, bowl_groups.shape[1])
+    merged_const = np.bincount(bowl_index, bowl_weight * bowl_const, bowl_groups.shape[1])
+    merged_const /= np.where(merged_weight > 0, merged_weight, 1)
+    bowl_keep = merged_weight > 0
+
+    # Assembles the hinges with leftover weight and the merged bowls
+    hinge_keep = np.maximum(positive, negative) > shared
+    hinge_sign = np.where(positive > negative, 1.0, -1.0)[hinge_keep]
+    merged = {
+        'weight': np.concatenate(((np.maximum(positive, negative) - shared)[hinge_keep], merged_weight[bowl_keep])),
+        'coeff1': np.concatenate((hinge_sign * groups[2][hinge_keep], bowl_groups[2][bowl_keep])),
+        'coeff2': np.concatenate((hinge_sign * groups[3][hinge_keep], bowl_groups[3][bowl_keep])),
+        'const': np.concatenate((hinge_sign * groups[4][hinge_keep], merged_const[bowl_keep])),
+        'bowl': np.concatenate((np.zeros(hinge_keep.sum(), dtype=bool), np.ones(bowl_keep.sum(), dtype=bool))),
+        'var1': np.concatenate((groups[0][hinge_keep], bowl_groups[0][bowl_keep])).astype(np.intp),
+        'var2': np.concatenate((groups[1][hinge_keep], bowl_groups[1][bowl_keep])).astype(np.intp),
+    }
+    merged['two_vars'] = (merged['var2'] >= 0).astype(float)
+    merged['var2_safe'] = np.where(merged['var2'] >= 0, merged['var2'], 0)
+    return merged
+
+
+def _solve_components(arrays, z, counts, var_components, settings):
+    # Runs ADMM on every connected component at once, with a separate stopping test for each one. Whenever some
+    # components converge, the remaining ones are copied into smaller arrays, so converged components stop costing
+    # anything. Updates arrays and z in place and returns the largest number of iterations used by a component.
+    n_components = var_components.max() + 1 if len(var_components) > 0 else 0
+    pot_components = var_components[arrays['var1']]
+    epsilon_abs_term = np.sqrt(np.bincount(var_components, minlength=n_components)) * settings.epsilon_abs
+    active = np.bincount(pot_components, minlength=n_components) > 0
+    eta = np.full(n_components, float(settings.eta))
+    history = []
+
+    iteration = 0
+    while active.any() and iteration < settings.max_iter:
+        # Sets up the still active components
+        components = np.flatnonzero(active)
+        component_index = np.full(n_components, -1, dtype=np.intp)
+        component_index[components] = np.arange(len(components))
+        rows = np.flatnonzero(active[pot_components])
+        var_ids = np.flatnonzero(active[var_components])
+        sub_arrays = _select(arrays, rows, var_ids, len(z))
+        sub_z = z[var_ids]
+        sub_counts = counts[var_ids]
+        has_locations = sub_counts > 0
+        var_groups = component_index[var_components[var_ids]]
+        pot_groups = component_index[pot_components[rows]]
+        block = _PotentialBlock(sub_arrays, groups=pot_groups, n_groups=len(components))
+        component_eta = eta[components]
+
+        converged = np.zeros(len(components), dtype=bool)
+        while not converged.any() and iteration < settings.max_iter:
+            totals, ax_norm, ay_norm = block.update(sub_z, component_eta[pot_groups], settings.relaxation)
+
+            new_z = np.where(has_locations, totals / np.maximum(sub_counts, 1), sub_z)
+            np.clip(new_z, 0, 1, out=new_z)
+            dual_res = np.bincount(var_groups, sub_counts * (sub_z - new_z) ** 2, len(components))
+            bz_norm = np.bincount(var_groups, sub_counts * new_z ** 2, len(components))
+            sub_z = new_z
+
+            primal_res = np.sqrt(block.get_primal_res(sub_z))
+            dual_res = component_eta * np.sqrt(dual_res)
+            epsilon_primal = epsilon_abs_term[components] + \
+                settings.epsilon_rel * np.sqrt(np.maximum(ax_norm, bz_norm))
+            epsilon_dual = epsilon_abs_term[components] + settings.epsilon_rel * np.sqrt(ay_norm)
+            converged = (primal_res <= epsilon_primal) & (dual_res <= epsilon_dual)
+            history.append((math.sqrt(np.dot(primal_res, primal_res)), math.sqrt(np.dot(dual_res, dual_res)),
+                            float(np.max(component_eta))))
+
+            if settings.adaptive_eta:
+                new_eta = _balance_eta(component_eta, primal_res, dual_res, settings.eta_ratio, settings.eta_factor)
+                if (new_eta != component_eta).any():
+                    block.update_multipliers(sub_z, component_eta[pot_groups])
+                    component_eta = new_eta
+
+            iteration += 1
+
+        # Copies the state of the active components back, with the deferred multiplier update applied if eta changed,
+        # since the next run starts with the initial eta
+        if (component_eta != settings.eta).any():
+            block.update_multipliers(sub_z, component_eta[pot_groups])
+        for name in _STATE_ARRAYS:
+            arrays[name][rows] = sub_arrays[name]
+        z[var_ids] = sub_z
+        eta[components] = component_eta
+        active[components[converged]] = False
+
+    return iteration, history
+
+
+def _solve_components_job(arrays, z, counts, var_components, settings):
+    iterations, history = _solve_components(arrays, z, counts, var_components, settings)
+    return dict((name, arrays[name]) for name in _STATE_ARRAYS), z, iterations, history
+
+
+def _merge_histories(history1, history2):
+    # Combines the residual histories of two disjoint sets of components
+    merged = []
+    for i in range(max(len(history1), len(history2))):
+        primal_res = 0.0
+        dual_res = 0.0
+        eta = 0.0
+        for history in (history1, history2):
+            if i < len(history):
+                primal_res += history[i][0] ** 2
+                dual_res += history[i][1] ** 2
+                eta = max(eta, history[i][2])
+        merged.append((math.sqrt(primal_res), math.sqrt(dual_res), eta))
+    return merged
+
+
+def _balance_eta(eta, primal_res, dual_res, ratio, factor):
+    # Residual balancing. The Lagrange multipliers are stored unscaled, i.e., not divided by eta, so they remain
+    # valid when eta changes and need no rescaling, but the deferred multiplier update of the last step must be
+    # applied with the old eta first. See _PotentialBlock.update_multipliers.
+    return np.where(primal_res > ratio * dual_res, eta * factor, np.where(dual_res > ratio * primal_res,
+                                                                           eta / factor, eta))
+
+
+def _select(arrays, rows, var_ids, n_vars):
+    # Copies the given potentials, renumbering their variables to index into var_ids
+    var_index = np.full(n_vars, -1, dtype=np.intp)
+    var_index[var_ids] = np.arange(len(var_ids))
+    selected = dict((name, array[rows]) for name, array in arrays.items())
+    selected['var1'] = var_index[selected['var1']]
+    selected['var2_safe'] = np.where(selected['var2'] >= 0, var_index[selected['var2_safe']], 0)
+    selected['var2'] = np.where(selected['var2'] >= 0, selected['var2_safe'], -1)
+    return selected
+
+
+def _broadcast_batch(weights, coefficients, variables, constants, two_sided):
+    variables = np.asarray(variables)
+    if variables.ndim == 1:
+        variables = variables.reshape(-1, 1)
+    n_pots, n_vars = variables.shape
+    coefficients = np.broadcast_to(np.asarray(coefficients, dtype=float).reshape(-1, n_vars), (n_pots, n_vars))
+    weights = np.broadcast_to(np.asarray(weights, dtype=float), (n_pots,))
+    constants = np.broadcast_to(np.asarray(constants, dtype=float), (n_pots,))
+    two_sided = np.broadcast_to(np.asarray(two_sided, dtype=bool), (n_pots,))
+    return weights, coefficients, variables, constants, two_sided
+
+
+def _find_repeats(pots, hashes):
+    # Returns the first row of each distinct potential and the potential of each row. Rows are grouped by their
+    # hashes, which only needs one sort, unless two different potentials share a hash.
+    order = np.argsort(hashes, kind='stable')
+    sorted_hashes = hashes[order]
+    starts = np.ones(len(order), dtype=bool)
+    starts[1:] = sorted_hashes[1:] != sorted_hashes[:-1]
+    groups = np.cumsum(starts) - 1
+    firsts = order[starts]
+    if all((column[order] == column[firsts[groups]]).all() for column in pots.values()):
+        inverse = np.empty(len(order), dtype=np.intp)
+        inverse[order] = groups
+        return firsts, inverse
+
+    keys = np.column_stack((pots['var1'], pots['var2'], pots['coeff1'].view(np.int64), pots['coeff2'].view(np.int64),
+                            pots['const'].view(np.int64), pots['bowl']))
+    _, firsts, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    return firsts, inverse.ravel()
+
+
+def _cg(A, b, tol, maxiter, M):
+    # The relative tolerance was named tol before scipy 1.12 and only rtol since 1.14
+    try:
+        return scipy.sparse.linalg.cg(A, b, rtol=tol, maxiter=maxiter, M=M)
+    except TypeError:
+        return scipy.sparse.linalg.cg(A, b, tol=tol, maxiter=maxiter, M=M)
+
+
+def _grow(array, min_size):
+    grown = np.zeros(max(2 * len(array), min_size), dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+def _make_key(coefficients, variables, constant, two_sided, squared):
+    if isinstance(coefficients, (int, float)):
+        coefficients = (coefficients,)
+    if isinstance(variables, (Variable, int, np.integer)):
+        variables = (variables,)
+
+    if not squared:
+        raise NotImplementedError('Only squared potentials are currently supported.')
+    if len(coefficients) != len(variables):
+        raise Exception('Must provide the same number of coefficients and variables.')
+
+    return coefficients, variables, constant, two_sided, squared
+
+
 class _ADMMPotential:
 
     __slots__ = ('admm', 'weight')
@@ -0,0 +1,141 @@
+import numpy as np
+import scipy.sparse
+
+import mmln
+
+
+class LabelStore:
+
+    def __init__(self, nodes, labels, adjacency, observations, targets, truth, directed=False):
+        # Nodes and labels are listed in the order of the rows and columns of the label matrices. These are CSR
+        # matrices with an explicit entry, which may be 0, for each (node, label) that has an observation, a target,
+        # or a truth value. The adjacency matrix holds the edge weights.
+        self.nodes = list(nodes)
+        self.labels = list(labels)
+        self.node_index = dict((node, i) for i, node in enumerate(self.nodes))
+        self.label_index = dict((label, j) for j, label in enumerate(self.labels))
+        self.adjacency = adjacency
+        self.directed = directed
+        self.matrices = {mmln.OBSVS: observations, mmln.TARGETS: targets, mmln.TRUTH: truth}
+
+        # Columns are read through CSC matrices of the positions of the entries in the label matrices, which are made
+        # when first needed
+        self._columns = {}
+
+    @classmethod
+    def from_network(cls, net):
+        nodes = net.nodes()
+        labels = []
+        label_index = {}
+        entries = dict((collection, ([], [], [])) for collection in (mmln.OBSVS, mmln.TARGETS, mmln.TRUTH))
+        for i, node in enumerate(nodes):
+            for collection, (rows, cols, values) in entries.items():
+                if collection in net.node[node]:
+                    # Targets can also be given as a collection of labels
+                    label_map = net.node[node][collection]
+                    items = label_map.items() if isinstance(label_map, dict) else ((label, 0) for label in label_map)
+                    for label, value in items:
+                        if label not in label_index:
+                            label_index[label] = len(labels)
+                            labels.append(label)
+                        rows.append(i)
+                        cols.append(label_index[label])
+                        values.append(value)
+
+        shape = (len(nodes), len(labels))
+        matrices = dict((collection, scipy.sparse.csr_matrix((np.array(values, dtype=float), (rows, cols)),
+                                                             shape=shape))
+                        for collection, (rows, cols, values) in entries.items())
+
+        # Edges are stored in both directions, unless the network is directed
+        node_index = dict((node, i) for i, node in enumerate(nodes))
+        edges = net.edges(data=True)
+        heads = np.fromiter((node_index[edge[0]] for edge in edges), dtype=np.intp, count=len(edges))
+        tails = np.fromiter((node_index[edge[1]] for edge in edges), dtype=np.intp, count=len(edges))
+        weights = np.fromiter((edge[2].get('weight', 1.0) for edge in edges), dtype=float, count=len(edges))
+        if not net.is_directed():
+            mirrored = heads != tails
+            heads, tails = np.concatenate((heads, tails[mirrored])), np.concatenate((tails, heads[mirrored]))
+            weights = np.concatenate((weights, weights[mirrored]))
+        adjacency = scipy.sparse.csr_matrix((weights, (heads, tails)), shape=(len(nodes), len(nodes)))
+
+        return cls(nodes, labels, adjacency, matrices[mmln.OBSVS], matrices[mmln.TARGETS], matrices[mmln.TRUTH],
+                   net.is_directed())
+
+    def to_network(self, net, collections=(mmln.OBSVS, mmln.TARGETS, mmln.TRUTH)):
+        # Writes the label matrices back to the node attributes of net, which must have the same nodes
+        for collection in collections:
+            matrix = self.matrices[collection]
+            for i, node in enumerate(self.nodes):
+                start, end = matrix.indptr[i], matrix.indptr[i + 1]
+                if end > start or collection in net.node[node]:
+                    net.node[node][collection] = dict(zip((self.labels[j] for j in matrix.indices[start:end]),
+                                                          matrix.data[start:end].tolist()))
+        return net
+
+    def get_column(self, collection, label):
+        # Returns the nodes, as sorted indices, that have an entry for label, and the entries
+        nodes, positions = self.get_entries(collection, label)
+        return nodes, self.matrices[collection].data[positions]
+
+    def get_entries(self, collection, label):
+        # Returns the nodes, as sorted indices, that have an entry for label, and the entries' positions in the CSR
+        # order of the label matrix
+        j = self.label_index.get(label)
+        if j is None:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.intp)
+        column = self.get_columns(collection)
+        start, end = column.indptr[j], column.indptr[j + 1]
+        return column.indices[start:end], column.data[start:end]
+
+    def get_columns(self, collection):
+        # Returns a CSC matrix of the positions of the entries of a label matrix in its CSR order, with the rows of
+        # each column sorted
+        if collection not in self._columns:
+            matrix = self.matrices[collection]
+            self._columns[collection] = scipy.sparse.csr_matrix(
+                (np.arange(matrix.nnz), matrix.indices, matrix.indptr), shape=matrix.shape).tocsc()
+            self._columns[collection].sort_indices()
+        return self._columns[collection]
+
+    def align(self, collection, other):
+        # Returns whether each entry of a label matrix, in CSR order, has an entry for the same (node, label) in
+        # another label matrix, which can also be given as a CSR matrix of the same shape, and the positions of those
+        # entries in the other's CSR order
+        keys = _get_keys(self.matrices[collection])
+        other_keys = _get_keys(self.matrices[other] if isinstance(other, str) else other)
+        if len(other_keys) == 0:
+            return np.zeros(len(keys), dtype=bool), np.zeros(0, dtype=np.intp)
+        order = np.argsort(other_keys, kind='stable')
+        indices = np.minimum(np.searchsorted(other_keys[order], keys), len(other_keys) - 1)
+        found = other_keys[order[indices]] == keys
+        return found, order[indices[found]]
+
+    def lookup(self, collection, label, nodes):
+        # Returns whether each of nodes has an entry for label, and the entries of those that do
+        found, positions = self.lookup_entries(collection, label, nodes)
+        return found, self.matrices[collection].data[positions]
+
+    def lookup_entries(self, collection, label, nodes):
+        column_nodes, positions = self.get_entries(collection, label)
+        if len(column_nodes) == 0:
+            return np.zeros(len(nodes), dtype=bool), positions
+        indices = np.minimum(np.searchsorted(column_nodes, nodes), len(column_nodes) - 1)
+        found = column_nodes[indices] == nodes
+        return found, positions[indices[found]]
+
+    def set_values(self, collection, values):
+        # Replaces the entries of a label matrix, in CSR order
+        self.matrices[collection].data[...] = values
+
+    def get_pattern(self):
+        # Returns the adjacency matrix with every edge weight set to 1
+        pattern = self.adjacency.copy()
+        pattern.data[...] = 1
+        return pattern
+
+
+def _get_keys(matrix):
+    # Numbers the entries of a label matrix by node and label
+    rows = np.repeat(np.arange(matrix.shape[0], dtype=np.int64), np.diff(matrix.indptr))
+    return rows * matrix.shape[1] + matrix.indices
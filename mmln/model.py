@@ -14,8 +14,24 @@ class Model:
 
         self._weights = {inter_node_pos: {}, inter_node_neg: {}, intra_node_pos: {}, intra_node_neg: {}}
 
+    @property
+    def inter_node_pos(self):
+        return self._weights[inter_node_pos]
+
+    @property
+    def inter_node_neg(self):
+        return self._weights[inter_node_neg]
+
+    @property
+    def intra_node_pos(self):
+        return self._weights[intra_node_pos]
+
+    @property
+    def intra_node_neg(self):
+        return self._weights[intra_node_neg]
+
     def __getitem__(self, item):
         return self._weights[item]
 
     def __setitem__(self, key, value):
-        self._weights[key] = value
\ No newline at end of file
+        self._weights[key] = value
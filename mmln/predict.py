@@ -1,120 +1,752 @@
 import logging
+import multiprocessing
 import numpy as np
 import scipy.sparse
+import scipy.sparse.csgraph
 import scipy.sparse.linalg
 import sklearn.metrics
 
 import mmln
 import mmln.ground
 import mmln.infer
+import mmln.profiling
 
 
 class AbstractPredictor:
 
-    def __init__(self, network):
+    def __init__(self, network, writeback=True):
+        # The network can also be given as a label store. Otherwise, a label store is made from it each time
+        # predictions are made, so changes to the network are seen, and predictions are written back to it, unless
+        # writeback is False. Then they are only kept in the label store's target matrix, and are read with
+        # get_predictions or get_top_k.
         self.n = network
-        self.all_labels = mmln.get_all_labels(network)
+        self.store = network if isinstance(network, mmln.LabelStore) else mmln.LabelStore.from_network(network)
+        self.writeback = writeback
+        self.all_labels = mmln.get_all_labels(self.store)
         self.predict_done = False
         self.logger = logging.getLogger(__name__)
 
     def get_per_label_predictions(self):
         if not self.predict_done:
             raise Exception('Must call Predictor.predict() first.')
+        self._refresh_store()
 
         predictions = {}
         for label in self.all_labels:
-            predictions[label] = {}
-
-        for node in self.n.nodes():
-            if mmln.TARGETS in self.n.node[node]:
-                for label in self.n.node[node][mmln.TARGETS]:
-                    predictions[label][node] = self.n.node[node][mmln.TARGETS][label]
+            nodes, values = self.store.get_column(mmln.TARGETS, label)
+            predictions[label] = dict(zip((self.store.nodes[i] for i in nodes), values.tolist()))
 
         return predictions
 
-    def get_per_label_score(self, metric=sklearn.metrics.roc_auc_score):
+    def get_per_label_score(self, metric=sklearn.metrics.roc_auc_score, n_jobs=1, n_bins=None, predictions=None):
+        # AUC and average precision are computed for all labels at once, as by get_per_label_scores. Other metrics are
+        # called on each label's targets. Predictions from get_predictions can be given in place of the targets'
+        # values.
+        if metric in _VECTORIZED_METRICS:
+            return self.get_per_label_scores((_VECTORIZED_METRICS[metric],), n_jobs, n_bins, predictions)[
+                _VECTORIZED_METRICS[metric]]
         if not self.predict_done:
             raise Exception('Must call Predictor.predict() first.')
-
-        predictions = self.get_per_label_predictions()
+        self._refresh_store()
 
         # Computes AUCs
+        indptr, y, y_true = self._get_aligned_targets(predictions)
         scores = {}
-        for label in self.all_labels:
-            y_true = []
-            y = []
-            for node, prediction in predictions[label].items():
-                y_true.append(self.n.node[node][mmln.TRUTH][label])
-                y.append(prediction)
-            scores[label] = metric(y_true, y)
+        for j in np.flatnonzero(np.diff(indptr) > 0):
+            scores[self.store.labels[j]] = metric(y_true[indptr[j]:indptr[j + 1]], y[indptr[j]:indptr[j + 1]])
 
         return scores
 
+    def get_per_label_scores(self, metrics=('roc_auc', 'average_precision'), n_jobs=1, n_bins=None,
+                             predictions=None):
+        # Computes each of metrics, 'roc_auc' or 'average_precision', for every label with targets in one pass over
+        # the targets, sorted by label and prediction. With n_jobs > 1, the labels are split between worker processes.
+        # If n_bins is given, the predictions are instead counted in that many equal-width bins, as if those in a bin
+        # were tied, which approximates the metrics without sorting. Predictions from get_predictions can be given in
+        # place of the targets' values. Returns the scores by label for each metric.
+        if not self.predict_done:
+            raise Exception('Must call Predictor.predict() first.')
+        self._refresh_store()
+
+        indptr, values, truth = self._get_aligned_targets(predictions)
+        return _score_labels(self.store.labels, indptr, values, truth, metrics, n_jobs, n_bins)
+
+    def get_predictions(self, k=None, threshold=None):
+        # Returns the predictions as a CSR matrix with a row per node and a column per label, in the orders of the
+        # label store. If k is given, only each node's k highest predictions are kept, and if threshold is given, only
+        # those of at least threshold.
+        if not self.predict_done:
+            raise Exception('Must call Predictor.predict() first.')
+        self._refresh_store()
+
+        targets = self.store.matrices[mmln.TARGETS]
+        rows, positions, _ = _select_top_k(targets, k, threshold)
+        order = np.lexsort((targets.indices[positions], rows))
+        rows, positions = rows[order], positions[order]
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=targets.shape[0]))))
+        return scipy.sparse.csr_matrix((targets.data[positions], targets.indices[positions], indptr),
+                                       shape=targets.shape)
+
+    def get_top_k(self, k, threshold=None):
+        # Returns arrays with a row per node of its k highest predictions, highest first, and of their labels'
+        # indices in the label store. Rows with fewer predictions, at least threshold if given, are padded with nan
+        # and -1.
+        if not self.predict_done:
+            raise Exception('Must call Predictor.predict() first.')
+        self._refresh_store()
+
+        targets = self.store.matrices[mmln.TARGETS]
+        rows, positions, ranks = _select_top_k(targets, k, threshold)
+        values = np.full((targets.shape[0], k), np.nan)
+        labels = np.full((targets.shape[0], k), -1, dtype=np.intp)
+        values[rows, ranks] = targets.data[positions]
+        labels[rows, ranks] = targets.indices[positions]
+        return values, labels
+
+    def _get_aligned_targets(self, predictions=None):
+        # Returns the index pointer of the targets' columns, and the predictions and truth values of the targets in
+        # column order. If a matrix of predictions is given, targets without an entry in it are tied below those
+        # with one.
+        targets = self.store.matrices[mmln.TARGETS]
+        found, positions = self.store.align(mmln.TARGETS, mmln.TRUTH)
+        if not found.all():
+            missing = np.flatnonzero(~found)[0]
+            node = np.searchsorted(targets.indptr, missing, side='right') - 1
+            raise Exception('Missing truth for (' + str(self.store.nodes[node]) + ', ' +
+                            str(self.store.labels[targets.indices[missing]]) + ').')
+        truth = self.store.matrices[mmln.TRUTH].data[positions]
+        columns = self.store.get_columns(mmln.TARGETS)
+
+        values = targets.data
+        if predictions is not None:
+            if predictions.shape != targets.shape:
+                raise Exception('Predictions must have a row per node and a column per label.')
+            predictions = scipy.sparse.csr_matrix(predictions)
+            found, positions = self.store.align(mmln.TARGETS, predictions)
+            values = np.full(targets.nnz, predictions.data.min() - 1 if predictions.nnz > 0 else 0.0)
+            values[found] = predictions.data[positions]
+        return columns.indptr, values[columns.data], truth[columns.data]
+
+    def _refresh_store(self, rebuild=False):
+        # Remakes the label store from the network, so that changes made to the network since the store was made are
+        # seen. A label store given in place of the network is used as it is. Without writeback, the predictions are
+        # only kept in the store, so then it is only remade when rebuild is set, i.e., before predicting.
+        if self.n is self.store:
+            return
+        if self.store is None or rebuild or self.writeback:
+            self.store = mmln.LabelStore.from_network(self.n)
+            self.all_labels = mmln.get_all_labels(self.store)
+
+    def _set_predictions(self, values):
+        # Sets the predictions in the CSR order of the target matrix
+        self.store.set_values(mmln.TARGETS, values)
+        if self.n is not self.store and self.writeback:
+            self.store.to_network(self.n, (mmln.TARGETS,))
+
 
 class MRFPredictor(AbstractPredictor):
 
-    def __init__(self, network):
-        super(MRFPredictor, self).__init__(network)
+    def __init__(self, network, writeback=True):
+        super(MRFPredictor, self).__init__(network, writeback)
 
-    def predict(self, model, inf=None):
+    def predict(self, model, inf=None, queries=None, depth=2, boundary=None, profiler=None):
+        # If queries, a list of (node, label) targets, are given, only the targets within depth steps of them in the
+        # graph of potentials are grounded and inferred, and only the queries' predictions are set. The targets one
+        # step further are fixed to boundary values, given in the order of the target matrix, which default to the
+        # targets' current values, e.g., the predictions of a cheaper predictor. If a mmln.Profiler is given, it
+        # records the phases of grounding and inference and the inference method's iterations.
         self.logger.info('Starting prediction. Setting up inference.')
+        self._refresh_store(rebuild=True)
         if inf is None:
             inf = mmln.infer.HLMRF()
-        manager = mmln.ground.GroundingManager(model, self.n, self.all_labels, inf)
-        manager.init_all_weights()
+        if queries is None:
+            store, positions, local_positions = self.store, None, None
+        else:
+            with mmln.profiling._phase(profiler, 'select queries'):
+                store, positions, local_positions = self._get_local_store(model, queries, depth, boundary)
+        with mmln.profiling._phase(profiler, 'grounding'):
+            manager = mmln.ground.GroundingManager(model, store, self.all_labels, inf, profiler)
+            manager.init_all_weights()
 
         self.logger.info('Inference set up. Starting inference.')
-        inf.infer()
+        # The inference method records its iterations with the profiler for this run only
+        with mmln.profiling._phase(profiler, 'inference'):
+            previous_profiler = inf.profiler
+            if profiler is not None:
+                inf.profiler = profiler
+            try:
+                inf.infer()
+            finally:
+                inf.profiler = previous_profiler
 
+        # The manager's variables are in the order of the target matrix
         self.logger.info('Inference done. Collecting the results.')
-        for node in self.n.nodes():
-            if mmln.TARGETS in self.n.node[node]:
-                for label in self.n.node[node][mmln.TARGETS]:
-                    self.n.node[node][mmln.TARGETS][label] = manager.get_value(node, label)
+        with mmln.profiling._phase(profiler, 'set predictions'):
+            values = [inf.get_value(var) for var in manager.var_array]
+            if positions is None:
+                self._set_predictions(values)
+            else:
+                predictions = self.store.matrices[mmln.TARGETS].data.copy()
+                predictions[positions] = np.asarray(values)[local_positions]
+                self._set_predictions(predictions)
 
         self.logger.info('Prediction done.')
         self.predict_done = True
 
+    def _get_local_store(self, model, queries, depth, boundary):
+        # Makes a label store of the targets within depth steps of the queries, with the targets one step further
+        # observed at their boundary values. Also returns the positions of the queries in the target matrix and in
+        # the local store's target matrix.
+        if self.store.directed:
+            raise Exception('Queries are only supported for undirected networks.')
+        n_labels = len(self.store.labels)
+        targets = self.store.matrices[mmln.TARGETS]
+        rows = np.repeat(np.arange(len(self.store.nodes)), np.diff(targets.indptr))
+
+        # Targets are identified by keys, node * n_labels + label
+        keys = rows * n_labels + targets.indices
+        order = np.argsort(keys)
+        keys = keys[order]
+        query_keys = np.unique([self.store.node_index[node] * n_labels + self.store.label_index[label]
+                                for node, label in queries])
+        if not _find_keys(keys, query_keys).all():
+            raise Exception('All queries must be targets.')
+
+        intra, inter = self._get_label_couplings(model)
+        region = frontier = query_keys
+        for step in range(depth + 1):
+            reached = _expand_keys(frontier, n_labels, self.store.adjacency, intra, inter)
+            reached = reached[_find_keys(keys, reached)]
+            frontier = np.setdiff1d(reached, region, assume_unique=True)
+            if step < depth:
+                region = np.union1d(region, frontier)
+        self.logger.info('Grounding ' + str(len(region)) + ' targets for ' + str(len(query_keys)) +
+                         ' queries, with ' + str(len(frontier)) + ' fixed at their boundary values.')
+
+        values = targets.data if boundary is None else np.asarray(boundary, dtype=float)
+        positions = order[np.searchsorted(keys, region)]
+        boundary_values = values[order[np.searchsorted(keys, frontier)]]
+
+        # Keeps the region's nodes and their neighbors. Only the region's nodes need their edges.
+        region_nodes = np.unique(region // n_labels)
+        neighbors = self.store.adjacency[region_nodes]
+        nodes = np.unique(np.concatenate((region_nodes, neighbors.indices, frontier // n_labels)))
+        shape = (len(nodes), n_labels)
+        heads = np.searchsorted(nodes, region_nodes)[np.repeat(np.arange(len(region_nodes)), np.diff(neighbors.indptr))]
+        adjacency = scipy.sparse.csr_matrix((neighbors.data, (heads, np.searchsorted(nodes, neighbors.indices))),
+                                            shape=(len(nodes), len(nodes)))
+
+        local_targets = scipy.sparse.csr_matrix(
+            (targets.data[positions], (np.searchsorted(nodes, region // n_labels), region % n_labels)), shape=shape)
+
+        # Observations of the boundary targets replace any others
+        obsvs = self.store.matrices[mmln.OBSVS][nodes].tocoo()
+        obsv_keys = nodes[obsvs.row] * n_labels + obsvs.col
+        kept = ~np.isin(obsv_keys, frontier)
+        local_obsvs = scipy.sparse.csr_matrix(
+            (np.concatenate((obsvs.data[kept], boundary_values)),
+             (np.concatenate((obsvs.row[kept], np.searchsorted(nodes, frontier // n_labels))),
+              np.concatenate((obsvs.col[kept], frontier % n_labels)))), shape=shape)
+
+        store = mmln.LabelStore([self.store.nodes[i] for i in nodes], self.store.labels, adjacency, local_obsvs,
+                                local_targets, scipy.sparse.csr_matrix(shape))
+        # The local targets are in the order of the region's keys
+        query_positions = order[np.searchsorted(keys, query_keys)]
+        return store, query_positions, np.searchsorted(region, query_keys)
+
+    def _get_label_couplings(self, model):
+        # Returns which labels share potentials on the same node and on adjacent nodes, as symmetric matrices
+        couplings = []
+        inter_pairs = list(model.inter_node_pos.items())
+        if model.inter_node_pos_same_label_default != 0:
+            inter_pairs += [((label, label), model.inter_node_pos_same_label_default) for label in self.all_labels
+                            if (label, label) not in model.inter_node_pos]
+        for pairs in (model.intra_node_pos.items(), inter_pairs):
+            pairs = [(self.store.label_index[l1], self.store.label_index[l2]) for (l1, l2), weight in pairs
+                     if weight != 0 and l1 in self.store.label_index and l2 in self.store.label_index]
+            rows = [j1 for j1, j2 in pairs] + [j2 for j1, j2 in pairs]
+            cols = [j2 for j1, j2 in pairs] + [j1 for j1, j2 in pairs]
+            n_labels = len(self.store.labels)
+            couplings.append(scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n_labels, n_labels)))
+        return couplings
+
+
+def _find_keys(keys, queries):
+    # Returns whether each query is in keys, which are sorted
+    if len(keys) == 0:
+        return np.zeros(len(queries), dtype=bool)
+    return keys[np.minimum(np.searchsorted(keys, queries), len(keys) - 1)] == queries
+
+
+def _expand_keys(keys, n_labels, adjacency, intra, inter):
+    # Returns the keys of the (node, label) pairs that share a potential with any of keys if both are targets
+    nodes, labels = keys // n_labels, keys % n_labels
+    same_node = intra[labels]
+    expanded = [nodes[np.repeat(np.arange(len(keys)), np.diff(same_node.indptr))] * n_labels + same_node.indices]
+
+    # Couples the labels first and then moves to the neighbors
+    other_labels = inter[labels]
+    pairs = np.unique(nodes[np.repeat(np.arange(len(keys)), np.diff(other_labels.indptr))] * n_labels +
+                      other_labels.indices)
+    neighbors = adjacency[pairs // n_labels]
+    expanded.append(neighbors.indices.astype(np.int64) * n_labels + (pairs % n_labels)[np.repeat(np.arange(len(pairs)),
+                                                                                 np.diff(neighbors.indptr))])
+    return np.unique(np.concatenate(expanded))
+
 
 class LabelPropPredictor(AbstractPredictor):
 
-    def __init__(self, network):
-        super(LabelPropPredictor, self).__init__(network)
+    def __init__(self, network, writeback=True):
+        super(LabelPropPredictor, self).__init__(network, writeback)
 
-    def predict(self, lam=1.0):
+        # Solution for the solved labels at the (node, label) pairs where it is more than a cutoff, by node and label,
+        # if kept by predict
+        self.solution = None
+
+    def predict(self, lam=1.0, block_size=256, solver='direct', tol=1e-6, max_iter=None, preconditioner='jacobi',
+                warm_start=False, cache=None, keep_solution=False, profiler=None, solution_cutoff=1e-8):
+        # The solver is either 'direct', which factorizes the Laplacian, or 'cg', which solves it with preconditioned
+        # conjugate gradient and needs much less memory on large graphs. CG needs a symmetric positive definite system,
+        # i.e., an undirected network and lam >= 1. It stops when each label's residual is at most tol times the norm of
+        # its observations, and is preconditioned by the Laplacian's diagonal ('jacobi') or a symmetric incomplete
+        # factorization ('ilu'). If warm_start is set, CG starts from the current values of the targets, e.g., the
+        # predictions for another fold or value of lam. If a mmln.FactorizationCache is given, the factorization, or for
+        # CG the system and its preconditioner, is looked up in it and added to it. If keep_solution is set, the
+        # solution is kept as well, which update needs, at every (node, label) pair of a label with observations where
+        # it is more than solution_cutoff.
         self.logger.info('Starting prediction. Setting up inference.')
+        self._refresh_store(rebuild=True)
+        if solver not in ('direct', 'cg'):
+            raise Exception('Unknown solver: ' + str(solver) + '.')
+        if solver == 'cg' and (self.store.directed or lam < 1):
+            raise Exception('The CG solver needs an undirected network and lam >= 1.')
+        if solver == 'cg' and preconditioner not in ('jacobi', 'ilu'):
+            raise Exception('Unknown preconditioner: ' + str(preconditioner) + '.')
+
+        with mmln.profiling._phase(profiler, 'factorization'):
+            n_nodes = len(self.store.nodes)
+            factorization = None
+            if cache is not None:
+                settings = (float(lam), solver, preconditioner if solver == 'cg' else None)
+                key = cache.get_key(self.store.adjacency, settings)
+                factorization = cache.get(key)
+            if factorization is None:
+                factorization, n_bytes = self._factorize(lam, solver, preconditioner)
+                if cache is not None:
+                    cache.put(key, factorization, n_bytes)
+            else:
+                self.logger.info('Found the factorization in the cache.')
 
-        # Makes a map from nodes to matrix indices
-        node_indices = {}
-        next_index = 0
-        for node in self.n.nodes():
-            node_indices[node] = next_index
-            next_index += 1
-
-        # Constructs the network's Laplacian matrix
-        L = scipy.sparse.lil_matrix((self.n.number_of_nodes(), self.n.number_of_nodes()))
-        for node in self.n.nodes():
-            total_weight = 0
-            for neighbor in self.n.neighbors(node):
-                L[node_indices[node], node_indices[neighbor]] = -1 * self.n.edge[node][neighbor]['weight']
-                total_weight += self.n.edge[node][neighbor]['weight']
-            L[node_indices[node], node_indices[node]] = 1 + lam * total_weight
-        L = scipy.sparse.csc_matrix(L)
-        solve = scipy.sparse.linalg.factorized(L)
+            if solver == 'direct':
+                solve = factorization.solve
+            else:
+                A, precondition = factorization
+                solve = lambda b, x: _solve_cg(A, b, x, precondition, tol, max_iter, profiler)
 
+        # Solves for block_size labels at a time, which bounds the memory for the dense right-hand sides and solutions.
+        # Only labels with observations and targets, or observations if the solution is kept, are solved, since the
+        # solution for a label without observations is 0.
         self.logger.info('Inference set up. Starting inference.')
-        for label in self.all_labels:
-            y = np.zeros(self.n.number_of_nodes())
+        with mmln.profiling._phase(profiler, 'inference'):
+            obsvs = self.store.matrices[mmln.OBSVS].tocsc()
+            targets = self.store.matrices[mmln.TARGETS]
+            target_nodes = np.repeat(np.arange(n_nodes), np.diff(targets.indptr))
+            n_labels = len(self.store.labels)
+            has_targets = np.bincount(targets.indices, minlength=n_labels) > 0
+            solved = np.flatnonzero((np.diff(obsvs.indptr) > 0) & (has_targets | keep_solution))
+            if warm_start:
+                guesses = targets.tocsc()
+
+            # Groups the targets' positions by label
+            order = np.argsort(targets.indices, kind='stable')
+            sorted_labels = targets.indices[order]
 
-            for node in self.n.nodes():
-                if mmln.OBSVS in self.n.node[node] and label in self.n.node[node][mmln.OBSVS]:
-                    y[node_indices[node]] = self.n.node[node][mmln.OBSVS][label]
+            predictions = np.zeros(targets.nnz)
+            columns = np.full(n_labels, -1)
+            iterations = 0
+            kept = []
+            for start in range(0, len(solved), block_size):
+                block = solved[start:start + block_size]
+                if solver == 'direct':
+                    f = solve(obsvs[:, block].toarray())
+                else:
+                    guess = guesses[:, block].toarray() if warm_start else np.zeros((n_nodes, len(block)))
+                    f, block_iterations = solve(obsvs[:, block].toarray(), guess)
+                    iterations = max(iterations, block_iterations)
 
-            f = solve(y)
+                columns[block] = np.arange(len(block))
+                positions = order[np.searchsorted(sorted_labels, block[0]):
+                                  np.searchsorted(sorted_labels, block[-1], side='right')]
+                positions = positions[columns[targets.indices[positions]] >= 0]
+                predictions[positions] = f[target_nodes[positions], columns[targets.indices[positions]]]
+                columns[block] = -1
 
-            for node in self.n.nodes():
-                if mmln.TARGETS in self.n.node[node] and label in self.n.node[node][mmln.TARGETS]:
-                    self.n.node[node][mmln.TARGETS][label] = f[node_indices[node]]
+                if keep_solution:
+                    rows, block_columns = np.nonzero(np.abs(f) > solution_cutoff)
+                    kept.append((rows, block[block_columns], f[rows, block_columns]))
+            self.logger.info('Solved for ' + str(len(solved)) + ' labels in blocks of ' + str(block_size) + '.')
+            if solver == 'cg':
+                self.logger.info('CG took at most ' + str(iterations) + ' iterations per block.')
+        with mmln.profiling._phase(profiler, 'set predictions'):
+            self._set_predictions(predictions)
+            if keep_solution:
+                self.solution = {}
+                for nodes, labels, values in kept:
+                    for i, j, value in zip(nodes.tolist(), labels.tolist(), values.tolist()):
+                        self.solution.setdefault(self.store.nodes[i], {})[self.store.labels[j]] = value
 
         self.logger.info('Prediction done.')
         self.predict_done = True
+
+    def update(self, added_nodes=(), added_edges=(), label_changes=None, lam=1.0, tol=1e-6, max_pushes=None):
+        # Applies changes to the network and updates the predictions near them by pushing residuals, as in local
+        # personalized PageRank, starting from the targets' current values and the solution kept by predict. Added
+        # nodes and edges are given as to networkx's add_nodes_from and add_edges_from, and an added edge that
+        # exists changes its weight. Label changes map nodes to dictionaries of new OBSVS, TARGETS, or TRUTH entries,
+        # which replace the old ones. Residuals are pushed until each is at most tol, or for at most max_pushes
+        # pushes. Values of the kept solution of at most tol are dropped as the changes are stored.
+        if self.n is self.store:
+            raise Exception('Only networks, not label stores, can be updated.')
+        if not self.writeback:
+            raise Exception('Updates start from the targets in the network, so they need writeback.')
+        if self.solution is None:
+            raise Exception('Must call predict with keep_solution=True before updating.')
+        if self.n.is_directed() or lam < 1:
+            raise Exception('Updates need an undirected network and lam >= 1.')
+        added_nodes = list(added_nodes)
+        added_edges = list(added_edges)
+        label_changes = label_changes if label_changes is not None else {}
+
+        # Reads the values of the old solution, before any changes
+        new_nodes = set(node[0] if isinstance(node, tuple) and len(node) == 2 and isinstance(node[1], dict) else node
+                        for node in added_nodes)
+        new_nodes.update(node for edge in added_edges for node in edge[:2])
+        new_nodes = set(node for node in new_nodes if not self.n.has_node(node))
+        old_targets = dict((node, dict(self.n.node[node].get(mmln.TARGETS, {}))) for node in label_changes
+                           if node not in new_nodes)
+        old_obsvs = dict((node, dict(self.n.node[node].get(mmln.OBSVS, {}))) for node in label_changes
+                         if node not in new_nodes)
+
+        def get_old_values(node):
+            if node in new_nodes:
+                return {}
+            values = dict(self.solution.get(node, {}))
+            targets = old_targets[node] if node in old_targets else self.n.node[node].get(mmln.TARGETS, {})
+            if isinstance(targets, dict):
+                values.update(targets)
+            return values
+
+        # The old solution f solves L f = y, so after the changes the residual is the change in y minus the change in
+        # L times f
+        residuals = {}
+        old_values = {}
+        for edge in added_edges:
+            # An edge that exists keeps its weight unless it is given a new one, as in add_edges_from
+            u, v = edge[:2]
+            old_weight = self.n[u][v].get('weight', 1.0) if self.n.has_edge(u, v) else 0.0
+            weight = old_weight if self.n.has_edge(u, v) else 1.0
+            if len(edge) > 2:
+                weight = edge[2].get('weight', weight)
+            delta = weight - old_weight
+            for node in (u, v):
+                if node not in old_values:
+                    old_values[node] = get_old_values(node)
+            for label, value in old_values[u].items():
+                _add_residual(residuals, u, label, -1 * lam * delta * value)
+                if u != v:
+                    _add_residual(residuals, v, label, delta * value)
+            if u != v:
+                for label, value in old_values[v].items():
+                    _add_residual(residuals, v, label, -1 * lam * delta * value)
+                    _add_residual(residuals, u, label, delta * value)
+        for node, labels in label_changes.items():
+            if node not in new_nodes and mmln.OBSVS in labels:
+                old = old_obsvs[node]
+                for label in set(old) | set(labels[mmln.OBSVS]):
+                    _add_residual(residuals, node, label, labels[mmln.OBSVS].get(label, 0) - old.get(label, 0))
+
+        self.n.add_nodes_from(added_nodes)
+        self.n.add_edges_from(added_edges)
+        for node, labels in label_changes.items():
+            self.n.node[node].update(labels)
+        for node in new_nodes:
+            for label, value in self.n.node[node].get(mmln.OBSVS, {}).items():
+                _add_residual(residuals, node, label, value)
+
+        changes, n_pushes = _push_residuals(self.n, residuals, lam, tol, max_pushes)
+
+        # Writes the new values of targets and of the solution at every pair the changes touch, including those of
+        # changed and new nodes
+        for node in set(changes) | set(label_changes) | new_nodes:
+            attributes = self.n.node[node]
+            if node not in old_values:
+                old_values[node] = get_old_values(node)
+            node_changes = changes.get(node, {})
+            targets = attributes.get(mmln.TARGETS, {})
+            for label in list(targets):
+                targets[label] = old_values[node].get(label, 0.0) + node_changes.get(label, 0.0)
+            values = ((label, old_values[node].get(label, 0.0) + node_changes.get(label, 0.0))
+                      for label in set(old_values[node]) | set(node_changes))
+            solution = dict((label, value) for label, value in values if abs(value) > tol)
+            if solution:
+                self.solution[node] = solution
+            else:
+                self.solution.pop(node, None)
+
+        # The label store is remade from the network when next needed
+        self.store = None
+        self.logger.info('Updated ' + str(len(changes)) + ' nodes with ' + str(n_pushes) + ' pushes.')
+
+    def _factorize(self, lam, solver, preconditioner):
+        # Returns the factorization of the Laplacian for the solver, or for CG the Laplacian and its preconditioner,
+        # and roughly how many bytes they take
+
+        # Constructs the network's Laplacian matrix from the edges. Self-loops only count toward the total weights.
+        n_nodes = len(self.store.nodes)
+        edges = self.store.adjacency.tocoo()
+        off_diagonal = edges.row != edges.col
+        total_weights = np.bincount(edges.row, edges.data, n_nodes)
+        L = scipy.sparse.csc_matrix(
+            (np.concatenate((-1 * edges.data[off_diagonal], 1 + lam * total_weights)),
+             (np.concatenate((edges.row[off_diagonal], np.arange(n_nodes))),
+              np.concatenate((edges.col[off_diagonal], np.arange(n_nodes))))), shape=(n_nodes, n_nodes))
+
+        if solver == 'direct':
+            lu = scipy.sparse.linalg.splu(L)
+            return lu, _get_lu_bytes(lu)
+
+        A = L.tocsr()
+        n_bytes = A.data.nbytes + A.indices.nbytes + A.indptr.nbytes
+        if preconditioner == 'jacobi':
+            inverse_diagonal = 1 / (1 + lam * total_weights)
+            return (A, lambda r: r * inverse_diagonal[:, None]), n_bytes + inverse_diagonal.nbytes
+        # The incomplete factorization is computed without pivoting in a reverse Cuthill-McKee order, which keeps the
+        # fill low. Its upper factor U and diagonal D give the symmetric positive definite preconditioner U^T D^-1 U,
+        # which CG needs, instead of the product of both factors, which is generally not symmetric. The triangular
+        # solves with U are done by factorizing it, which does not change it since it is already upper triangular.
+        order = scipy.sparse.csgraph.reverse_cuthill_mckee(A, symmetric_mode=True)
+        ilu = scipy.sparse.linalg.spilu(L[order][:, order], permc_spec='NATURAL', diag_pivot_thresh=0,
+                                        options={'SymmetricMode': True})
+        U = ilu.U.tocsc()
+        diagonal = U.diagonal()
+        if np.any(ilu.perm_r != np.arange(n_nodes)) or not np.all(diagonal > 0):
+            self.logger.info('The incomplete factorization is not positive definite. Using the Jacobi preconditioner.')
+            return self._factorize(lam, solver, 'jacobi')
+        upper = scipy.sparse.linalg.splu(U, permc_spec='NATURAL', diag_pivot_thresh=0)
+
+        def precondition(r):
+            z = np.empty(r.shape)
+            z[order] = upper.solve(diagonal[:, None] * upper.solve(r[order], trans='T'))
+            return z
+        return (A, precondition), n_bytes + _get_lu_bytes(upper) + diagonal.nbytes + order.nbytes
+
+
+def _get_lu_bytes(lu):
+    # Counts a value and an index for each entry of the factors, and the permutations
+    return (lu.L.nnz + lu.U.nnz) * 12 + lu.shape[0] * 16
+
+
+def _solve_cg(A, B, X, precondition, tol, max_iter=None, profiler=None):
+    # Solves A X = B for a symmetric positive definite A with preconditioned conjugate gradient, run on all columns at
+    # once so that each iteration is one sparse product with a dense block. Each column has its own step sizes and
+    # stops when its residual is at most tol times the norm of its column of B. X is the starting guess, and is
+    # updated in place. Returns X and the number of iterations.
+    max_iter = max_iter if max_iter is not None else 10 * A.shape[0]
+    thresholds = tol * np.linalg.norm(B, axis=0)
+    X[:, thresholds == 0] = 0
+    R = B - A.dot(X)
+
+    # Works on copies of the columns that have not converged, which are written back as they converge
+    active = np.flatnonzero(np.linalg.norm(R, axis=0) > thresholds)
+    X_active, R_active = X[:, active], R[:, active]
+    P = rz = None
+
+    if profiler is not None:
+        profiler.start_iterations('CG')
+    iteration = 0
+    while len(active) > 0 and iteration < max_iter:
+        Z = precondition(R_active)
+        new_rz = np.einsum('ij,ij->j', R_active, Z)
+        P = Z if P is None else Z + (new_rz / rz) * P
+        rz = new_rz
+
+        AP = A.dot(P)
+        alpha = rz / np.einsum('ij,ij->j', P, AP)
+        X_active += alpha * P
+        R_active -= alpha * AP
+
+        residuals = np.linalg.norm(R_active, axis=0)
+        converged = residuals <= thresholds[active]
+        if converged.any():
+            X[:, active[converged]] = X_active[:, converged]
+            kept = ~converged
+            active, X_active, R_active, P, rz = active[kept], X_active[:, kept], R_active[:, kept], P[:, kept], rz[kept]
+
+        iteration += 1
+        if profiler is not None:
+            profiler.record_iteration(iteration, max_residual=float(residuals.max()), active=len(active))
+    X[:, active] = X_active
+    return X, iteration
+
+
+def _add_residual(residuals, node, label, value):
+    if value != 0:
+        node_residuals = residuals.setdefault(node, {})
+        node_residuals[label] = node_residuals.get(label, 0.0) + value
+
+
+def _push_residuals(net, residuals, lam, tol, max_pushes=None):
+    # Runs Gauss-Southwell iterations on L f = r for the residuals r, which are changed in place. Each push moves a
+    # node's residual into its value and spreads it to its neighbors' residuals. With lam >= 1, L is diagonally
+    # dominant, so each push removes at least a 1 / L_ii fraction of the residual. Returns the changes to the values
+    # by node and label, and the number of pushes.
+    changes = {}
+    diagonals = {}
+    # Pairs are pushed last in, first out, and are queued again whenever their residuals grow past tol
+    queue = [(node, label) for node, node_residuals in residuals.items() for label, value in node_residuals.items()
+             if abs(value) > tol]
+    n_pushes = 0
+    while queue and (max_pushes is None or n_pushes < max_pushes):
+        node, label = queue.pop()
+        residual = residuals[node].get(label, 0.0)
+        if abs(residual) <= tol:
+            continue
+        if node not in diagonals:
+            diagonals[node] = 1 + lam * sum(attributes.get('weight', 1.0) for attributes in net[node].values())
+        delta = residual / diagonals[node]
+        node_changes = changes.setdefault(node, {})
+        node_changes[label] = node_changes.get(label, 0.0) + delta
+        residuals[node][label] = 0.0
+        n_pushes += 1
+
+        for neighbor, attributes in net[node].items():
+            if neighbor != node:
+                neighbor_residuals = residuals.setdefault(neighbor, {})
+                value = neighbor_residuals.get(label, 0.0) + attributes.get('weight', 1.0) * delta
+                neighbor_residuals[label] = value
+                if abs(value) > tol:
+                    queue.append((neighbor, label))
+    return changes, n_pushes
+
+
+_VECTORIZED_METRICS = {sklearn.metrics.roc_auc_score: 'roc_auc',
+                       sklearn.metrics.average_precision_score: 'average_precision'}
+
+# Bounds the size of the histograms of binned scores
+_MAX_HISTOGRAM_ENTRIES = 2 ** 22
+
+
+def _select_top_k(matrix, k=None, threshold=None):
+    # Returns the rows and CSR positions of the entries of a matrix that are among the k highest of their row and at
+    # least threshold, sorted by row and then by value from highest to lowest, and their ranks in their rows
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    positions = np.arange(matrix.nnz)
+    if threshold is not None:
+        positions = positions[matrix.data >= threshold]
+        rows = rows[positions]
+    order = np.lexsort((-1 * matrix.data[positions], rows))
+    rows, positions = rows[order], positions[order]
+    starts = np.searchsorted(rows, np.arange(matrix.shape[0]))
+    ranks = np.arange(len(rows)) - starts[rows]
+    if k is not None:
+        kept = ranks < k
+        rows, positions, ranks = rows[kept], positions[kept], ranks[kept]
+    return rows, positions, ranks
+
+
+def _score_labels(labels, indptr, scores, truth, metrics, n_jobs=1, n_bins=None):
+    # Scores the columns of a CSC layout, given by its index pointer and the scores and truth values of its entries,
+    # and returns the scores of the columns with entries by label for each metric
+    for metric in metrics:
+        if metric not in _VECTORIZED_METRICS.values():
+            raise Exception('Unknown metric: ' + str(metric) + '.')
+    bounds = (scores.min(), scores.max()) if len(scores) > 0 else (0.0, 0.0)
+    n_columns = len(indptr) - 1
+
+    if n_jobs > 1 and n_columns > 1:
+        # Splits the columns into contiguous ranges with about the same number of entries
+        splits = np.searchsorted(indptr, np.linspace(0, indptr[-1], n_jobs + 1)[1:-1])
+        boundaries = np.unique(np.concatenate(([0], splits, [n_columns])))
+        jobs = [(indptr[a:b + 1] - indptr[a], scores[indptr[a]:indptr[b]], truth[indptr[a]:indptr[b]], metrics,
+                 n_bins, bounds) for a, b in zip(boundaries[:-1], boundaries[1:])]
+        with multiprocessing.Pool(len(jobs)) as pool:
+            results = pool.starmap(_score_columns, jobs)
+        results = dict((metric, np.concatenate([result[metric] for result in results])) for metric in metrics)
+    else:
+        results = _score_columns(indptr, scores, truth, metrics, n_bins, bounds)
+
+    scored = np.flatnonzero(np.diff(indptr) > 0)
+    if 'roc_auc' in metrics:
+        undefined = scored[np.isnan(results['roc_auc'][scored])]
+        if len(undefined) > 0:
+            raise Exception('Only one class present in the truth for ' + str(labels[undefined[0]]) + '.')
+    return dict((metric, dict((labels[j], value) for j, value in zip(scored, results[metric][scored].tolist())))
+                for metric in metrics)
+
+
+def _score_columns(indptr, scores, truth, metrics, n_bins=None, bounds=None):
+    # Returns the metrics of each column, from the ranks of its entries' scores. Tied scores get their average rank, as
+    # in the Mann-Whitney statistic, and are one threshold for average precision.
+    if n_bins is not None:
+        return _score_columns_binned(indptr, scores, truth, metrics, n_bins, bounds)
+    n_columns = len(indptr) - 1
+    counts = np.diff(indptr)
+    columns = np.repeat(np.arange(n_columns), counts)
+    order = np.lexsort((scores, columns))
+    sorted_scores = scores[order]
+    positive = truth[order] != 0
+
+    # Groups tied scores in each column
+    new_group = np.ones(len(order), dtype=bool)
+    new_group[1:] = (columns[1:] != columns[:-1]) | (sorted_scores[1:] != sorted_scores[:-1])
+    starts = np.flatnonzero(new_group)
+    ends = np.append(starts[1:], len(order))
+    group_columns = columns[starts]
+    cumulative = np.concatenate(([0], np.cumsum(positive)))
+    group_positives = cumulative[ends] - cumulative[starts]
+    n_positives = np.bincount(columns, positive, n_columns)
+
+    results = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if 'roc_auc' in metrics:
+            ranks = (starts + ends + 1) / 2.0 - indptr[group_columns]
+            rank_sums = np.bincount(group_columns, group_positives * ranks, n_columns)
+            results['roc_auc'] = (rank_sums - n_positives * (n_positives + 1) / 2) / (n_positives *
+                                                                                      (counts - n_positives))
+        if 'average_precision' in metrics:
+            column_ends = indptr[group_columns + 1]
+            precisions = (cumulative[column_ends] - cumulative[starts]) / (column_ends - starts)
+            results['average_precision'] = np.bincount(group_columns, group_positives * precisions,
+                                                       n_columns) / n_positives
+    return results
+
+
+def _score_columns_binned(indptr, scores, truth, metrics, n_bins, bounds):
+    # Returns the metrics of each column from histograms of its positive and negative entries' scores, made for blocks
+    # of columns at a time
+    low, high = bounds
+    width = (high - low) / n_bins if high > low else 1.0
+    bins = np.clip(((scores - low) / width).astype(np.intp), 0, n_bins - 1)
+    positive = truth != 0
+    n_columns = len(indptr) - 1
+    results = dict((metric, np.zeros(n_columns)) for metric in metrics)
+    block_size = max(1, _MAX_HISTOGRAM_ENTRIES // n_bins)
+
+    for start in range(0, n_columns, block_size):
+        end = min(start + block_size, n_columns)
+        a, b = indptr[start], indptr[end]
+        keys = np.repeat(np.arange(end - start), np.diff(indptr[start:end + 1])) * n_bins + bins[a:b]
+        positives = np.bincount(keys, positive[a:b], (end - start) * n_bins).reshape(end - start, n_bins)
+        negatives = np.bincount(keys, minlength=(end - start) * n_bins).reshape(end - start, n_bins) - positives
+        n_positives = positives.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if 'roc_auc' in metrics:
+                below = np.cumsum(negatives, axis=1) - negatives
+                results['roc_auc'][start:end] = (positives * (below + 0.5 * negatives)).sum(axis=1) / (
+                    n_positives * negatives.sum(axis=1))
+            if 'average_precision' in metrics:
+                above_positives = np.cumsum(positives[:, ::-1], axis=1)[:, ::-1]
+                above = np.cumsum((positives + negatives)[:, ::-1], axis=1)[:, ::-1]
+                precisions = np.where(above > 0, above_positives / np.maximum(above, 1), 0)
+                results['average_precision'][start:end] = (positives * precisions).sum(axis=1) / n_positives
+    return results
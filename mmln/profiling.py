@@ -0,0 +1,111 @@
+import contextlib
+import json
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class Profiler:
+
+    def __init__(self, callback=None, callback_every=25, trace_memory=False):
+        # Records the wall time and peak memory of named phases, the number of potentials grounded for each rule
+        # family and kind of potential, and the residuals and time of each solver iteration. If a callback is given,
+        # it is called with the record of every callback_every-th iteration. Peak memory is the process's peak
+        # resident set size at the end of the phase, and, if trace_memory is set, the peak of the memory traced by
+        # tracemalloc during the phase, which counts numpy arrays but slows down pure Python code.
+        self.callback = callback
+        self.callback_every = callback_every
+        self.trace_memory = trace_memory
+
+        self.phases = {}
+        self.potentials = {}
+        self.iterations = []
+        self._open_phases = []
+        self._last_iteration = None
+        self._started_tracing = False
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        # Phases can be nested, and repeated phases with the same name are summed
+        self._observe_peak()
+        frame = {'peak': 0}
+        self._open_phases.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self._observe_peak()
+            self._open_phases.pop()
+            if not self._open_phases and self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+
+            stats = self.phases.setdefault(name, {'seconds': 0.0, 'calls': 0})
+            stats['seconds'] += seconds
+            stats['calls'] += 1
+            if resource is not None:
+                stats['peak_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _RSS_UNIT
+            if self.trace_memory:
+                stats['peak_traced_bytes'] = max(stats.get('peak_traced_bytes', 0), frame['peak'])
+
+    def count(self, family, kind, n):
+        if n > 0:
+            kinds = self.potentials.setdefault(family, {})
+            kinds[kind] = kinds.get(kind, 0) + int(n)
+
+    def start_iterations(self, solver):
+        self._last_iteration = (solver, time.perf_counter())
+
+    def record_iteration(self, iteration, **values):
+        # Records the values of the iteration, e.g., its residuals, with the time since the last one or since
+        # start_iterations
+        solver, last = self._last_iteration
+        now = time.perf_counter()
+        record = dict(values, solver=solver, iteration=iteration, seconds=now - last)
+        self.iterations.append(record)
+        self._last_iteration = (solver, now)
+        if self.callback is not None and iteration % self.callback_every == 0:
+            self.callback(record)
+
+    def to_dict(self):
+        return {'phases': self.phases, 'potentials': self.potentials, 'iterations': self.iterations}
+
+    def to_json(self, path=None):
+        # Returns the report as JSON, and also writes it to path if given
+        report = json.dumps(self.to_dict(), indent=2, default=float)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(report)
+        return report
+
+    def _observe_peak(self):
+        # Adds the peak traced memory since the last observation to every open phase and starts a new peak. Tracing
+        # is started if needed, and is then stopped when the outermost phase ends.
+        if not self.trace_memory:
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        peak = tracemalloc.get_traced_memory()[1]
+        for frame in self._open_phases:
+            frame['peak'] = max(frame['peak'], peak)
+        tracemalloc.reset_peak()
+
+
+def _phase(profiler, name):
+    # Returns the profiler's context manager for the phase, or one that does nothing if there is no profiler
+    return profiler.phase(name) if profiler is not None else contextlib.nullcontext()
+
+
+def _kind(n_vars, two_sided):
+    return ('one' if n_vars == 1 else 'two') + '_var_' + ('bowl' if two_sided else 'hinge')
+
+
+# ru_maxrss is in bytes on macOS and kilobytes elsewhere
+_RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
@@ -1,5 +1,7 @@
 import random
 
+import numpy as np
+
 import mmln
 
 
@@ -7,6 +9,12 @@ def estimate_p_values_inter_node(net, n_samples=1000, seed=271828):
     random.seed(seed)
     labels = list(mmln.get_all_labels(net))
 
+    # Counts adjacent pairs in the samples with the label store's adjacency matrix. Sampling node indices draws the
+    # same samples as sampling the nodes.
+    store = net if isinstance(net, mmln.LabelStore) else mmln.LabelStore.from_network(net)
+    adjacency = store.get_pattern()
+    n_nodes = len(store.nodes)
+
     p = {}
     for label in labels:
         p[label] = {}
@@ -15,12 +23,12 @@ def estimate_p_values_inter_node(net, n_samples=1000, seed=271828):
         label1 = labels[i]
         for j in range(i, len(labels)):
             label2 = labels[j]
-            obsv = mmln.count_adjacent_labels(net, label1, label2)
-            n_label1 = mmln.count_labels(net, label1)
+            obsv = mmln.count_adjacent_labels(store, label1, label2)
+            n_label1 = mmln.count_labels(store, label1)
             if label1 == label2:
                 n_label2 = n_label1
             else:
-                n_label2 = mmln.count_labels(net, label2)
+                n_label2 = mmln.count_labels(store, label2)
 
             # Results at least as high as obsv
             pos = 0
@@ -28,18 +36,15 @@ def estimate_p_values_inter_node(net, n_samples=1000, seed=271828):
             neg = 0
 
             for sample in range(0, n_samples):
-                labelled1 = random.sample(net.nodes(), n_label1)
+                labelled1 = random.sample(range(n_nodes), n_label1)
                 if label1 == label2:
                     labelled2 = labelled1
                 else:
-                    labelled2 = random.sample(net.nodes(), n_label2)
-
-                adj_labels = 0
-                for node1 in labelled1:
-                    node1_neighbors = set(net.neighbors(node1))
-                    for node2 in labelled2:
-                        if node2 in node1_neighbors:
-                            adj_labels += 1
+                    labelled2 = random.sample(range(n_nodes), n_label2)
+
+                labelled2_indicator = np.zeros(n_nodes)
+                labelled2_indicator[labelled2] = 1
+                adj_labels = adjacency[labelled1].dot(labelled2_indicator).sum()
 
                 if label1 == label2:
                     adj_labels /= 2
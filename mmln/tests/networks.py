@@ -0,0 +1,35 @@
+import networkx as nx
+
+import mmln
+
+# A small model and network shared by the grounding tests. The network has a self-loop, targets and observations on
+# the same node, and a fractional observation.
+
+LABEL1 = 'Label 1'
+LABEL2 = 'Label 2'
+
+
+def get_model():
+    model = mmln.Model(regularization=0.5)
+    model.inter_node_pos[(LABEL1, LABEL2)] = 2
+    model.inter_node_pos[(LABEL2, LABEL2)] = 3
+    model.intra_node_pos[(LABEL1, LABEL2)] = 5
+    return model
+
+
+def get_network():
+    net = nx.Graph()
+    net.add_edge(1, 2)
+    net.add_edge(2, 3)
+    net.add_edge(3, 1)
+    net.add_edge(3, 4)
+    net.add_edge(4, 4)
+
+    net.node[1][mmln.TARGETS] = {LABEL1: 0}
+    net.node[2][mmln.TARGETS] = {LABEL1: 0, LABEL2: 0}
+    net.node[3][mmln.OBSVS] = {LABEL2: 0}
+    net.node[3][mmln.TARGETS] = {LABEL1: 0}
+    net.node[4][mmln.OBSVS] = {LABEL1: 1, LABEL2: 0.5}
+    net.node[4][mmln.TARGETS] = {LABEL2: 0}
+
+    return net
@@ -0,0 +1,61 @@
+from unittest import TestCase
+import os
+import tempfile
+
+import mmln
+import mmln.ground
+import mmln.infer
+from mmln.tests.networks import get_model, get_network
+
+
+class TestGroundingCache(TestCase):
+
+    label1 = 'Label 1'
+    label2 = 'Label 2'
+
+    def test_cache(self):
+        model = get_model()
+        net = get_network()
+        with tempfile.TemporaryDirectory() as path:
+            cache = mmln.GroundingCache(path)
+
+            potentials = []
+            for use_cache in (False, True, True):
+                inf = mmln.infer.VectorizedHLMRF()
+                manager = mmln.ground.GroundingManager(model, net, [self.label1, self.label2], inf)
+                manager.init_all_weights(cache=cache if use_cache else None)
+                columns = inf.get_potentials()
+                potentials.append(sorted(zip(*(columns[name].tolist() for name in sorted(columns)))))
+            self.assertEqual(len(potentials[0]), 26)
+            self.assertEqual(potentials[0], potentials[1])
+            self.assertEqual(potentials[0], potentials[2])
+            self.assertEqual(len(os.listdir(path)), 1)
+
+            # Potentials from the cache are added to objects the same way
+            values = []
+            for use_cache in (False, True):
+                inf = mmln.infer.HLMRF()
+                manager = mmln.ground.GroundingManager(model, net, [self.label1, self.label2], inf)
+                manager.init_all_weights(cache=cache if use_cache else None)
+                inf.infer()
+                values.append([manager.get_value(*var_id) for var_id in sorted(manager.variables)])
+            for value, cached_value in zip(*values):
+                self.assertAlmostEqual(value, cached_value)
+
+    def test_eviction(self):
+        model = get_model()
+        net = get_network()
+        with tempfile.TemporaryDirectory() as path:
+            cache = mmln.GroundingCache(path, max_bytes=0)
+            manager = mmln.ground.GroundingManager(model, net, [self.label1, self.label2], mmln.infer.SparseQP())
+            manager.init_all_weights(cache=cache)
+            key = cache.get_key(model, manager.store, [self.label1, self.label2])
+
+            # A change to the model changes the key, and the old entry is evicted
+            model.inter_node_pos[(self.label1, self.label1)] = 1
+            manager = mmln.ground.GroundingManager(model, net, [self.label1, self.label2], mmln.infer.SparseQP())
+            manager.init_all_weights(cache=cache)
+            new_key = cache.get_key(model, manager.store, [self.label1, self.label2])
+            self.assertNotEqual(key, new_key)
+            self.assertEqual(os.listdir(path), [new_key])
+            self.assertIsNone(cache.load(key))
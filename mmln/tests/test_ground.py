@@ -1,9 +1,11 @@
 from unittest import TestCase
 import networkx as nx
+import numpy as np
 
 import mmln
 import mmln.ground
 import mmln.infer
+from mmln.tests.networks import get_model, get_network
 
 
 class TestGroundingManager(TestCase):
@@ -106,6 +108,190 @@ class TestGroundingManager(TestCase):
         self.assertEqual(len(inf.pots), 24)
         self.assertEqual(inf.set_weight_count, 24)
 
+    def test_integer_variables(self):
+        model = mmln.Model()
+
+        net = nx.Graph()
+        net.add_node(1)
+        net.add_node(2)
+        net.add_edge(1, 2)
+
+        net.node[1][mmln.OBSVS] = {self.label1: 1}
+        net.node[2][mmln.TARGETS] = {self.label1: 0}
+
+        inf = mmln.infer.VectorizedHLMRF()
+        manager = mmln.ground.GroundingManager(model, net, {self.label1}, inf)
+        self.assertEqual(manager.variables[(2, self.label1)], 0)
+        manager.init_all_weights()
+        self.assertEqual(inf.n_pots, 2)
+        inf.infer()
+        self.assertAlmostEqual(manager.get_value(2, self.label1), 0.75, 2)
+
+    def test_bulk(self):
+        model = get_model()
+        net = get_network()
+
+        potentials = []
+        for bulk in (False, True):
+            inf = mmln.infer.VectorizedHLMRF()
+            manager = mmln.ground.GroundingManager(model, net, [self.label1, self.label2], inf)
+            manager.init_all_weights(bulk=bulk)
+            columns = inf.get_potentials()
+            potentials.append(sorted(zip(*(columns[name].tolist() for name in sorted(columns)))))
+        self.assertEqual(len(potentials[0]), 26)
+        self.assertEqual(potentials[0], potentials[1])
+
+    def test_parallel(self):
+        model = get_model()
+        net = get_network()
+
+        potentials = []
+        for n_jobs in (1, 2, 3):
+            inf = mmln.infer.VectorizedHLMRF()
+            manager = mmln.ground.GroundingManager(model, net, [self.label1, self.label2], inf)
+            manager.init_all_weights(n_jobs=n_jobs)
+            columns = inf.get_potentials()
+            potentials.append(sorted(zip(*(columns[name].tolist() for name in sorted(columns)))))
+        self.assertEqual(len(potentials[0]), 26)
+        self.assertEqual(potentials[0], potentials[1])
+        self.assertEqual(potentials[0], potentials[2])
+
+    def test_update(self):
+        model = get_model()
+        net = get_network()
+
+        inf = mmln.infer.VectorizedHLMRF()
+        manager = mmln.ground.GroundingManager(model, net, [self.label1, self.label2], inf)
+        manager.init_all_weights()
+        inf.infer()
+
+        manager.update(added_nodes=[(5, {mmln.OBSVS: {self.label2: 1}, mmln.TARGETS: {self.label1: 0}})],
+                       removed_nodes=[1], added_edges=[(5, 2), (5, 4)], removed_edges=[(4, 4)],
+                       label_changes={3: {mmln.OBSVS: {self.label1: 1}, mmln.TARGETS: {self.label2: 0}},
+                                      4: {mmln.OBSVS: {self.label1: 0, self.label2: 0.5}}})
+        self.assertEqual(sorted(manager.variables), [(2, self.label1), (2, self.label2), (3, self.label2),
+                                                     (4, self.label2), (5, self.label1)])
+        inf.infer()
+
+        new_inf = mmln.infer.VectorizedHLMRF()
+        new_manager = mmln.ground.GroundingManager(model, net, [self.label1, self.label2], new_inf)
+        new_manager.init_all_weights()
+        new_inf.infer()
+
+        potentials = []
+        for m in (manager, new_manager):
+            var_ids = dict((var, var_id) for var_id, var in m.variables.items())
+            var_ids[-1] = None
+            columns = m.inf.get_potentials()
+            columns['var1'] = [var_ids[var] for var in columns['var1'].tolist()]
+            columns['var2'] = [var_ids[var] for var in columns['var2'].tolist()]
+            potentials.append(sorted(zip(*(list(columns[name]) for name in sorted(columns))), key=str))
+        self.assertEqual(len(potentials[0]), len(potentials[1]))
+        for pot, new_pot in zip(*potentials):
+            self.assertEqual(pot[:-1], new_pot[:-1])
+            self.assertAlmostEqual(pot[-1], new_pot[-1])
+
+        for var_id in new_manager.variables:
+            self.assertAlmostEqual(manager.get_value(*var_id), new_manager.get_value(*var_id), 2)
+
+    def test_update_existing_edge(self):
+        model = mmln.Model(regularization=0.5)
+        model.inter_node_pos[(self.label1, self.label2)] = 2
+
+        net = nx.Graph()
+        net.add_edge(1, 2)
+        net.add_edge(2, 3)
+
+        net.node[1][mmln.TARGETS] = {self.label1: 0}
+        net.node[2][mmln.TARGETS] = {self.label1: 0, self.label2: 0}
+        net.node[3][mmln.OBSVS] = {self.label1: 1, self.label2: 0.5}
+
+        inf = mmln.infer.VectorizedHLMRF()
+        manager = mmln.ground.GroundingManager(model, net, [self.label1, self.label2], inf)
+        manager.init_all_weights()
+
+        manager.update(added_edges=[(1, 2), (3, 2)])
+
+        new_inf = mmln.infer.VectorizedHLMRF()
+        new_manager = mmln.ground.GroundingManager(model, net, [self.label1, self.label2], new_inf)
+        new_manager.init_all_weights()
+
+        potentials = []
+        for m in (manager, new_manager):
+            var_ids = dict((var, var_id) for var_id, var in m.variables.items())
+            var_ids[-1] = None
+            columns = m.inf.get_potentials()
+            columns['var1'] = [var_ids[var] for var in columns['var1'].tolist()]
+            columns['var2'] = [var_ids[var] for var in columns['var2'].tolist()]
+            potentials.append(sorted(zip(*(list(columns[name]) for name in sorted(columns))), key=str))
+        self.assertEqual(len(potentials[0]), len(potentials[1]))
+        for pot, new_pot in zip(*potentials):
+            self.assertEqual(pot[:-1], new_pot[:-1])
+            self.assertAlmostEqual(pot[-1], new_pot[-1])
+
+    def test_max_degree(self):
+        model = mmln.Model(regularization=0.5)
+
+        # A hub with 50 observed neighbors
+        net = nx.Graph()
+        net.add_node(0)
+        net.node[0][mmln.TARGETS] = {self.label1: 0}
+        for node in range(1, 51):
+            net.add_edge(0, node)
+            net.node[node][mmln.OBSVS] = {self.label1: node / 51.0}
+
+        potentials = []
+        for max_degree in (None, 10, 10, 100):
+            inf = mmln.infer.VectorizedHLMRF()
+            manager = mmln.ground.GroundingManager(model, net, [self.label1], inf)
+            manager.init_all_weights(max_degree=max_degree)
+            potentials.append(inf.get_potentials())
+        self.assertEqual(len(potentials[0]['weight']), 51)
+        self.assertEqual(len(potentials[1]['weight']), 11)
+        self.assertAlmostEqual(potentials[1]['weight'].sum(), potentials[0]['weight'].sum())
+        for name in potentials[0]:
+            self.assertEqual(potentials[1][name].tolist(), potentials[2][name].tolist())
+            self.assertEqual(potentials[0][name].tolist(), potentials[3][name].tolist())
+
+        # When the neighbors are targets, the potentials they ground to the hub are capped too
+        for node in range(1, 51):
+            net.node[node][mmln.TARGETS] = {self.label1: 0}
+        inf = mmln.infer.VectorizedHLMRF()
+        manager = mmln.ground.GroundingManager(model, net, [self.label1], inf)
+        manager.init_all_weights(max_degree=10)
+        potentials = inf.get_potentials()
+        hub = manager.variables[(0, self.label1)]
+        self.assertEqual(np.count_nonzero((potentials['var1'] == hub) | (potentials['var2'] == hub)), 21)
+
+    def test_aggregate(self):
+        model = mmln.Model(regularization=0.5)
+        model.inter_node_pos[(self.label1, self.label2)] = 2
+        model.intra_node_pos[(self.label1, self.label2)] = 5
+
+        # A hub with 40 observed neighbors, one of which is also a target
+        net = nx.Graph()
+        net.add_node(0)
+        net.node[0][mmln.TARGETS] = {self.label1: 0, self.label2: 0}
+        for node in range(1, 41):
+            net.add_edge(0, node)
+            net.node[node][mmln.OBSVS] = {self.label1: node % 2, self.label2: [0, 1, 0.25][node % 3]}
+        net.node[1][mmln.TARGETS] = {self.label1: 0}
+
+        n_pots = []
+        values = []
+        for aggregate, n_jobs in ((False, 1), (True, 1), (True, 2)):
+            inf = mmln.infer.SparseQP()
+            manager = mmln.ground.GroundingManager(model, net, [self.label1, self.label2], inf)
+            manager.init_all_weights(n_jobs=n_jobs, aggregate=aggregate)
+            n_pots.append(inf.n_pots)
+            inf.infer()
+            values.append([manager.get_value(*var_id) for var_id in sorted(manager.variables)])
+        self.assertEqual(n_pots, [18, 8, 8])
+        for value, aggregated_value, parallel_value in zip(*values):
+            self.assertAlmostEqual(value, aggregated_value)
+            self.assertAlmostEqual(value, parallel_value)
+        self.assertRaises(Exception, manager.update, removed_nodes=[2])
+
 
 class _FakeInference(mmln.infer.Inference):
 
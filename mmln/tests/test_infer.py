@@ -1,4 +1,8 @@
 from unittest import TestCase
+import os
+import tempfile
+import numpy as np
+import random
 
 import mmln
 import mmln.infer
@@ -43,12 +47,335 @@ class TestInference(TestCase):
             self.assertAlmostEqual(v4.value, .196, 3)
             self.assertAlmostEqual(v5.value, .313, 3)
 
+    def test_warm_start(self):
+        for inf in self._get_inference_methods():
+            variables = _add_random_potentials(inf, 161803)
+            inf.infer()
+            cold_iterations = inf.iterations
+
+            inf.add_weight(0.1, 1, variables[0], -0.5, two_sided=True, squared=True)
+            inf.set_weight(1, (2, -1), (variables[1], variables[2]), 0, squared=True)
+            inf.set_weight(0, (2, -1), (variables[1], variables[2]), 0, squared=True)
+            inf.infer()
+            self.assertLess(inf.iterations, cold_iterations)
+
+            reference = mmln.infer.HLMRF(max_iter=1000)
+            reference_vars = _add_random_potentials(reference, 161803)
+            reference.add_weight(0.1, 1, reference_vars[0], -0.5, two_sided=True, squared=True)
+            reference.infer()
+            for reference_var, var in zip(reference_vars, variables):
+                self.assertAlmostEqual(reference_var.value, var.value, 2)
+
     def _get_inference_methods(self):
-        return {self._get_hlmrf()}
+        return {self._get_hlmrf(), self._get_vectorized_hlmrf(), self._get_sparse_qp()}
 
     def _get_hlmrf(self):
         return mmln.infer.HLMRF(max_iter=1000)
 
+    def _get_vectorized_hlmrf(self):
+        return mmln.infer.VectorizedHLMRF(max_iter=1000)
+
+    def _get_sparse_qp(self):
+        return mmln.infer.SparseQP()
+
+
+class TestVectorizedHLMRF(TestCase):
+
+    def test_matches_hlmrf(self):
+        reference = mmln.infer.HLMRF(max_iter=500)
+        reference_vars = _add_random_potentials(reference, 271828)
+        reference.infer()
+
+        inf = mmln.infer.VectorizedHLMRF(max_iter=500)
+        variables = _add_random_potentials(inf, 271828)
+        inf.infer()
+
+        for reference_var, var in zip(reference_vars, variables):
+            self.assertAlmostEqual(reference_var.value, var.value, 8)
+
+    def test_parallel(self):
+        serial = mmln.infer.VectorizedHLMRF(max_iter=500)
+        serial_vars = _add_random_potentials(serial, 314159)
+        serial.infer()
+
+        inf = mmln.infer.VectorizedHLMRF(max_iter=500, n_jobs=3)
+        variables = _add_random_potentials(inf, 314159)
+        inf.infer()
+
+        for serial_var, var in zip(serial_vars, variables):
+            self.assertAlmostEqual(serial_var.value, var.value, 10)
+
+    def test_by_component(self):
+        reference = mmln.infer.HLMRF(max_iter=1000)
+        reference_vars = _add_random_potentials(reference, 271828, n_pots=40)
+        reference.infer()
+
+        for n_jobs in (1, 2):
+            inf = mmln.infer.VectorizedHLMRF(max_iter=1000, n_jobs=n_jobs, by_component=True)
+            variables = _add_random_potentials(inf, 271828, n_pots=40)
+            inf.infer()
+            self.assertLessEqual(inf.iterations, reference.iterations)
+
+            for reference_var, var in zip(reference_vars, variables):
+                self.assertAlmostEqual(reference_var.value, var.value, 3)
+
+    def test_adaptive_eta_and_relaxation(self):
+        reference = mmln.infer.HLMRF(epsilon_rel=1e-6, max_iter=5000)
+        reference_vars = _add_random_potentials(reference, 271828)
+        reference.infer()
+
+        fixed = mmln.infer.VectorizedHLMRF(eta=100.0, epsilon_rel=1e-6, max_iter=5000)
+        _add_random_potentials(fixed, 271828)
+        fixed.infer()
+        self.assertEqual(len(fixed.history), fixed.iterations)
+
+        for by_component in (False, True):
+            inf = mmln.infer.VectorizedHLMRF(eta=100.0, epsilon_rel=1e-6, max_iter=5000, by_component=by_component,
+                                             adaptive_eta=True, relaxation=1.6)
+            variables = _add_random_potentials(inf, 271828)
+            inf.infer()
+            self.assertLess(inf.iterations, fixed.iterations / 10)
+            self.assertLess(inf.history[-1][2], 100.0)
+
+            # The deferred multiplier update is applied with the last eta, since the next run starts with eta again
+            arrays = inf._get_arrays()
+            self.assertTrue(np.array_equal(arrays['local_copy1'], inf._get_values()[arrays['var1']]))
+
+            for reference_var, var in zip(reference_vars, variables):
+                self.assertAlmostEqual(reference_var.value, var.value, 3)
+
+    def test_merge_potentials(self):
+        inf = mmln.infer.VectorizedHLMRF(max_iter=1000, merge_potentials=True)
+        v1 = mmln.infer.Variable()
+        v2 = mmln.infer.Variable()
+        inf.set_weight(1, 1, v1, -0.5, two_sided=True, squared=True)
+        inf.set_weight(1, 1, v2, -0.5, two_sided=True, squared=True)
+        # Observation terms, the first of which is always 0 on [0, 1] and the rest of which are bowls
+        inf.set_weight(3, 1, v1, -1, squared=True)
+        inf.set_weight(2, 1, v1, 0, squared=True)
+        inf.set_weight(2, -1, v2, 1, squared=True)
+        # Opposite hinges with equal weights, i.e., a bowl
+        inf.set_weight(4, (1, -1), (v1, v2), 0, squared=True)
+        inf.set_weight(4, (1, -1), (v2, v1), 0, squared=True)
+        inf.infer()
+
+        self.assertEqual(len(inf.merged_arrays['weight']), 3)
+        self.assertTrue(inf.merged_arrays['bowl'].all())
+        self.assertAlmostEqual(v1.value, 0.409, 2)
+        self.assertAlmostEqual(v2.value, 0.591, 2)
+
+    def test_merge_random_potentials(self):
+        inf = mmln.infer.VectorizedHLMRF(merge_potentials=True)
+        _add_random_potentials(inf, 271828)
+        arrays = inf._get_arrays()
+        merged = mmln.infer._merge_potentials(arrays)
+        self.assertLess(len(merged['weight']), len(arrays['weight']))
+
+        # The objectives should differ by a constant on the box
+        rand = random.Random(271828)
+        differences = []
+        for _ in range(5):
+            x = np.array([rand.random() for _ in range(inf.n_vars)])
+            differences.append(_get_objective(arrays, x) - _get_objective(merged, x))
+        for difference in differences:
+            self.assertAlmostEqual(difference, differences[0], 8)
+
+    def test_integer_variables(self):
+        inf = mmln.infer.VectorizedHLMRF()
+        variables = inf.new_variables(range(20))
+        self.assertEqual(len(variables), 20)
+
+        # Adds, changes and removes many potentials, checking the index against a dictionary
+        rand = random.Random(271828)
+        weights = {}
+        for _ in range(3000):
+            var1, var2 = rand.sample(variables, 2)
+            key = rand.choice((((1,), (var1,), -1 * rand.randint(0, 1), False),
+                               ((1, -1), (var1, var2), 0, False),
+                               ((1, -1), (var1, var2), 0, True)))
+            if key in weights and rand.random() < 0.5:
+                inf.set_weight(0, key[0], key[1], key[2], two_sided=key[3], squared=True)
+                del weights[key]
+            else:
+                weights[key] = rand.random() + 0.1
+                inf.set_weight(weights[key], key[0], key[1], key[2], two_sided=key[3], squared=True)
+
+        self.assertEqual(inf.n_pots, len(weights))
+        for key, weight in weights.items():
+            self.assertEqual(inf.get_weight(key[0], key[1], key[2], two_sided=key[3], squared=True), weight)
+        counts = np.zeros(inf.n_vars)
+        for key in weights:
+            for var in key[1]:
+                counts[var] += 1
+        self.assertTrue(np.array_equal(inf.counts[:inf.n_vars], counts))
+
+        inf.infer()
+        for var in variables:
+            self.assertTrue(0 <= inf.get_value(var) <= 1)
+
+    def test_change_weights(self):
+        inf = mmln.infer.VectorizedHLMRF(max_iter=1000)
+        v1 = mmln.infer.Variable()
+        v2 = mmln.infer.Variable()
+        inf.set_weight(1, 1, v1, -0.5, two_sided=True, squared=True)
+        inf.set_weight(1, 1, v2, -0.5, two_sided=True, squared=True)
+        inf.set_weight(5, -1, v1, 1, squared=True)
+        inf.infer()
+        self.assertAlmostEqual(v1.value, 0.917, 2)
+        self.assertAlmostEqual(v2.value, 0.5, 2)
+
+        inf.set_weight(1, -1, v1, 1, squared=True)
+        inf.set_weight(5, (1, -1), (v2, v1), 0, two_sided=True, squared=True)
+        self.assertEqual(inf.get_weight(-1, v1, 1, squared=True), 1)
+        inf.infer()
+        self.assertAlmostEqual(v1.value, 0.676, 2)
+        self.assertAlmostEqual(v2.value, 0.647, 2)
+
+        inf.set_weight(0, (1, -1), (v2, v1), 0, two_sided=True, squared=True)
+        inf.infer()
+        self.assertAlmostEqual(v1.value, 0.75, 2)
+        self.assertAlmostEqual(v2.value, 0.5, 2)
+
+    def test_checkpoint(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'admm.npz')
+            for merge_potentials in (False, True):
+                reference = mmln.infer.VectorizedHLMRF(max_iter=1000, merge_potentials=merge_potentials)
+                reference_vars = _add_random_potentials(reference, 161803)
+                reference.infer()
+
+                inf = mmln.infer.VectorizedHLMRF(max_iter=30, checkpoint_path=path, checkpoint_every=20,
+                                                 merge_potentials=merge_potentials)
+                _add_random_potentials(inf, 161803)
+                inf.infer()
+
+                # Resumes from iteration 20 without adding the potentials again
+                resumed = mmln.infer.VectorizedHLMRF(max_iter=1000, merge_potentials=merge_potentials)
+                variables = resumed.new_variables(range(len(reference_vars)))
+                resumed.load_checkpoint(path)
+                self.assertEqual(resumed.n_pots, reference.n_pots)
+                resumed.infer()
+                self.assertEqual(resumed.iterations, reference.iterations)
+                self.assertEqual(len(resumed.history), resumed.iterations)
+
+                for reference_var, var in zip(reference_vars, variables):
+                    self.assertAlmostEqual(reference_var.value, resumed.get_value(var), 8)
+
+    def test_infer_batch(self):
+        for merge_potentials in (False, True):
+            inf = mmln.infer.VectorizedHLMRF(max_iter=1000, merge_potentials=merge_potentials)
+            variables = _add_random_potentials(inf, 271828)
+            potentials = inf.get_potentials()
+            weights = np.column_stack((potentials['weight'], 2 * potentials['weight'],
+                                       np.where(potentials['bowl'], 0.1, 1) * potentials['weight']))
+            values = inf.infer_batch(weights)
+            self.assertEqual(values.shape, (len(variables), 3))
+            self.assertTrue(all(var.value == 0 for var in variables))
+
+            for i in range(3):
+                reference = mmln.infer.VectorizedHLMRF(max_iter=1000, merge_potentials=merge_potentials)
+                reference.new_variables(range(len(variables)))
+                reference.set_potentials(dict(potentials, weight=weights[:, i]))
+                reference.infer()
+
+                for j in range(len(variables)):
+                    self.assertAlmostEqual(reference.get_value(j), values[j, i], 8)
+
+            # A configuration that zeroes weights is solved as if those potentials were removed
+            weights = np.column_stack((potentials['weight'], np.where(np.arange(inf.n_pots) % 3 == 0, 0,
+                                                                      potentials['weight'])))
+            values = inf.infer_batch(weights)
+            reference = mmln.infer.VectorizedHLMRF(max_iter=1000, merge_potentials=merge_potentials)
+            reference.new_variables(range(len(variables)))
+            kept = weights[:, 1] > 0
+            reference.set_potentials(dict((name, column[kept]) for name, column in potentials.items()))
+            reference.infer()
+            for j in range(len(variables)):
+                self.assertAlmostEqual(reference.get_value(j), values[j, 1], 8)
+
+    def test_add_weights(self):
+        inf = mmln.infer.VectorizedHLMRF()
+        reference = mmln.infer.VectorizedHLMRF()
+        variables = np.asarray(inf.new_variables(range(4)))
+        reference.new_variables(range(4))
+        reference.add_weight(1, (1, -1), (1, 2), 0, squared=True)
+        inf.add_weight(1, (1, -1), (1, 2), 0, squared=True)
+
+        pairs = np.array([[0, 1], [1, 2], [0, 1], [3, 0]])
+        inf.add_weights([1, 2, 3, 4], (1, -1), variables[pairs], 0, squared=True)
+        inf.add_weights(0.5, 1, variables, [-0.5, -0.5, 0, -1], two_sided=True, squared=True)
+        for weight, (var1, var2) in zip([1, 2, 3, 4], pairs):
+            reference.add_weight(weight, (1, -1), (int(var1), int(var2)), 0, squared=True)
+        for var, constant in zip(range(4), [-0.5, -0.5, 0, -1]):
+            reference.add_weight(0.5, 1, var, constant, two_sided=True, squared=True)
+
+        self.assertEqual(inf.n_pots, 7)
+        self.assertEqual(inf.get_weight((1, -1), (0, 1), 0, squared=True), 4)
+        self.assertEqual(inf.get_weight((1, -1), (1, 2), 0, squared=True), 3)
+        reference.infer()
+        inf.infer()
+        for var in range(4):
+            self.assertAlmostEqual(inf.get_value(var), reference.get_value(var), 8)
+
+        inf.add_weights(-3, (1, -1), [[1, 2]], 0, squared=True)
+        self.assertEqual(inf.n_pots, 6)
+        self.assertEqual(inf.get_weight((1, -1), (1, 2), 0, squared=True), 0)
+
+
+class TestSparseQP(TestCase):
+
+    def test_matches_hlmrf(self):
+        reference = mmln.infer.HLMRF(epsilon_rel=1e-7, max_iter=5000)
+        reference_vars = _add_random_potentials(reference, 271828)
+        reference.infer()
+
+        inf = mmln.infer.SparseQP()
+        variables = _add_random_potentials(inf, 271828)
+        inf.infer()
+        self.assertLess(inf.iterations, 20)
+
+        for reference_var, var in zip(reference_vars, variables):
+            self.assertAlmostEqual(reference_var.value, var.value, 4)
+
+    def test_no_hinges(self):
+        inf = mmln.infer.SparseQP()
+        v1 = mmln.infer.Variable()
+        v2 = mmln.infer.Variable()
+        inf.set_weight(1, 1, v1, -0.5, two_sided=True, squared=True)
+        inf.set_weight(1, 1, v2, -0.5, two_sided=True, squared=True)
+        inf.set_weight(1, 1, v1, -1, two_sided=True, squared=True)
+        inf.set_weight(5, (1, -1), (v2, v1), 0, two_sided=True, squared=True)
+        inf.infer()
+        self.assertAlmostEqual(v1.value, 0.676, 3)
+        self.assertAlmostEqual(v2.value, 0.647, 3)
+
+        # Pushes the unconstrained minimizer outside the box
+        inf.set_weight(10, 1, v1, -3, two_sided=True, squared=True)
+        inf.infer()
+        self.assertEqual(v1.value, 1.0)
+        self.assertAlmostEqual(v2.value, 0.917, 3)
+
+    def test_no_iterations(self):
+        inf = mmln.infer.SparseQP(max_iter=0)
+        variables = _add_random_potentials(inf, 271828)
+        inf.infer()
+        self.assertEqual(inf.iterations, 0)
+        self.assertTrue(all(var.value == 0 for var in variables))
+
+    def test_failed_line_search(self):
+        # A direction in which the objective increases is never taken
+        class AscentQP(mmln.infer.SparseQP):
+            def _solve(self, hessian, b, direct):
+                return -b
+
+        inf = AscentQP()
+        variables = _add_random_potentials(inf, 271828)
+        for var in variables:
+            var.value = 0.5
+        inf.infer()
+        self.assertEqual(inf.iterations, 0)
+        self.assertTrue(all(var.value == 0.5 for var in variables))
+
 
 class TestHLMRF(TestCase):
 
@@ -84,3 +411,32 @@ class TestHLMRF(TestCase):
         pot.optimize_local_copies()
         self.assertAlmostEqual(pot.local_copy1, 0.62)
         self.assertAlmostEqual(pot.local_copy2, 0.58)
+
+
+def _add_random_potentials(inf, seed, n_vars=50, n_pots=150):
+    rand = random.Random(seed)
+    variables = [mmln.infer.Variable() for _ in range(n_vars)]
+    for var in variables:
+        inf.add_weight(rand.random(), 1, var, -0.5, two_sided=True, squared=True)
+
+    for _ in range(n_pots):
+        var1, var2 = rand.sample(variables, 2)
+        weight = 3 * rand.random()
+        r = rand.random()
+        if r < 0.25:
+            inf.add_weight(weight, 1, var1, -1 * rand.randint(0, 1), squared=True)
+        elif r < 0.5:
+            inf.add_weight(weight, -1, var1, rand.randint(0, 1), squared=True)
+        elif r < 0.9:
+            inf.add_weight(weight, (1, -1), (var1, var2), 0, squared=True)
+        else:
+            inf.add_weight(weight, (1, -1), (var1, var2), 0, two_sided=True, squared=True)
+
+    return variables
+
+
+def _get_objective(arrays, x):
+    r = arrays['coeff1'] * x[arrays['var1']] + arrays['coeff2'] * arrays['two_vars'] * x[arrays['var2_safe']] + \
+        arrays['const']
+    r = np.where(arrays['bowl'], r, np.maximum(r, 0))
+    return np.dot(arrays['weight'], r ** 2)
@@ -0,0 +1,74 @@
+from unittest import TestCase
+import networkx as nx
+
+import mmln
+
+
+class TestLabelStore(TestCase):
+
+    label1 = 'Label 1'
+    label2 = 'Label 2'
+
+    def test_round_trip(self):
+        net = self._get_network()
+        store = mmln.LabelStore.from_network(net)
+        self.assertEqual(store.matrices[mmln.OBSVS].nnz, 5)
+        self.assertEqual(store.matrices[mmln.TARGETS].nnz, 3)
+        self.assertEqual(store.adjacency.nnz, 8)
+
+        nodes, obsvs = store.get_column(mmln.OBSVS, self.label2)
+        self.assertEqual([store.nodes[i] for i in nodes], [2, 3, 4])
+        self.assertEqual(obsvs.tolist(), [1, 1, 0])
+
+        found, truth = store.lookup(mmln.TRUTH, self.label1, nodes)
+        self.assertEqual(found.tolist(), [True, False, True])
+        self.assertEqual(truth.tolist(), [0, 1])
+
+        copy = self._get_network()
+        for node in copy.nodes():
+            copy.node[node].clear()
+        store.to_network(copy)
+        for node in net.nodes():
+            self.assertEqual(copy.node[node], net.node[node])
+
+    def test_counts(self):
+        net = self._get_network()
+        store = mmln.LabelStore.from_network(net)
+        self.assertEqual(mmln.get_all_labels(store), mmln.get_all_labels(net))
+        for label1 in (self.label1, self.label2):
+            self.assertEqual(mmln.count_labels(store, label1), mmln.count_labels(net, label1))
+            for label2 in (self.label1, self.label2):
+                self.assertEqual(mmln.count_coocurring_intra_node_labels(store, label1, label2),
+                                 mmln.count_coocurring_intra_node_labels(net, label1, label2))
+                self.assertEqual(mmln.count_adjacent_labels(store, label1, label2),
+                                 mmln.count_adjacent_labels(net, label1, label2))
+
+        self.assertEqual(mmln.count_adjacent_labels(store, self.label1, self.label2), 3)
+        self.assertEqual(mmln.count_adjacent_labels(store, self.label2, self.label2), 1)
+
+    def _get_network(self):
+        net = nx.Graph()
+        net.add_node(1)
+        net.add_node(2)
+        net.add_node(3)
+        net.add_node(4)
+
+        net.add_edge(1, 2)
+        net.add_edge(2, 3)
+        net.add_edge(3, 1)
+        net.add_edge(3, 4)
+
+        net.node[1][mmln.OBSVS] = {self.label1: 1}
+        net.node[2][mmln.OBSVS] = {self.label2: 1}
+        net.node[3][mmln.OBSVS] = {self.label1: 1, self.label2: 1}
+        net.node[4][mmln.OBSVS] = {self.label2: 0}
+
+        net.node[1][mmln.TARGETS] = {self.label2: 0}
+        net.node[2][mmln.TARGETS] = {self.label1: 0}
+        net.node[4][mmln.TARGETS] = {self.label1: 0}
+
+        net.node[1][mmln.TRUTH] = {self.label2: 1}
+        net.node[2][mmln.TRUTH] = {self.label1: 0}
+        net.node[4][mmln.TRUTH] = {self.label1: 1}
+
+        return net
@@ -1,7 +1,11 @@
+import copy
 from unittest import TestCase
 import networkx as nx
+import numpy as np
+import sklearn.metrics
 
 import mmln
+import mmln.infer
 
 
 class TestPredictor(TestCase):
@@ -19,6 +23,252 @@ class TestPredictor(TestCase):
         self.assertEqual(predictor.get_per_label_score()[self.label1], 0.75)
         self.assertEqual(predictor.get_per_label_score()[self.label2], 0.5)
 
+    def test_predict_sparse_qp(self):
+        model = mmln.Model()
+        net = self._get_network()
+        predictor = mmln.MRFPredictor(net)
+        predictor.predict(model, inf=mmln.infer.SparseQP())
+
+        self.assertAlmostEqual(net.node[1][mmln.TARGETS][self.label1], 0.583, 3)
+        self.assertAlmostEqual(net.node[3][mmln.TARGETS][self.label1], 0.667, 3)
+        self.assertEqual(predictor.get_per_label_score()[self.label1], 0.75)
+        self.assertEqual(predictor.get_per_label_score()[self.label2], 0.5)
+
+    def test_predict_label_store(self):
+        model = mmln.Model()
+        net = self._get_network()
+        store = mmln.LabelStore.from_network(net)
+        predictor = mmln.MRFPredictor(store)
+        predictor.predict(model, inf=mmln.infer.SparseQP())
+
+        predictions = predictor.get_per_label_predictions()
+        self.assertAlmostEqual(predictions[self.label1][1], 0.583, 3)
+        self.assertAlmostEqual(predictions[self.label1][3], 0.667, 3)
+        self.assertEqual(net.node[1][mmln.TARGETS][self.label1], 0)
+        self.assertEqual(predictor.get_per_label_score()[self.label1], 0.75)
+
+    def test_predict_queries(self):
+        model = mmln.Model()
+        model.inter_node_pos[(self.label1, self.label2)] = 2
+        store = mmln.LabelStore.from_network(self._get_network())
+        predictor = mmln.MRFPredictor(store)
+        predictor.predict(model, inf=mmln.infer.SparseQP())
+        predictions = predictor.get_per_label_predictions()
+        boundary = store.matrices[mmln.TARGETS].data.copy()
+
+        # Fixing the boundary at the full solution gives the same predictions for the queries
+        queries = [(1, self.label1), (2, self.label2)]
+        for depth, local_boundary in ((0, boundary), (1, boundary), (3, None)):
+            local_store = mmln.LabelStore.from_network(self._get_network())
+            local_predictor = mmln.MRFPredictor(local_store)
+            local_predictor.predict(model, inf=mmln.infer.SparseQP(), queries=queries, depth=depth,
+                                    boundary=local_boundary)
+            local_predictions = local_predictor.get_per_label_predictions()
+            for node, label in queries:
+                self.assertAlmostEqual(local_predictions[label][node], predictions[label][node], 6)
+
+            # Predictions for targets other than the queries are left as they were
+            for label, values in local_predictions.items():
+                for node, value in values.items():
+                    if (node, label) not in queries:
+                        self.assertEqual(value, 0)
+
+    def test_label_prop(self):
+        net = self._get_network()
+        net.add_edge(2, 2, weight=0.5)
+        net.node[2][mmln.OBSVS] = {'Label 3': 1}
+        net.node[4][mmln.TARGETS] = {'Label 3': 0}
+        store = mmln.LabelStore.from_network(net)
+
+        # Solves the system for each label with dense matrices
+        adjacency = store.adjacency.toarray()
+        laplacian = np.diag(1 + 2 * adjacency.sum(axis=1)) - adjacency + np.diag(adjacency.diagonal())
+        solution = np.linalg.solve(laplacian, store.matrices[mmln.OBSVS].toarray())
+
+        for block_size in (1, 2, 256):
+            predictor = mmln.LabelPropPredictor(mmln.LabelStore.from_network(net))
+            predictor.predict(lam=2.0, block_size=block_size)
+            predictions = predictor.get_per_label_predictions()
+            self.assertEqual(sum(len(values) for values in predictions.values()), 6)
+            for label, values in predictions.items():
+                for node, value in values.items():
+                    self.assertAlmostEqual(value, solution[store.node_index[node], store.label_index[label]])
+
+    def test_label_prop_cg(self):
+        net = self._get_network()
+        net.add_edge(2, 2, weight=0.5)
+        net.node[2][mmln.OBSVS] = {'Label 3': 1}
+        net.node[4][mmln.TARGETS] = {'Label 3': 0}
+
+        predictor = mmln.LabelPropPredictor(mmln.LabelStore.from_network(net))
+        predictor.predict(lam=2.0)
+        predictions = predictor.get_per_label_predictions()
+
+        for preconditioner, warm_start in (('jacobi', False), ('ilu', False), ('jacobi', True)):
+            store = predictor.store if warm_start else mmln.LabelStore.from_network(net)
+            cg_predictor = mmln.LabelPropPredictor(store)
+            cg_predictor.predict(lam=2.0, block_size=2, solver='cg', tol=1e-10, preconditioner=preconditioner,
+                                 warm_start=warm_start)
+            cg_predictions = cg_predictor.get_per_label_predictions()
+            for label, values in predictions.items():
+                for node, value in values.items():
+                    self.assertAlmostEqual(cg_predictions[label][node], value)
+        self.assertRaises(Exception, cg_predictor.predict, lam=0.5, solver='cg')
+
+        # The incomplete factorization preconditioner is symmetric, as CG needs
+        (A, precondition), _ = cg_predictor._factorize(2.0, 'cg', 'ilu')
+        R = np.random.RandomState(0).rand(A.shape[0], 2)
+        self.assertAlmostEqual(R[:, 0].dot(precondition(R)[:, 1]), R[:, 1].dot(precondition(R)[:, 0]))
+
+    def test_network_changes(self):
+        net = nx.Graph()
+        net.add_edge(1, 2)
+        net.node[1][mmln.OBSVS] = {self.label1: 1}
+        net.node[2][mmln.TARGETS] = {self.label1: 0}
+        net.node[2][mmln.TRUTH] = {self.label1: 1}
+
+        # Changes to the network after the predictor is made are seen by the next prediction
+        predictor = mmln.LabelPropPredictor(net)
+        predictor.predict()
+        self.assertAlmostEqual(net.node[2][mmln.TARGETS][self.label1], 1 / 3)
+        net.node[1][mmln.OBSVS] = {self.label1: 0}
+        predictor.predict()
+        self.assertEqual(net.node[2][mmln.TARGETS][self.label1], 0)
+        self.assertEqual(predictor.get_per_label_predictions(), {self.label1: {2: 0}})
+
+    def test_label_prop_cache(self):
+        cache = mmln.FactorizationCache()
+        predictions = []
+        for observed, lam in ((self.label1, 1.0), (self.label2, 1), (self.label2, 2.0)):
+            net = self._get_network()
+            net.node[2][mmln.OBSVS] = {observed: 1}
+            for use_cache in (False, True):
+                predictor = mmln.LabelPropPredictor(net)
+                predictor.predict(lam=lam, cache=cache if use_cache else None)
+                predictions.append(predictor.get_per_label_predictions())
+            self.assertEqual(predictions[-2], predictions[-1])
+        self.assertNotEqual(predictions[0], predictions[2])
+        self.assertEqual((cache.misses, cache.hits, len(cache.entries)), (2, 1, 2))
+
+        # The least recently used factorization is evicted
+        cache.max_bytes = cache.n_bytes
+        cache.get(cache.get_key(mmln.LabelStore.from_network(net).adjacency, (1.0, 'direct', None)))
+        predictor.predict(lam=3.0, cache=cache)
+        self.assertEqual(len(cache.entries), 2)
+        self.assertEqual(cache.hits, 2)
+        self.assertIn(cache.get_key(predictor.store.adjacency, (1.0, 'direct', None)), cache.entries)
+
+    def test_label_prop_update(self):
+        net = self._get_network()
+        predictor = mmln.LabelPropPredictor(net)
+        self.assertRaises(Exception, predictor.update, added_nodes=[5])
+        predictor.predict(lam=1.5, keep_solution=True)
+
+        # Every pair near the changes is observed or a target, so the updates are exact
+        predictor.update(added_nodes=[(5, {mmln.OBSVS: {self.label2: 1},
+                                           mmln.TARGETS: {self.label1: 0},
+                                           mmln.TRUTH: {self.label1: 1}})],
+                         added_edges=[(5, 4), (5, 1, {'weight': 2.0}), (2, 3, {'weight': 0.5})],
+                         label_changes={2: {mmln.OBSVS: {self.label1: 1}}}, lam=1.5, tol=1e-12)
+        predictions = predictor.get_per_label_predictions()
+        self.assertIn(5, predictions[self.label1])
+
+        solved = mmln.LabelPropPredictor(copy.deepcopy(net))
+        solved.predict(lam=1.5)
+        for label, values in solved.get_per_label_predictions().items():
+            for node, value in values.items():
+                self.assertAlmostEqual(predictions[label][node], value)
+
+        # New nodes can attach through pairs that are neither observed nor targets, and re-adding an edge that exists
+        # keeps its weight
+        net = nx.Graph()
+        net.add_edge(1, 2)
+        net.add_edge(2, 3, weight=2.0)
+        net.node[1][mmln.OBSVS] = {self.label1: 1}
+        net.node[3][mmln.TARGETS] = {self.label1: 0}
+        predictor = mmln.LabelPropPredictor(net)
+        predictor.predict(keep_solution=True, solution_cutoff=1e-12)
+        predictor.update(added_nodes=[(4, {mmln.TARGETS: {self.label1: 0}})], added_edges=[(4, 2), (2, 3)],
+                         tol=1e-12)
+        self.assertEqual(net[2][3]['weight'], 2.0)
+        predictions = predictor.get_per_label_predictions()
+        self.assertGreater(predictions[self.label1][4], 0)
+
+        solved = mmln.LabelPropPredictor(copy.deepcopy(net))
+        solved.predict()
+        for label, values in solved.get_per_label_predictions().items():
+            for node, value in values.items():
+                self.assertAlmostEqual(predictions[label][node], value)
+
+    def test_per_label_scores(self):
+        rng = np.random.RandomState(0)
+        net = nx.gnm_random_graph(60, 150, seed=0)
+        labels = ['Label ' + str(i) for i in range(5)]
+        for node in net.nodes():
+            net.node[node][mmln.OBSVS] = dict((label, int(rng.rand() < 0.3)) for label in labels if rng.rand() < 0.5)
+            net.node[node][mmln.TARGETS] = dict((label, 0) for label in labels
+                                                if label not in net.node[node][mmln.OBSVS])
+            net.node[node][mmln.TRUTH] = dict((label, int(rng.rand() < 0.4)) for label in net.node[node][mmln.TARGETS])
+        predictor = mmln.LabelPropPredictor(net)
+        predictor.predict()
+
+        # Rounding the predictions makes ties, and no two distinct predictions fall in the same one of 1000 bins
+        predictor._set_predictions(np.round(predictor.store.matrices[mmln.TARGETS].data, 2))
+        expected = dict((metric, {}) for metric in ('roc_auc', 'average_precision'))
+        for label in labels:
+            nodes, y = predictor.store.get_column(mmln.TARGETS, label)
+            y_true = predictor.store.lookup(mmln.TRUTH, label, nodes)[1]
+            expected['roc_auc'][label] = sklearn.metrics.roc_auc_score(y_true, y)
+            expected['average_precision'][label] = sklearn.metrics.average_precision_score(y_true, y)
+
+        for n_jobs, n_bins in ((1, None), (2, None), (1, 1000), (2, 1000)):
+            scores = predictor.get_per_label_scores(n_jobs=n_jobs, n_bins=n_bins)
+            for metric, metric_scores in expected.items():
+                self.assertEqual(set(scores[metric]), set(labels))
+                for label, score in metric_scores.items():
+                    self.assertAlmostEqual(scores[metric][label], score)
+        self.assertEqual(predictor.get_per_label_score(sklearn.metrics.average_precision_score),
+                         predictor.get_per_label_scores(('average_precision',))['average_precision'])
+
+        net.node[next(node for node in net.nodes() if net.node[node][mmln.TARGETS])][mmln.TRUTH] = {}
+        self.assertRaises(Exception, predictor.get_per_label_scores)
+
+    def test_sparse_predictions(self):
+        net = self._get_network()
+        predictor = mmln.MRFPredictor(net, writeback=False)
+        predictor.predict(mmln.Model(), inf=mmln.infer.SparseQP())
+        self.assertEqual(net.node[1][mmln.TARGETS][self.label1], 0)
+        targets = predictor.store.matrices[mmln.TARGETS]
+
+        predictions = predictor.get_predictions()
+        self.assertEqual((predictions != targets).nnz, 0)
+        self.assertEqual(predictor.get_per_label_score(predictions=predictions), predictor.get_per_label_score())
+
+        top = predictor.get_predictions(k=1, threshold=0.5)
+        for i in range(len(predictor.store.nodes)):
+            row = top.getrow(i)
+            self.assertLessEqual(row.nnz, 1)
+            if row.nnz > 0:
+                self.assertGreaterEqual(row.data[0], 0.5)
+                self.assertEqual(row.data[0], targets.getrow(i).data.max())
+        self.assertAlmostEqual(top[predictor.store.node_index[3], predictor.store.label_index[self.label1]], 0.667, 3)
+
+        # Targets missing from the top predictions are scored the same way by both paths
+        per_label = predictor.get_per_label_score(lambda y_true, y: sklearn.metrics.roc_auc_score(y_true, y),
+                                                  predictions=top)
+        self.assertEqual(predictor.get_per_label_score(predictions=top), per_label)
+
+        values, labels = predictor.get_top_k(2)
+        node3, node4 = predictor.store.node_index[3], predictor.store.node_index[4]
+        self.assertAlmostEqual(values[node3, 0], 0.667, 3)
+        self.assertEqual(labels[node3].tolist(), [predictor.store.label_index[self.label1], -1])
+        self.assertTrue(np.isnan(values[node3, 1]))
+        self.assertEqual(labels[node4].tolist(), [-1, -1])
+        node1 = predictor.store.node_index[1]
+        self.assertGreaterEqual(values[node1, 0], values[node1, 1])
+        for rank in range(2):
+            self.assertEqual(values[node1, rank], targets[node1, labels[node1, rank]])
+
     def _get_network(self):
         net = nx.Graph()
         net.add_node(1)
@@ -0,0 +1,45 @@
+from unittest import TestCase
+import json
+import tracemalloc
+
+import mmln
+import mmln.infer
+from mmln.tests.networks import get_model, get_network
+
+
+class TestProfiler(TestCase):
+
+    label1 = 'Label 1'
+    label2 = 'Label 2'
+
+    def test_profile(self):
+        model = get_model()
+
+        records = []
+        profiler = mmln.Profiler(callback=records.append, callback_every=5, trace_memory=True)
+        inf = mmln.infer.VectorizedHLMRF()
+        predictor = mmln.MRFPredictor(get_network())
+        predictor.predict(model, inf=inf, profiler=profiler)
+        self.assertIsNone(inf.profiler)
+        self.assertFalse(tracemalloc.is_tracing())
+
+        report = json.loads(profiler.to_json())
+        for name in ('grounding', 'ground regularization', 'ground intra', 'ground inter', 'ground default',
+                     'inference', 'set predictions'):
+            self.assertGreaterEqual(report['phases'][name]['calls'], 1)
+            self.assertGreater(report['phases'][name]['peak_traced_bytes'], 0)
+        self.assertGreaterEqual(report['phases']['grounding']['seconds'],
+                                report['phases']['ground intra']['seconds'])
+
+        self.assertEqual(report['potentials'], {
+            'regularization': {'one_var_bowl': 5},
+            'intra': {'two_var_hinge': 1, 'one_var_hinge': 2},
+            'inter': {'two_var_hinge': 4, 'one_var_hinge': 8},
+            'default': {'two_var_hinge': 6, 'one_var_bowl': 1}})
+
+        self.assertEqual(len(report['iterations']), inf.iterations)
+        self.assertEqual([record['iteration'] for record in records], list(range(5, inf.iterations + 1, 5)))
+        for record, (primal_res, dual_res, eta) in zip(report['iterations'], inf.history):
+            self.assertEqual(record['solver'], 'VectorizedHLMRF')
+            self.assertAlmostEqual(record['primal_res'], primal_res)
+            self.assertAlmostEqual(record['dual_res'], dual_res)
@@ -1,5 +1,7 @@
 import random
 
+import numpy as np
+
 import mmln
 
 
@@ -79,6 +81,10 @@ def _make_target(network, node, label):
 
 
 def get_all_labels(net):
+    if isinstance(net, mmln.LabelStore):
+        counts = sum(np.bincount(matrix.indices, minlength=len(net.labels)) for matrix in net.matrices.values())
+        return set(label for label, j in net.label_index.items() if counts[j] > 0)
+
     all_labels = set()
     for collection in (mmln.OBSVS, mmln.TARGETS, mmln.TRUTH):
         for node in net.nodes():
@@ -97,6 +103,9 @@ def prune_labels(net, labels_to_keep):
 
 
 def count_labels(net, label):
+    if isinstance(net, mmln.LabelStore):
+        return int(np.count_nonzero(_get_binary_obsvs(net, label)[1] == 1))
+
     count = 0
     for node in net.nodes():
         if mmln.OBSVS in net.node[node]:
@@ -111,6 +120,14 @@ def count_labels(net, label):
 
 
 def count_coocurring_intra_node_labels(net, label1, label2):
+    if isinstance(net, mmln.LabelStore):
+        nodes1, obsvs1 = net.get_column(mmln.OBSVS, label1)
+        nodes2, obsvs2 = net.get_column(mmln.OBSVS, label2)
+        _, indices1, indices2 = np.intersect1d(nodes1, nodes2, assume_unique=True, return_indices=True)
+        _check_binary(net, label1, nodes1[indices1], obsvs1[indices1])
+        _check_binary(net, label2, nodes2[indices2], obsvs2[indices2])
+        return int(np.count_nonzero((obsvs1[indices1] == 1) & (obsvs2[indices2] == 1)))
+
     count = 0
     for node in net.nodes():
         if _check_cooccurence(net, node, label1, node, label2):
@@ -119,11 +136,24 @@ def count_coocurring_intra_node_labels(net, label1, label2):
 
 
 def count_adjacent_labels(net, label1, label2):
+    # Counts ordered pairs of neighbors with label1 and label2, i.e., each edge in each direction in which it matches
+    if isinstance(net, mmln.LabelStore):
+        positives = []
+        for label in (label1, label2):
+            nodes, obsvs = _get_binary_obsvs(net, label)
+            positive = np.zeros(len(net.nodes))
+            positive[nodes[obsvs == 1]] = 1
+            positives.append(positive)
+        count = int(positives[0].dot(net.get_pattern().dot(positives[1])))
+        if label1 == label2:
+            count /= 2
+        return count
+
     count = 0
     for node1, node2 in net.edges():
         if _check_cooccurence(net, node1, label1, node2, label2):
             count += 1
-        elif _check_cooccurence(net, node1, label1, node2, label2):
+        if node1 != node2 and _check_cooccurence(net, node2, label1, node1, label2):
             count += 1
 
     if label1 == label2:
@@ -148,3 +178,16 @@ def _check_cooccurence(net, node1, label1, node2, label2):
                                 ' for (' + str(node2) + ', ' + str(label2) + ')')
 
     return False
+
+
+def _get_binary_obsvs(store, label):
+    nodes, obsvs = store.get_column(mmln.OBSVS, label)
+    _check_binary(store, label, nodes, obsvs)
+    return nodes, obsvs
+
+
+def _check_binary(store, label, nodes, obsvs):
+    invalid = np.flatnonzero((obsvs != 0) & (obsvs != 1))
+    if len(invalid) > 0:
+        raise Exception('Only values in {0, 1} are accepted observations. Found ' + str(obsvs[invalid[0]]) +
+                        ' for (' + str(store.nodes[nodes[invalid[0]]]) + ', ' + str(label) + ')')